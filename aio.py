@@ -0,0 +1,266 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# asyncio counterpart of transport.Transport.
+#
+# A minimal HTTP/1.1 client (GET only, keep-alive, chunked and
+# gzip/deflate bodies) on top of asyncio streams, thus a request in
+# flight costs a coroutine instead of a thread. Responses are
+# requests.Response objects, such that sources, the page cache and
+# page_encoding() work unchanged.
+#
+# CPU-bound work (parsing, cleanup, writing) is run in an executor
+# via run(). Code that runs there may use the blocking get().
+
+import asyncio
+import concurrent.futures
+import functools
+import ssl
+import urllib.parse
+import zlib
+
+import requests
+import requests.models
+import requests.structures
+import requests.utils
+
+import cache
+import ratelimit
+import transport
+
+
+redirect_statuses = (301, 302, 303, 307, 308)
+
+
+class Pool(object):
+
+  def __init__(self, size):
+    self.idle = []
+    self.slots = asyncio.Semaphore(size)
+
+  def close(self):
+    for reader, writer in self.idle:
+      writer.close()
+    self.idle = []
+
+
+def decode_body(body, encoding):
+  encoding = (encoding or '').strip().lower()
+  if encoding == 'gzip':
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+  if encoding == 'deflate':
+    try:
+      return zlib.decompress(body)
+    except zlib.error:
+      return zlib.decompress(body, -zlib.MAX_WBITS)
+  return body
+
+
+def response(url, status, reason, headers, body):
+  r = requests.Response()
+  r.status_code = status
+  r.reason = reason
+  r.url = url
+  r.headers = headers
+  r._content = decode_body(body, headers.get('Content-Encoding'))
+  r.encoding = requests.utils.get_encoding_from_headers(headers)
+  return r
+
+
+class Transport(object):
+
+  def __init__(self, args):
+    self.args = args
+    self.limiter = ratelimit.AsyncHostLimiter(transport.request_rate(args))
+    self.connect_timeout = args.connect_timeout
+    self.read_timeout = args.read_timeout
+    self.stats = transport.ConnectionStats()
+    self.pool_size = args.pool_size or max(1, args.jobs)
+    self.pools = {}
+    self.headers = { 'User-Agent': args.agent,
+        'Accept-Encoding': args.compression, 'Connection': 'keep-alive' }
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, args.jobs))
+    self.loop = None
+    self.cache = None
+    if args.cache:
+      self.cache = cache.HttpCache(args.cache,
+          int(args.cache_size * 1024 * 1024), args.cache_ttl)
+    elif args.offline:
+      raise ValueError('--offline requires --cache')
+
+  # must be called from the event loop before the first request
+  def start(self):
+    self.loop = asyncio.get_running_loop()
+
+  async def run(self, f, *args):
+    return await self.loop.run_in_executor(self.executor,
+        functools.partial(f, *args))
+
+  # blocking, for code that runs in the executor (or another thread)
+  def get(self, url, stats=None, retries=None):
+    return asyncio.run_coroutine_threadsafe(self.aget(url, stats, retries),
+        self.loop).result()
+
+  async def connect(self, u):
+    port = u.port or (443 if u.scheme == 'https' else 80)
+    ctx = None
+    if u.scheme == 'https':
+      ctx = ssl.create_default_context()
+    self.stats.connection(u.hostname)
+    return await asyncio.wait_for(asyncio.open_connection(u.hostname, port,
+      ssl=ctx), self.connect_timeout)
+
+  async def read(self, f, *args):
+    return await asyncio.wait_for(f(*args), self.read_timeout)
+
+  async def read_body(self, reader, status, headers):
+    if status in (204, 304):
+      return b''
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+      l = []
+      while True:
+        line = await self.read(reader.readline)
+        n = int(line.split(b';')[0], 16)
+        if n == 0:
+          while (await self.read(reader.readline)) not in (b'\r\n', b''):
+            pass
+          return b''.join(l)
+        l.append(await self.read(reader.readexactly, n))
+        await self.read(reader.readexactly, 2)
+    if 'Content-Length' in headers:
+      return await self.read(reader.readexactly,
+          int(headers['Content-Length']))
+    return await self.read(reader.read)
+
+  # one request/response on an open connection, returns the
+  # response and whether the connection can be reused
+  async def exchange(self, conn, u, url, headers):
+    reader, writer = conn
+    path = u.path or '/'
+    if u.query:
+      path += '?' + u.query
+    h = dict(self.headers)
+    h['Host'] = u.netloc
+    h.update(headers or {})
+    lines = [ 'GET {} HTTP/1.1'.format(path) ]
+    lines += [ '{}: {}'.format(k, v) for k, v in h.items() ]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    line = await self.read(reader.readline)
+    if not line:
+      raise ConnectionResetError('Connection closed by {}'.format(u.netloc))
+    version, status, reason = (line.decode('latin-1').rstrip('\r\n')
+        .split(' ', 2) + [ '' ])[:3]
+    status = int(status)
+    rh = requests.structures.CaseInsensitiveDict()
+    while True:
+      line = await self.read(reader.readline)
+      if line in (b'\r\n', b'\n', b''):
+        break
+      k, v = line.decode('latin-1').split(':', 1)
+      rh[k.strip()] = v.strip()
+    body = await self.read_body(reader, status, rh)
+    keep = (version == 'HTTP/1.1'
+        and rh.get('Connection', '').lower() != 'close'
+        and ('Content-Length' in rh or 'Transfer-Encoding' in rh
+          or status in (204, 304)))
+    return response(url, status, reason, rh, body), keep
+
+  # A reused connection may have been closed by the server in the
+  # meantime - then the request is repeated on a new one.
+  async def request(self, url, headers=None):
+    u = urllib.parse.urlsplit(url)
+    key = (u.scheme, u.netloc)
+    pool = self.pools.get(key)
+    if not pool:
+      pool = Pool(self.pool_size)
+      self.pools[key] = pool
+    async with pool.slots:
+      while True:
+        reused = bool(pool.idle)
+        conn = pool.idle.pop() if reused else await self.connect(u)
+        try:
+          r, keep = await self.exchange(conn, u, url, headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+          conn[1].close()
+          if reused:
+            continue
+          raise
+        except BaseException:
+          conn[1].close()
+          raise
+        break
+      if keep:
+        pool.idle.append(conn)
+      else:
+        conn[1].close()
+      return r
+
+  # Follows redirects like a requests session, the response is the
+  # one of the last hop.
+  async def follow(self, url, headers=None):
+    for hop in range(requests.models.DEFAULT_REDIRECT_LIMIT + 1):
+      r = await self.request(url, headers)
+      if (r.status_code not in redirect_statuses
+          or 'Location' not in r.headers):
+        return r
+      url = urllib.parse.urljoin(url, r.headers['Location'])
+    raise requests.TooManyRedirects('Exceeded {} redirects'.format(
+      requests.models.DEFAULT_REDIRECT_LIMIT))
+
+  # retries like transport.Transport.fetch()
+  async def fetch(self, url, headers=None, stats=None, retries=None):
+    attempt = 0
+    while True:
+      delay = await self.limiter.acquire(url)
+      if stats:
+        stats.add('wait', delay)
+      self.stats.request(urllib.parse.urlsplit(url).hostname)
+      page, error = None, None
+      try:
+        page = await self.follow(url, headers)
+      except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        error = e
+      delay = transport.retry_delay(url, page, error, self.limiter, retries,
+          attempt)
+      if delay is None:
+        if error:
+          raise error
+        return page
+      await asyncio.sleep(delay)
+      if stats:
+        stats.add('wait', delay)
+      attempt += 1
+
+  # same cache handling as transport.Transport.get()
+  async def aget(self, url, stats=None, retries=None):
+    if not self.cache:
+      return await self.fetch(url, stats=stats, retries=retries)
+    entry = self.cache.lookup(url)
+    if entry and (self.args.offline or self.cache.fresh(entry)):
+      self.cache.count('hit')
+      return self.cache.response(url, entry)
+    if self.args.offline:
+      raise RuntimeError('Not in cache (offline mode): {}'.format(url))
+    headers = None
+    if entry:
+      headers = self.cache.conditional_headers(entry)
+    page = await self.fetch(url, headers, stats, retries)
+    if entry and page.status_code == 304:
+      self.cache.count('revalidated')
+      self.cache.revalidated(url, entry)
+      return self.cache.response(url, entry)
+    self.cache.count('miss')
+    if page.status_code == 200:
+      self.cache.put(url, page)
+    return page
+
+  def close(self):
+    if self.args.conn_stats:
+      self.stats.log()
+    if self.cache:
+      self.cache.log()
+    for pool in self.pools.values():
+      pool.close()
+    self.executor.shutdown()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Per-chapter cleanup time as rules are added: one tree walk for all
+# rules (cleanup.Engine) vs. one walk per rule (like the former
+# XPath sweeps).
+#
+# The 'uniform' rule set consists of rules with comparable cost per
+# element (attribute stripping), thus it shows the cost of the walks
+# themselves: with a single walk, the time grows only by the work of
+# the rules. The 'mixed' set is a realistic one - there, a rule that
+# changes the tree (e.g. unwrapping the many anchors of dmoe_2) adds
+# its own cost, no matter how many walks there are.
+#
+# Usage (from the top-level directory):
+#
+#     python3 -m bench.cleanup [--repeat N]
+
+import argparse
+import time
+
+import lxml.html
+
+import cleanup
+
+parser = argparse.ArgumentParser(description='Benchmark chapter cleanup.')
+parser.add_argument('--repeat', type=int, default=20,
+    help='number of runs per fixture and rule count (the fastest counts)')
+
+uniform = [ cleanup.StripAttributes([ a ]) for a in [ 'class', 'style',
+  'align', 'id', 'title', 'lang', 'dir', 'width' ] ]
+
+mixed = [
+  cleanup.StripAttributes(['class']),
+  cleanup.Unwrap(['a'], unless='href'),
+  cleanup.RemoveEmpty(['p']),
+  cleanup.StripAttributes(['style']),
+  cleanup.StripAttributes(['align'], ['p', 'div', 'h1', 'h2', 'h3']),
+  cleanup.Unwrap(['font', 'center']),
+  cleanup.RemoveEmpty(['span']),
+  cleanup.StripAttributes(['id', 'title']),
+  ]
+
+
+def load(fn):
+  with open(fn, 'rb') as f:
+    return f.read()
+
+
+def measure(s, repeat, apply):
+  t = []
+  for i in range(repeat):
+    div = lxml.html.fromstring(s).xpath('//div[@id="gutenb"]')[0]
+    start = time.perf_counter()
+    apply(div)
+    t.append(time.perf_counter() - start)
+  return min(t) * 1000
+
+
+def main():
+  args = parser.parse_args()
+  print('{:<12} {:<8} {:>5} {:>12} {:>12}'.format('fixture', 'set', 'rules',
+    'single [ms]', 'multi [ms]'))
+  for (fn, name, rules) in [ (fn, name, rules)
+      for fn in [ 'test/in/dmoe_1.html', 'test/in/dmoe_2.html' ]
+      for name, rules in [ ('uniform', uniform), ('mixed', mixed) ] ]:
+    s = load(fn)
+    for n in range(1, len(rules) + 1):
+      engine = cleanup.Engine(rules[:n])
+      passes = [ cleanup.Engine([ r ]) for r in rules[:n] ]
+      def multi(div):
+        for p in passes:
+          p.apply(div)
+      print('{:<12} {:<8} {:>5} {:>12.3f} {:>12.3f}'.format(fn.split('/')[-1],
+        name, n,
+        measure(s, args.repeat, engine.apply),
+        measure(s, args.repeat, multi)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Size/time trade-off of the epub compression levels.
+#
+# Usage (from the top-level directory):
+#
+#     python3 -m bench.compress [--chapters N]
+
+import argparse
+import copy
+import os
+import shutil
+import tempfile
+import time
+
+import lxml.html
+
+import epub
+
+parser = argparse.ArgumentParser(description='Benchmark epub compression.')
+parser.add_argument('--chapters', type=int, default=124,
+    help='number of chapters of the synthetic book')
+parser.add_argument('--levels', default='0,1,6,9',
+    help='comma separated compression levels')
+
+
+def stage(path, n):
+  with open('test/in/dmoe_2.html', 'rb') as f:
+    tree = lxml.html.fromstring(f.read())
+  div = tree.xpath('//div[@id="gutenb"]')[0]
+  book = epub.Book(path)
+  book.title = 'Benchmark'
+  book.uuid = '0'
+  book.push_author('Robert', 'Musil')
+  for i in range(n):
+    book.push_chapter('Chapter {}'.format(i), [ copy.deepcopy(div) ])
+  book.write_mimetype()
+  book.write_css()
+  book.write_container()
+  book.write_opf()
+  book.write_ncx()
+  return book
+
+
+def main():
+  args = parser.parse_args()
+  path = tempfile.mkdtemp()
+  try:
+    book = stage(path, args.chapters)
+    print('{:>5} {:>7} {:>10} {:>9}'.format('level', 'threads', 'bytes', 'seconds'))
+    for level in [ int(x) for x in args.levels.split(',') ]:
+      for jobs in sorted(set([ 1, os.cpu_count() or 1 ])):
+        book.compress_level = level
+        book.compress_jobs = jobs
+        start = time.perf_counter()
+        book.write_epub()
+        t = time.perf_counter() - start
+        print('{:>5} {:>7} {:>10} {:>9.3f}'.format(level, jobs,
+          os.path.getsize(book.epub_filename()), t))
+  finally:
+    shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+  main()
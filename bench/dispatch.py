@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# URL dispatch cost and CLI startup time as the number of sources
+# grows. Dispatch is measured for hostname hits, for URLs that only
+# the combined regular expression matches and for the former loop
+# over every source's patterns. Startup is the wall time of
+# `book-dl.py --help` and of a single (offline, thus failing) URL
+# with the synthetic sources registered via --sources.
+#
+# Usage (from the top-level directory):
+#
+#     python3 -m bench.dispatch [--urls N] [--repeat N]
+
+import argparse
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import registry
+
+parser = argparse.ArgumentParser(description='Benchmark source dispatch.')
+parser.add_argument('--urls', type=int, default=10000,
+    help='number of dispatched URLs per measurement')
+parser.add_argument('--repeat', type=int, default=5,
+    help='number of CLI runs per measurement')
+parser.add_argument('--sizes', default='1,10,100,1000',
+    help='comma separated numbers of sources')
+
+
+def sources(n):
+  return [ { 'name': 's{}'.format(i), 'module': 'gb_de', 'cls': 'GB_DE',
+    'hosts': [ 'host{}.example.org'.format(i) ],
+    'patterns': [ 'mirror{}\\.example\\.net'.format(i) ] } for i in range(n) ]
+
+
+def urls(n, count, fmt):
+  return [ fmt.format(i % n) for i in range(count) ]
+
+
+def loop_match(l, url):
+  for name, exps in l:
+    for e in exps:
+      if e.search(url):
+        return name
+  raise ValueError(url)
+
+
+def measure(f, l):
+  start = time.perf_counter()
+  for url in l:
+    f(url)
+  return (time.perf_counter() - start) / len(l) * 1e6
+
+
+def cli(argv, repeat):
+  t = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    subprocess.run([ sys.executable, 'book-dl.py' ] + argv,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    t.append(time.perf_counter() - start)
+  return min(t) * 1000
+
+
+def main():
+  args = parser.parse_args()
+  print('{:>7} {:>10} {:>10} {:>10} {:>11} {:>11}'.format('sources',
+    'host [us]', 'regex [us]', 'loop [us]', 'help [ms]', 'url [ms]'))
+  d = tempfile.mkdtemp()
+  fn = d + '/sources.json'
+  for n in [ int(x) for x in args.sizes.split(',') ]:
+    r = registry.Registry()
+    l = sources(n)
+    for s in l:
+      r.add(registry.Source(**s))
+    # compiles the alternations
+    measure(r.match, urls(n, n, 'http://mirror{}.example.net/'))
+    loop = [ (s['name'], [ re.compile(p) for p in s['patterns'] ]) for s in l ]
+    hosts = urls(n, args.urls, 'http://host{}.example.org/a/b.xml')
+    mirrors = urls(n, args.urls, 'http://mirror{}.example.net/a/b.xml')
+    with open(fn, 'w') as f:
+      json.dump(l, f)
+    print('{:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>11.1f} {:>11.1f}'.format(n,
+      measure(r.match, hosts), measure(r.match, mirrors),
+      measure(lambda url: loop_match(loop, url), mirrors),
+      cli([ '--help' ], args.repeat),
+      cli([ '--sources', fn, '--out', d, '--offline', '--cache', d + '/cache',
+        '--level', 'error', 'http://host0.example.org/a/b.xml' ],
+        args.repeat)))
+  shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+  main()
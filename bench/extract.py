@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Chapter extraction: parsing the whole page vs. only the regions a
+# chapter needs (gb_de.parse_regions), on the fixtures and on pages
+# padded with synthetic markup outside of the chapter div. Peak
+# memory is the resident set size high-water mark (VmHWM, Linux) of
+# a fresh child process per measurement, since libxml2's allocations
+# aren't visible to tracemalloc - and ru_maxrss is inherited from the
+# parent.
+#
+# Usage (from the top-level directory):
+#
+#     python3 -m bench.extract [--repeat N] [--padding N,...]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import gb_de
+
+parser = argparse.ArgumentParser(description='Benchmark chapter extraction.')
+parser.add_argument('--repeat', type=int, default=20,
+    help='number of parses per fixture and method')
+parser.add_argument('--padding', default='0,1,10',
+    help='comma separated sizes (in MiB) of synthetic markup around the chapter')
+
+navigation = (b'<div class="nav"><ul><li><a href="/a">Eintrag</a></li>'
+    b'<li><a href="/b">Eintrag</a></li></ul><p>Werbung</p></div>\n')
+
+
+def load(fn):
+  with open(fn, 'rb') as f:
+    return f.read()
+
+
+def padded(s, mib):
+  pad = navigation * (mib * 1024 * 1024 // len(navigation))
+  i = s.index(b'<div id="gutenb">')
+  return s[:i] + pad + s[i:] + pad
+
+
+def parse(method, s):
+  if method == 'full':
+    return gb_de.parse_html(s, 'iso-8859-1')
+  tree = gb_de.parse_regions(s, gb_de.GB_DE.first_chapter_regions
+      if b'id="metadata"' in s else gb_de.GB_DE.chapter_regions, 'iso-8859-1')
+  if tree is None:
+    raise RuntimeError('Fast path rejected the page')
+  return tree
+
+
+def measure(method, s, repeat):
+  t = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    parse(method, s)
+    t.append(time.perf_counter() - start)
+  return min(t) * 1000
+
+
+# peak RSS in MiB of a child that parses the page, minus the one of
+# a child that just reads it
+def peak(method, fn):
+  r = []
+  for m in [ 'none', method ]:
+    out = subprocess.run([ sys.executable, '-m', 'bench.extract', '--child',
+      m, fn ], stdout=subprocess.PIPE, check=True).stdout
+    r.append(int(out))
+  return (r[1] - r[0]) / 1024
+
+
+def child(method, fn):
+  s = load(fn)
+  if method != 'none':
+    tree = parse(method, s)
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith('VmHWM:'):
+        print(line.split()[1])
+
+
+def main():
+  if sys.argv[1:2] == [ '--child' ]:
+    return child(sys.argv[2], sys.argv[3])
+  args = parser.parse_args()
+  print('{:<12} {:>8} {:>10} {:>10} {:>11} {:>11}'.format('fixture', 'size',
+    'full [ms]', 'fast [ms]', 'full [MiB]', 'fast [MiB]'))
+  d = tempfile.mkdtemp()
+  page = d + '/page.html'
+  for fn in [ 'test/in/dmoe_1.html', 'test/in/dmoe_2.html' ]:
+    for mib in [ int(x) for x in args.padding.split(',') ]:
+      s = padded(load(fn), mib)
+      with open(page, 'wb') as f:
+        f.write(s)
+      print('{:<12} {:>7}K {:>10.3f} {:>10.3f} {:>11.1f} {:>11.1f}'.format(
+        fn.split('/')[-1], len(s) // 1024,
+        measure('full', s, args.repeat), measure('fast', s, args.repeat),
+        peak('full', page), peak('fast', page)))
+  os.remove(page)
+  os.rmdir(d)
+
+
+if __name__ == '__main__':
+  main()
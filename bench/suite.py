@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks of the parse/clean/serialize/package hot path.
+#
+# Usage (from the top-level directory):
+#
+#     python3 -m bench.suite --save base.json
+#     [.. change something ..]
+#     python3 -m bench.suite --compare base.json
+#
+# The comparison exits with status 1 if a benchmark got slower than
+# the baseline by more than --threshold (relative, of the best run).
+
+import argparse
+import copy
+import json
+import logging
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import lxml.etree
+import lxml.html
+
+import epub
+import gb_de
+import test.gb_de
+
+parser = argparse.ArgumentParser(description='Run the microbenchmarks.')
+parser.add_argument('--sizes', default='10,1000,10000',
+    help='comma separated chapter counts of the synthetic books')
+parser.add_argument('--repeat', type=int, default=5,
+    help='runs per benchmark')
+parser.add_argument('--filter', help='only run benchmarks matching this regex')
+parser.add_argument('--save', help='store the results as JSON baseline')
+parser.add_argument('--compare', help='compare against a JSON baseline')
+parser.add_argument('--threshold', type=float, default=0.1,
+    help='relative slowdown that counts as regression (default: 0.1)')
+
+
+def load(fn):
+  with open(fn, 'rb') as f:
+    return f.read()
+
+
+def synthetic_div(i):
+  return lxml.etree.fromstring(
+      '<div><h3>Kapitel {0}</h3><p class="centerbig">Titel {0}</p>'
+      '<p>Ulrich <a name="a{0}"/>kam nach Hause.</p><p> </p>'
+      '<p>Es war ein schöner Augusttag des Jahres 1913.</p></div>'.format(i))
+
+
+def synthetic_book(path, n):
+  book = epub.Book(path)
+  book.title = 'Synthetic'
+  book.uuid = 'synthetic-{}'.format(n)
+  book.push_author('Robert', 'Musil')
+  for i in range(n):
+    book.push_chapter('Kapitel {}'.format(i), [ synthetic_div(i) ])
+  book.write_mimetype()
+  book.write_css()
+  book.write_container()
+  book.write_opf()
+  book.write_ncx()
+  return book
+
+
+class Runner(object):
+
+  def __init__(self, args):
+    self.args = args
+    self.results = {}
+    self.filter = re.compile(args.filter) if args.filter else None
+
+  # setup() is called before each run and not measured, its result
+  # is passed to fn()
+  def run(self, name, fn, setup=None):
+    if self.filter and not self.filter.search(name):
+      return
+    times = []
+    for r in range(self.args.repeat):
+      state = setup() if setup else None
+      start = time.perf_counter()
+      fn(state)
+      times.append(time.perf_counter() - start)
+    self.results[name] = { 'min': min(times),
+        'median': statistics.median(times), 'runs': len(times) }
+    print('{:<36} {:>10.3f} ms {:>10.3f} ms'.format(name,
+      min(times) * 1000, statistics.median(times) * 1000))
+
+
+def run_all(runner, sizes, path):
+  dmoe_1 = load('test/in/dmoe_1.html')
+  dmoe_2 = load('test/in/dmoe_2.html')
+  book = epub.Book(path)
+  book.title = 'dmoe'
+  gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml',
+      book, test.gb_de.Args())
+
+  runner.run('chapter_urls_from_string',
+      lambda s: gb.chapter_urls_from_string(dmoe_1, 'utf-8'))
+  runner.run('parse_html', lambda s: gb_de.parse_html(dmoe_2, 'utf-8'))
+  runner.run('parse_regions',
+      lambda s: gb_de.parse_regions(dmoe_2, gb.chapter_regions, 'utf-8'))
+  root = lxml.html.fromstring(dmoe_1)
+  first = gb.chapter_path(root)[0]
+  def no_authors():
+    gb.book.authors = []
+  runner.run('gb_de.set_meta_data',
+      lambda s: gb.set_meta_data(root, first), no_authors)
+  def fresh_book():
+    gb.book.chapters = []
+  runner.run('gb_de.push_chapter',
+      lambda s: gb.push_chapter(dmoe_2, 2, 'utf-8'), fresh_book)
+  div = lxml.html.fromstring(dmoe_2).xpath('//div[@id="gutenb"]')[0]
+  def copy_div():
+    book.chapters = []
+    return copy.deepcopy(div)
+  runner.run('epub.push_chapter',
+      lambda d: book.push_chapter('Kapitel', [ d ]), copy_div)
+
+  for n in sizes:
+    p = '{}/{}'.format(path, n)
+    b = synthetic_book(p, n)
+    runner.run('write_opf[{}]'.format(n), lambda s: b.write_opf())
+    runner.run('write_ncx[{}]'.format(n), lambda s: b.write_ncx())
+    runner.run('write_epub[{}]'.format(n), lambda s: b.write_epub())
+    shutil.rmtree(p)
+
+
+def compare(results, baseline, threshold):
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    old = baseline[name]['min']
+    new = results[name]['min']
+    change = (new - old) / old if old else 0.0
+    flag = ''
+    if change > threshold:
+      flag = 'REGRESSION'
+      regressions.append(name)
+    print('{:<36} {:>+8.1%} {}'.format(name, change, flag))
+  return regressions
+
+
+def main():
+  args = parser.parse_args()
+  logging.getLogger('').setLevel(logging.WARNING)
+  sizes = [ int(x) for x in args.sizes.split(',') ]
+  runner = Runner(args)
+  path = tempfile.mkdtemp()
+  try:
+    run_all(runner, sizes, path)
+  finally:
+    shutil.rmtree(path)
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(runner.results, f, indent=1, sort_keys=True)
+  if args.compare:
+    with open(args.compare, 'r') as f:
+      baseline = json.load(f)
+    if compare(runner.results, baseline, args.threshold):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
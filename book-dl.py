@@ -6,23 +6,123 @@ import logging
 import argparse
 import sys
 import re
+import json
+import tracemalloc
+import multiprocessing
+import os
 
-import gb_de
-import epub
+import registry
 
 user_agent = 'Mozilla/5.0 (Android; Mobile; rv:30.0) Gecko/30.0 Firefox/30.0' 
 
 
 parser = argparse.ArgumentParser(description='Download books.')
-parser.add_argument('url', nargs='+', help = 'URL to download'
+parser.add_argument('url', nargs='*', help = 'URL to download'
                     )
-parser.add_argument('--out', help = 'Output directory',
-                    required = True)
+parser.add_argument('--batch', metavar='FILE',
+    help='read further URLs from FILE (- for stdin), one per line, '
+    'and build the books in parallel processes')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+    help='number of processes in batch mode, or of concurrently built '
+    'books in daemon mode (default: number of CPUs)')
+parser.add_argument('--daemon', metavar='SOCKET',
+    help='run as daemon that accepts jobs on the Unix socket SOCKET')
+parser.add_argument('--spool', metavar='DIR',
+    help='daemon mode: also build the jobs of DIR/*.job files (JSON)')
+parser.add_argument('--submit', metavar='SOCKET',
+    help='build the books by the daemon listening on SOCKET')
+parser.add_argument('--no-wait', action='store_true',
+    help='with --submit: print the job ids instead of waiting for the books')
+parser.add_argument('--jobs-status', metavar='SOCKET',
+    help='list the jobs of the daemon listening on SOCKET')
+parser.add_argument('--out', help = 'Output directory (required, '
+    'except for --jobs-status)')
 parser.add_argument('--name', help = 'epub base name')
-parser.add_argument('--wait', help='wait rate',
+parser.add_argument('--wait', help='mean wait time between requests (seconds)',
                     #default=0.1,
                     default=1.1,
                     type=float)
+parser.add_argument('--rate', type=float,
+    help='maximal number of requests per second and host (default: 1/wait)')
+parser.add_argument('--adaptive', action='store_true',
+    help='start at --rate and adapt rate and concurrency per host to the '
+    'server\'s latency and throttling responses (threads engine)')
+parser.add_argument('--max-rate', type=float,
+    help='upper bound of the adaptive rate (default: 4 * rate)')
+parser.add_argument('--retries', type=int, default=5,
+    help='number of retries of failed or throttled requests per book')
+parser.add_argument('--backoff', type=float, default=1.0,
+    help='base of the jittered exponential backoff between retries '
+    '(seconds)')
+parser.add_argument('--engine', default='threads',
+    choices=['threads', 'asyncio'],
+    help='fetch pages with a pool of threads (per book) or with '
+    'asyncio (all books in one event loop, default: threads)')
+parser.add_argument('--jobs', type=int, default=4,
+    help='number of chapters fetched in parallel (asyncio: connections '
+    'per host)')
+parser.add_argument('--pool-size', type=int,
+    help='number of keep-alive connections per host (default: jobs)')
+parser.add_argument('--connect-timeout', type=float, default=10.0,
+    help='connect timeout in seconds')
+parser.add_argument('--read-timeout', type=float, default=60.0,
+    help='read timeout in seconds')
+parser.add_argument('--compression', default='gzip, deflate',
+    help='accepted content encodings, e.g. identity to disable compression')
+parser.add_argument('--conn-stats', action='store_true',
+    help='report requests and new connections per host at the end')
+parser.add_argument('--cache',
+    help='directory of the on-disk page cache (default: no cache)')
+parser.add_argument('--cache-size', type=float, default=512,
+    help='cache size limit in MiB, least recently used pages are evicted')
+parser.add_argument('--cache-ttl', type=float, default=24*3600,
+    help='seconds a cached page is used without revalidation')
+parser.add_argument('--parse-workers', type=int, default=0,
+    help='number of processes that parse and clean chapters while further '
+    'pages are fetched (default: 0, i.e. parse in the building thread)')
+parser.add_argument('--queue-depth', type=int, default=8,
+    help='capacity of the queues between the fetch, parse and assemble '
+    'stages of a book')
+parser.add_argument('--chapter-cache', metavar='DIR',
+    help='directory of the on-disk cache of cleaned chapters, keyed by '
+    'page content and extraction rules (default: no cache)')
+parser.add_argument('--chapter-cache-size', type=float, default=256,
+    help='chapter cache size limit in MiB')
+parser.add_argument('--cache-stats', action='store_true',
+    help='print entries and size of --cache and --chapter-cache and exit')
+parser.add_argument('--offline', action='store_true',
+    help='only use cached pages, never access the network')
+parser.add_argument('--resume', action='store_true',
+    help='only download chapters missing from the staging directory')
+parser.add_argument('--incremental', action='store_true',
+    help='only process chapters whose source changed since the previous '
+    'build and copy the others from the previous epub')
+parser.add_argument('--build', default='staged',
+    choices=['staged', 'stream', 'memory'],
+    help='write chapters to a staging directory (default), directly '
+    'into the epub file or into an in-memory epub')
+parser.add_argument('--progressive', type=int, default=0, metavar='N',
+    help='write a readable epub once N chapters are there and refresh it '
+    'while further chapters arrive (requires --build staged)')
+parser.add_argument('--progressive-interval', type=float, default=10.0,
+    help='minimal number of seconds between refreshes of a progressive '
+    'epub')
+parser.add_argument('--split-size', type=float, default=256, metavar='KIB',
+    help='split chapters larger than KIB KiB into several files, which '
+    'e-readers render faster (0 disables, default: 256)')
+parser.add_argument('--split-elements', type=int, default=0, metavar='N',
+    help='split chapters with more than N elements into several files '
+    '(default: 0, i.e. disabled)')
+parser.add_argument('--compact', action='store_true',
+    help='strip insignificant whitespace and empty elements from chapters, '
+    'move inline styles into the stylesheet and report the bytes saved')
+parser.add_argument('--compress-level', type=int, default=6,
+    choices=range(0, 10), metavar='0-9',
+    help='deflate level of the epub members, 0 stores them (default: 6)')
+parser.add_argument('--stats', metavar='FILE',
+    help='write per-book timing and resource statistics as JSON')
+parser.add_argument('--trace-malloc', action='store_true',
+    help='include the top allocators (tracemalloc) in the statistics')
 parser.add_argument('--agent', help='user agent',
                     default = user_agent)
 parser.add_argument('--title', help='override book title')
@@ -30,19 +130,20 @@ parser.add_argument('--author', help='override author',
                     default=[], action='append')
 parser.add_argument('--uuid', help='set uuid, e.g. ISBN')
 parser.add_argument('--style', help='disable auto-detect of source and explicitly specify one (e.g. gb)')
+parser.add_argument('--sources', metavar='FILE',
+    help='register further sources from FILE (JSON list of objects with '
+    'name, module, cls, hosts and patterns)')
 parser.add_argument('--level',
     help='set log level (e.g. debug, warning, ...)', default = 'info')
+parser.add_argument('--stream', action='store_true',
+    help='parse and write each chapter while it is downloaded, one '
+    'chapter after another - for books that are one huge page')
+parser.add_argument('--no-images', action='store_true',
+    help='do not download the images of chapters')
 parser.add_argument('--dump', action='store_true',
     help='dump requested pages for debugging purposes')
 
 
-sources = [ ('gb', gb_de.GB_DE, [ re.compile('gutenberg\\.spiegel\\.de') ] ) ]
-
-sources_map = {}
-
-for s in sources:
-  sources_map[s[0]] = (s[1], s[2])
-
 name_exp = re.compile('.+/([^/]+)\\.xml')
 
 def base_name(url):
@@ -59,29 +160,105 @@ if __name__ == '__main__':
   try:
     logging.debug('Parsing arguments ...')
     args = parser.parse_args()
-    if not args.url:
-      raise ValueError('no url given')
+    if not args.out and not args.jobs_status and not args.cache_stats:
+      parser.error('the following arguments are required: --out')
+    if args.progressive and args.build != 'staged':
+      parser.error('--progressive requires --build staged')
+    if args.stream and args.engine == 'asyncio':
+      parser.error('--stream requires --engine threads')
     level = getattr(logging, args.level.upper())
     logging.getLogger('').setLevel(level)
-    for url in args.url:
-      if args.style:
-        c = sources_map[args.style]
-      else:
-        for s in sources:
-          for e in s[2]:
-            if e.search(url):
-              c = s[1]
-              break
-      book = epub.Book(args.out)
+    # imported here, such that e.g. --help doesn't pay for lxml and
+    # requests
+    import cache
+    import job
+    import daemon
+    import transport
+    import ratelimit
+    if args.sources:
+      registry.registry.load(args.sources)
+    if args.daemon:
+      daemon.Daemon(args,
+          lambda url: registry.registry.resolve(url, args.style),
+          base_name).serve(args.daemon, args.spool)
+      sys.exit(0)
+    if args.cache_stats:
+      for name, path, size in [ ('page cache', args.cache, args.cache_size),
+          ('chapter cache', args.chapter_cache, args.chapter_cache_size) ]:
+        if path:
+          print(cache.format_stats(name,
+            cache.Store(path, int(size * 1024 * 1024)).stats()))
+      sys.exit(0)
+    if args.jobs_status:
+      print(daemon.table(daemon.request(args.jobs_status, { 'op': 'status' })))
+      sys.exit(0)
+    urls = list(args.url)
+    if args.batch == '-':
+      urls += job.read_urls(sys.stdin)
+    elif args.batch:
+      with open(args.batch, 'r') as f:
+        urls += job.read_urls(f)
+    if not urls:
+      raise ValueError('no url given')
+    if args.submit:
+      d = daemon.submit_options(args, parser.get_default)
+      d['out'] = os.path.abspath(args.out)
+      d['op'] = 'submit'
       if args.name:
-        book.epub_base_name = args.name
+        d['name'] = args.name
+      ids = []
+      for url in urls:
+        d['url'] = url
+        ids.append(daemon.request(args.submit, d))
+      if args.no_wait:
+        print('\n'.join(str(i) for i in ids))
+        sys.exit(0)
+      results = [ daemon.request(args.submit, { 'op': 'wait', 'id': i })
+          for i in ids ]
+      logging.info('Summary:\n{}'.format(job.summary(results)))
+      sys.exit(0 if all(r['ok'] for r in results) else 1)
+    if args.trace_malloc:
+      tracemalloc.start()
+    jobs = []
+    for url in urls:
+      c = registry.registry.resolve(url, args.style)
+      if args.name:
+        name = args.name
+      else:
+        name = base_name(url)
+      jobs.append((c, url, name))
+    names = job.unique_names([ j[2] for j in jobs ])
+    jobs = [ (j[0], j[1], name) for j, name in zip(jobs, names) ]
+    reports = {}
+    failed = False
+    if args.batch or args.engine == 'asyncio':
+      if args.engine == 'asyncio':
+        results = job.run_async(jobs, args)
       else:
-        book.epub_base_name = base_name(url)
-      o = c(url, book, args)
-      o.download()
-      logging.info('Book written to: {}/{}.epub'.format(args.out,
-        book.epub_base_name))
-      book.write()
+        with multiprocessing.Manager() as manager:
+          limiter = ratelimit.SharedHostLimiter(manager,
+              transport.request_rate(args))
+          results = job.run_batch(jobs, args, limiter)
+      logging.info('Batch summary:\n{}'.format(job.summary(results)))
+      for r in results:
+        if r['stats']:
+          reports[r['name']] = r['stats']
+      failed = not all(r['ok'] for r in results)
+    else:
+      tp = transport.Transport(args)
+      for c, url, name in jobs:
+        book = job.build_book(c, url, name, args, tp)
+        if args.stats:
+          reports[name] = (book.stats.report(), book.stats.summary())
+      tp.close()
+    if args.stats:
+      for name in reports:
+        logging.info('Statistics of {}:\n{}'.format(name, reports[name][1]))
+      with open(args.stats, 'w') as f:
+        json.dump(dict((k, v[0]) for k, v in reports.items()), f,
+            indent=1, sort_keys=True)
+    if failed:
+      sys.exit(1)
   except Exception as e:
     raise
     logging.error('Error: {}'.format(e))
@@ -0,0 +1,234 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+import requests.structures
+
+
+# On-disk key/value store with a size cap. Each entry is a body
+# file plus a small JSON file with metadata. The modification time
+# of the body doubles as the last access stamp for LRU eviction.
+class Store(object):
+
+  def __init__(self, path, max_bytes):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.index = {}
+    self.size = 0
+    os.makedirs(self.path, exist_ok=True)
+    self.scan()
+
+  def scan(self):
+    for d in os.scandir(self.path):
+      if not d.is_dir():
+        continue
+      for e in os.scandir(d.path):
+        if e.name.endswith('.body'):
+          st = e.stat()
+          self.index[e.name[:-5]] = (st.st_size, st.st_mtime)
+          self.size += st.st_size
+
+  def key(self, s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+  def filename(self, k, ext):
+    return '{}/{}/{}.{}'.format(self.path, k[:2], k, ext)
+
+  def get(self, s):
+    k = self.key(s)
+    with self.lock:
+      if k not in self.index:
+        return None
+      try:
+        with open(self.filename(k, 'json'), 'r') as f:
+          meta = json.load(f)
+        with open(self.filename(k, 'body'), 'rb') as f:
+          body = f.read()
+      except (OSError, ValueError):
+        self.drop(k)
+        return None
+      self.touch(k)
+    return (meta, body)
+
+  def put(self, s, meta, body):
+    k = self.key(s)
+    with self.lock:
+      if k in self.index:
+        self.drop(k)
+      os.makedirs('{}/{}'.format(self.path, k[:2]), exist_ok=True)
+      self.write(self.filename(k, 'json'),
+          json.dumps(meta).encode('utf-8'))
+      self.write(self.filename(k, 'body'), body)
+      self.index[k] = (len(body), time.time())
+      self.size += len(body)
+      self.evict()
+
+  def update(self, s, meta):
+    k = self.key(s)
+    with self.lock:
+      if k in self.index:
+        self.write(self.filename(k, 'json'),
+            json.dumps(meta).encode('utf-8'))
+        self.touch(k)
+
+  def write(self, filename, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.replace(tmp, filename)
+
+  def touch(self, k):
+    now = time.time()
+    try:
+      os.utime(self.filename(k, 'body'), (now, now))
+    except OSError:
+      pass
+    self.index[k] = (self.index[k][0], now)
+
+  def drop(self, k):
+    size = self.index.pop(k)[0]
+    self.size -= size
+    for ext in [ 'body', 'json' ]:
+      try:
+        os.remove(self.filename(k, ext))
+      except OSError:
+        pass
+
+  def stats(self):
+    with self.lock:
+      stamps = [ v[1] for v in self.index.values() ]
+      return { 'path': self.path, 'entries': len(self.index),
+          'bytes': self.size, 'max_bytes': self.max_bytes,
+          'oldest': min(stamps) if stamps else None,
+          'newest': max(stamps) if stamps else None }
+
+  def evict(self):
+    if self.size <= self.max_bytes:
+      return
+    for k in sorted(self.index, key=lambda k: self.index[k][1]):
+      if self.size <= self.max_bytes:
+        break
+      logging.debug('Evicting cache entry {}'.format(k))
+      self.drop(k)
+
+
+class HttpCache(object):
+
+  def __init__(self, path, max_bytes, ttl):
+    self.store = Store(path, max_bytes)
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.counts = { 'hit': 0, 'revalidated': 0, 'miss': 0 }
+
+  def count(self, key):
+    with self.lock:
+      self.counts[key] += 1
+
+  def lookup(self, url):
+    return self.store.get(url)
+
+  def fresh(self, entry):
+    return time.time() - entry[0]['stamp'] < self.ttl
+
+  def conditional_headers(self, entry):
+    h = {}
+    if entry[0]['etag']:
+      h['If-None-Match'] = entry[0]['etag']
+    if entry[0]['last_modified']:
+      h['If-Modified-Since'] = entry[0]['last_modified']
+    return h
+
+  def put(self, url, page):
+    meta = { 'url': url, 'stamp': time.time(),
+        'etag': page.headers.get('ETag'),
+        'last_modified': page.headers.get('Last-Modified'),
+        'content_type': page.headers.get('Content-Type'),
+        'encoding': page.encoding }
+    self.store.put(url, meta, page.content)
+
+  def revalidated(self, url, entry):
+    entry[0]['stamp'] = time.time()
+    self.store.update(url, entry[0])
+
+  def response(self, url, entry):
+    meta, body = entry
+    r = requests.Response()
+    r.status_code = 200
+    r.url = url
+    r._content = body
+    # such that iter_content() yields the body
+    r._content_consumed = True
+    r.headers = requests.structures.CaseInsensitiveDict()
+    if meta['content_type']:
+      r.headers['Content-Type'] = meta['content_type']
+    r.encoding = meta['encoding']
+    r.from_cache = True
+    return r
+
+  def log(self):
+    logging.info('cache: {} hits, {} revalidated, {} misses'.format(
+      self.counts['hit'], self.counts['revalidated'], self.counts['miss']))
+
+
+
+# Cleaned and serialized chapters. The key is the digest of the
+# source page plus everything else the chapter file depends on (the
+# source's rules and code version, the chapter template, ...), thus
+# changing any of it just misses.
+class ChapterCache(object):
+
+  def __init__(self, path, max_bytes):
+    self.store = Store(path, max_bytes)
+    self.lock = threading.Lock()
+    self.counts = { 'hit': 0, 'miss': 0 }
+
+  def key(self, digest, parts):
+    return '{}:{}'.format(digest, json.dumps(parts, sort_keys=True))
+
+  def has(self, key):
+    return self.store.key(key) in self.store.index
+
+  # returns (meta, data) or None
+  def get(self, key):
+    r = self.store.get(key)
+    with self.lock:
+      self.counts['hit' if r else 'miss'] += 1
+    return r
+
+  def put(self, key, meta, data):
+    self.store.put(key, meta, data)
+
+
+chapter_caches = {}
+chapter_caches_lock = threading.Lock()
+
+# one instance per directory and process, shared by its books
+def chapter_cache(path, max_bytes):
+  with chapter_caches_lock:
+    c = chapter_caches.get(path)
+    if not c:
+      c = ChapterCache(path, max_bytes)
+      chapter_caches[path] = c
+    return c
+
+
+def format_stats(name, d):
+  l = [ '{}: {}'.format(name, d['path']),
+      '  entries: {}'.format(d['entries']),
+      '  size: {:.1f} of {:.1f} MiB'.format(d['bytes'] / 1024 / 1024,
+        d['max_bytes'] / 1024 / 1024) ]
+  if d['entries']:
+    l.append('  oldest access: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S',
+      time.localtime(d['oldest']))))
+    l.append('  newest access: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S',
+      time.localtime(d['newest']))))
+  return '\n'.join(l)
@@ -0,0 +1,155 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+def book_meta(book):
+  return { 'title': book.title, 'uuid': book.uuid,
+      'authors': [ list(a) for a in book.authors ] }
+
+def set_book_meta(book, meta):
+  book.title = meta['title']
+  book.uuid = meta['uuid']
+  book.authors = [ tuple(a) for a in meta['authors'] ]
+
+
+# Records which chapters of a book are already in the staging
+# directory, such that an interrupted download can be resumed.
+#
+# The file is a journal of JSON lines: a snapshot of the whole
+# manifest, followed by one line per finished chapter. Thus, a
+# chapter costs an append instead of rewriting the manifest. load()
+# replays the journal and compacts it into a new snapshot.
+class Manifest(object):
+
+  def __init__(self, filename, url):
+    self.filename = filename
+    self.url = url
+    self.lock = threading.Lock()
+    self.meta = None
+    # the metadata options (e.g. --title) the metadata was set with
+    self.overrides = None
+    self.chapters = {}
+    # (extension, sha1) of the staged images, in book order
+    self.images = []
+    # whether the file starts with a snapshot of this build
+    self.saved = False
+
+  def load(self):
+    try:
+      with open(self.filename, 'r') as f:
+        lines = f.readlines()
+      d = json.loads(lines[0])
+    except (OSError, ValueError, IndexError) as e:
+      logging.info('No usable checkpoint manifest: {}'.format(e))
+      return False
+    if d['url'] != self.url:
+      logging.warning('Ignoring checkpoint manifest of {}'.format(d['url']))
+      return False
+    self.meta = d['meta']
+    self.overrides = d.get('overrides')
+    self.chapters = dict((int(k), v) for k, v in d['chapters'].items())
+    self.images = [ tuple(x) for x in d.get('images', []) ]
+    for line in lines[1:]:
+      try:
+        self.replay(json.loads(line))
+      except ValueError:
+        # a line that was cut short by an interruption
+        break
+    self.save()
+    return True
+
+  def replay(self, d):
+    if 'meta' in d:
+      self.meta = d['meta']
+      self.overrides = d.get('overrides')
+    if 'chapter' in d:
+      self.chapters[d['chapter']] = d['entry']
+    if 'images' in d:
+      self.images = self.images[:d['offset']] + [ tuple(x)
+          for x in d['images'] ]
+
+  def save(self):
+    d = { 'url': self.url, 'meta': self.meta, 'overrides': self.overrides,
+        'chapters': dict((str(k), v) for k, v in self.chapters.items()),
+        'images': [ list(x) for x in self.images ] }
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+    with os.fdopen(fd, 'w') as f:
+      json.dump(d, f, sort_keys=True)
+      f.write('\n')
+    os.replace(tmp, self.filename)
+    self.saved = True
+
+  def append(self, d):
+    if not self.saved:
+      self.save()
+    with open(self.filename, 'a') as f:
+      f.write(json.dumps(d, sort_keys=True) + '\n')
+
+  def set_meta(self, book, overrides=None):
+    with self.lock:
+      self.meta = book_meta(book)
+      self.overrides = overrides
+      self.append({ 'meta': self.meta, 'overrides': overrides })
+
+  def restore_meta(self, book):
+    set_book_meta(book, self.meta)
+
+  # digest: sha1 of the source page, out_digest: of the chapter
+  # file(s), images: number of images the chapter references,
+  # book_images: the images of the book so far, parts: number of
+  # files of the chapter, styles: the hoisted styles it uses
+  def done(self, i, url, title, digest, out_digest=None, images=0,
+      book_images=None, parts=1, styles=None):
+    with self.lock:
+      entry = { 'url': url, 'title': title, 'sha1': digest,
+          'out_sha1': out_digest, 'images': images, 'parts': parts }
+      if styles:
+        entry['styles'] = styles
+      self.chapters[i] = entry
+      d = { 'chapter': i, 'entry': entry }
+      if book_images is not None:
+        # only the images that are new since the last line
+        book_images = [ tuple(x) for x in book_images ]
+        n = 0
+        while (n < len(self.images) and n < len(book_images)
+            and self.images[n] == book_images[n]):
+          n += 1
+        if n < len(self.images) or n < len(book_images):
+          d['offset'] = n
+          d['images'] = [ list(x) for x in book_images[n:] ]
+        self.images = book_images
+      self.append(d)
+
+  # drops chapters beyond a (shorter) TOC
+  def truncate(self, n):
+    l = [ i for i in self.chapters if i > n ]
+    for i in l:
+      del self.chapters[i]
+    if l:
+      self.save()
+
+  # Chapters (1-based) that can be reused for the given TOC: the
+  # URL at that position still matches and the file is staged.
+  # Chapters with images are only reused when all images are staged
+  # as well - which are then registered with the book.
+  def completed(self, urls, book):
+    images = all(book.has_image(i, ext)
+        for i, (ext, digest) in enumerate(self.images))
+    if images:
+      book.restore_images(self.images)
+    r = {}
+    for i, url in enumerate(urls, 1):
+      c = self.chapters.get(i)
+      if (c and c['url'] == url and book.has_chapter(i-1, c.get('parts', 1))
+          and (images or not c.get('images'))):
+        r[i] = c
+    if 1 in r and not self.meta:
+      del r[1]
+    return r
+
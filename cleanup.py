@@ -0,0 +1,225 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Rule-based cleanup of chapter trees.
+#
+# A source declares a list of rules, which are compiled once into an
+# Engine. Engine.apply() then visits every element below the root
+# exactly once, no matter how many rules there are. Elements are
+# visited in reverse document order, i.e. children before their
+# parents - thus, a rule that checks for empty elements sees the
+# result of the rules applied to the children.
+
+import hashlib
+import json
+import re
+
+
+class Rule(object):
+
+  # tags: element names the rule is restricted to, None for all
+  def __init__(self, tags=None):
+    self.tags = tags
+
+  # returns False if the element was removed from the tree
+  def apply(self, e):
+    return True
+
+
+class StripAttributes(Rule):
+
+  def __init__(self, attributes, tags=None):
+    super().__init__(tags)
+    self.attributes = attributes
+
+  def apply(self, e):
+    for a in self.attributes:
+      e.attrib.pop(a, None)
+    return True
+
+
+# Removes the element but keeps its content and its tail - in
+# contrast to getparent().remove(e), which drops the tail as well.
+class Unwrap(Rule):
+
+  def __init__(self, tags, unless=None):
+    super().__init__(tags)
+    self.unless = unless
+
+  def apply(self, e):
+    if self.unless and self.unless in e.attrib:
+      return True
+    e.drop_tag()
+    return False
+
+
+def normalized_text(e):
+  s = (e.text or '') + ''.join(c.tail or '' for c in e)
+  return s.strip(' \t\r\n')
+
+
+# Removes elements without child elements and with only whitespace
+# (like the XPath predicate [not(*)][not(normalize-space())]).
+class RemoveEmpty(Rule):
+
+  def apply(self, e):
+    for c in e:
+      if isinstance(c.tag, str):
+        return True
+    if normalized_text(e):
+      return True
+    e.getparent().remove(e)
+    return False
+
+
+# Compaction rules, e.g. for epub.Book - unlike the rules above, they
+# work on lxml.etree elements, too.
+
+# elements whose whitespace-only text next to block children is
+# insignificant
+block_tags = frozenset([ 'address', 'blockquote', 'body', 'center', 'dd',
+  'div', 'dl', 'dt', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol',
+  'p', 'pre', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul' ])
+
+whitespace_exp = re.compile('[ \t\r\n]+')
+
+def is_block(e):
+  return e is None or e.tag in block_tags
+
+def in_pre(e):
+  return any(a.tag == 'pre' for a in e.iterancestors())
+
+# Collapses runs of whitespace (not &nbsp;) into one blank and drops
+# whitespace-only text before or after block elements in a block
+# element - except in pre elements.
+class StripWhitespace(Rule):
+
+  def strip(self, s, drop):
+    if not s:
+      return s
+    s = whitespace_exp.sub(' ', s)
+    if drop and s == ' ':
+      return None
+    return s
+
+  def apply(self, e):
+    if in_pre(e):
+      return True
+    block = e.tag in block_tags
+    if e.tag != 'pre':
+      e.text = self.strip(e.text, block and (not len(e) or is_block(e[0])))
+    parent = e.getparent()
+    e.tail = self.strip(e.tail, block and parent is not None
+        and parent.tag in block_tags and is_block(e.getnext()))
+    return True
+
+
+# 'prop: value; ...' - declarations without colon are dropped
+def normalized_style(s):
+  l = []
+  for d in s.split(';'):
+    prop, colon, value = d.partition(':')
+    if colon and prop.strip() and value.strip():
+      l.append('{}: {}'.format(prop.strip().lower(), ' '.join(value.split())))
+  return '; '.join(l)
+
+# The (normalized) styles that occur more than once below root. seen
+# collects the styles over several calls, the ones seen before count
+# as repeated.
+def repeated_styles(root, seen=None):
+  seen = set() if seen is None else seen
+  r = set()
+  for e in root.iter():
+    style = e.get('style')
+    if style is not None:
+      style = normalized_style(style)
+      if style in seen:
+        r.add(style)
+      seen.add(style)
+  return r
+
+
+# Replaces style attributes with classes, classes maps declarations
+# to class names and is extended with new ones. With repeated (see
+# repeated_styles()), other styles aren't hoisted, unless they are in
+# classes already - a class and its rule cost more than a style that
+# is used once. used collects the hoisted declarations (and their
+# classes), e.g. of one chapter when classes are shared by a book.
+class HoistStyle(Rule):
+
+  def __init__(self, classes, repeated=None, used=None, tags=None):
+    super().__init__(tags)
+    self.classes = classes
+    self.repeated = repeated
+    self.used = used
+
+  def apply(self, e):
+    style = e.attrib.pop('style', None)
+    if style is None:
+      return True
+    style = normalized_style(style)
+    if not style:
+      return True
+    c = self.classes.get(style)
+    if not c:
+      if self.repeated is not None and style not in self.repeated:
+        e.set('style', style)
+        return True
+      c = 'st' + hashlib.sha1(style.encode('utf-8')).hexdigest()[:8]
+      self.classes[style] = c
+    if self.used is not None:
+      self.used[style] = c
+    e.set('class', ' '.join((e.get('class') or '').split() + [ c ]))
+    return True
+
+
+# Removes elements without attributes, child elements and text,
+# keeping their tail - and the whitespace of inline elements.
+class DropEmpty(Rule):
+
+  def apply(self, e):
+    parent = e.getparent()
+    if (parent is None or len(e) or e.attrib
+        or (e.text or '').strip(' \t\r\n')):
+      return True
+    text = (e.text if e.tag not in block_tags else None) or ''
+    text += e.tail or ''
+    if text:
+      prev = e.getprevious()
+      if prev is not None:
+        prev.tail = (prev.tail or '') + text
+      else:
+        parent.text = (parent.text or '') + text
+    parent.remove(e)
+    return False
+
+
+class Engine(object):
+
+  def __init__(self, rules):
+    self.rules = rules
+    self.generic = [ r for r in rules if r.tags is None ]
+    self.by_tag = {}
+    for r in rules:
+      for tag in (r.tags or []):
+        self.by_tag.setdefault(tag, []).append(r)
+    # keep the declaration order for tags with generic and specific rules
+    for tag in self.by_tag:
+      self.by_tag[tag] = [ r for r in rules if r.tags is None or tag in r.tags ]
+
+  # identifies the rules (and their parameters), e.g. to key cached
+  # results of apply()
+  def fingerprint(self):
+    return hashlib.sha1(json.dumps([ [ type(r).__name__, vars(r) ]
+      for r in self.rules ], sort_keys=True).encode('utf-8')).hexdigest()
+
+  def apply(self, root):
+    for e in reversed(list(root.iterdescendants())):
+      tag = e.tag
+      # comments and processing instructions
+      if not isinstance(tag, str):
+        continue
+      for r in self.by_tag.get(tag, self.generic):
+        if not r.apply(e):
+          break
+
@@ -0,0 +1,264 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Long-running build service and its client.
+#
+# The daemon accepts jobs over a Unix socket and, optionally, from a
+# spool directory. Books are built concurrently by a pool of threads
+# that share one Transport, thus connection pools, the page cache and
+# the image memo stay warm across jobs.
+#
+# Protocol: the client sends one JSON object per line, e.g.
+# {"op": "submit", "url": ...}, and gets one line back - either
+# {"result": ...} or {"error": "..."}.
+
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+
+import job
+import transport
+
+
+# job attributes a client may set, besides url and name
+job_options = [ 'out', 'title', 'author', 'uuid', 'build', 'compress_level',
+    'resume', 'incremental', 'no_images', 'progressive', 'split_size',
+    'split_elements', 'compact' ]
+
+# The job options a client submits: only the ones that differ from
+# their default (e.g. parser.get_default), thus the daemon's own
+# settings apply to the rest.
+def submit_options(args, default):
+  return dict((k, getattr(args, k)) for k in job_options
+      if getattr(args, k) != default(k))
+
+
+# number of finished jobs whose status is kept
+history = 1000
+
+
+def write_json(filename, d):
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+  with os.fdopen(fd, 'w') as f:
+    json.dump(d, f, indent=1, sort_keys=True)
+  os.replace(tmp, filename)
+
+
+class Job(object):
+
+  def __init__(self, id, cls, url, name, args):
+    self.id = id
+    self.cls = cls
+    self.url = url
+    self.name = name
+    self.args = args
+    self.state = 'queued'
+    self.book = None
+    self.result = None
+    self.done = threading.Event()
+
+  def progress(self, book):
+    self.book = book
+
+  def run(self, tp):
+    self.state = 'running'
+    try:
+      self.result = job.run_job(self.cls, self.url, self.name, self.args, tp,
+          self.progress)
+      self.state = 'done' if self.result['ok'] else 'failed'
+    finally:
+      self.done.set()
+
+  def status(self):
+    d = { 'id': self.id, 'url': self.url, 'name': self.name,
+        'state': self.state, 'chapters': 0, 'readable': 0 }
+    if self.book:
+      d['chapters'] = len(self.book.chapters)
+      # chapters in the epub file so far, with --progressive
+      d['readable'] = self.book.snapshot_chapters
+    if self.result:
+      d.update(self.result)
+    return d
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    for line in self.rfile:
+      try:
+        r = { 'result': self.server.service.request(
+          json.loads(line.decode('utf-8'))) }
+      except Exception as e:
+        r = { 'error': '{}: {}'.format(type(e).__name__, e) }
+      self.wfile.write(json.dumps(r).encode('utf-8') + b'\n')
+      self.wfile.flush()
+      # only after the reply is out
+      if self.server.service.stopping.is_set():
+        threading.Thread(target=self.server.service.stop).start()
+        return
+
+
+# resolve maps an URL to its source class, default_name to an epub
+# base name
+class Daemon(object):
+
+  def __init__(self, args, resolve, default_name):
+    self.args = args
+    self.resolve = resolve
+    self.default_name = default_name
+    self.transport = transport.Transport(args)
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, args.workers))
+    self.jobs = {}
+    self.next_id = 1
+    self.lock = threading.Lock()
+    self.server = None
+    self.stopping = threading.Event()
+
+  def submit(self, d):
+    url = d['url']
+    cls = self.resolve(url)
+    if not cls:
+      raise ValueError('no source for {}'.format(url))
+    args = copy.copy(self.args)
+    for k in job_options:
+      if k in d:
+        setattr(args, k, d[k])
+    with self.lock:
+      # concurrent books must not share a staging directory
+      active = set(j.name for j in self.jobs.values() if not j.done.is_set())
+      name = base = d.get('name') or self.default_name(url)
+      n = 1
+      while name in active:
+        n += 1
+        name = '{}_{}'.format(base, n)
+      j = Job(self.next_id, cls, url, name, args)
+      self.next_id += 1
+      self.jobs[j.id] = j
+      self.expire()
+    logging.info('Job {}: {} as {}'.format(j.id, url, name))
+    j.future = self.executor.submit(j.run, self.transport)
+    return j
+
+  def expire(self):
+    done = [ i for i, j in self.jobs.items() if j.done.is_set() ]
+    for i in done[:max(0, len(done) - history)]:
+      del self.jobs[i]
+
+  def job(self, id):
+    with self.lock:
+      j = self.jobs.get(id)
+    if not j:
+      raise KeyError('no such job: {}'.format(id))
+    return j
+
+  def request(self, d):
+    op = d.get('op')
+    if op == 'submit':
+      return self.submit(d).id
+    elif op == 'status':
+      if 'id' in d:
+        return self.job(d['id']).status()
+      with self.lock:
+        return [ j.status() for j in self.jobs.values() ]
+    elif op == 'wait':
+      j = self.job(d['id'])
+      j.done.wait(d.get('timeout'))
+      return j.status()
+    elif op == 'shutdown':
+      self.stopping.set()
+      return True
+    raise ValueError('unknown op: {}'.format(op))
+
+  # Claims the *.job files of the spool directory by renaming them,
+  # the job's final status is written to a .status file next to it.
+  def scan_spool(self, spool):
+    for fn in sorted(os.listdir(spool)):
+      if not fn.endswith('.job'):
+        continue
+      path = os.path.join(spool, fn)
+      taken = path + '.taken'
+      try:
+        os.replace(path, taken)
+      except OSError:
+        continue
+      status = path[:-4] + '.status'
+      try:
+        with open(taken, 'r') as f:
+          j = self.submit(json.load(f))
+      except Exception as e:
+        logging.error('Bad spool job {}: {}'.format(fn, e))
+        write_json(status, { 'state': 'failed', 'ok': False,
+          'error': '{}: {}'.format(type(e).__name__, e) })
+        os.remove(taken)
+        continue
+      def finished(f, j=j, status=status, taken=taken):
+        write_json(status, j.status())
+        os.remove(taken)
+      j.future.add_done_callback(finished)
+
+  def poll_spool(self, spool, interval):
+    while not self.stopping.wait(interval):
+      try:
+        self.scan_spool(spool)
+      except OSError as e:
+        logging.error('Scanning spool {} failed: {}'.format(spool, e))
+
+  def serve(self, path, spool=None, interval=1.0):
+    if os.path.exists(path):
+      try:
+        request(path, { 'op': 'status' })
+        raise RuntimeError('A daemon is already listening on {}'.format(path))
+      except OSError:
+        os.unlink(path)
+    self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    self.server.daemon_threads = True
+    self.server.service = self
+    if spool:
+      t = threading.Thread(target=self.poll_spool, args=(spool, interval))
+      t.daemon = True
+      t.start()
+    logging.info('Listening on {}'.format(path))
+    try:
+      self.server.serve_forever()
+    finally:
+      self.server.server_close()
+      os.unlink(path)
+      self.executor.shutdown()
+      self.transport.close()
+
+  def stop(self):
+    self.stopping.set()
+    if self.server:
+      self.server.shutdown()
+
+
+def request(path, d, timeout=None):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    s.settimeout(timeout)
+    s.connect(path)
+    with s.makefile('rwb') as f:
+      f.write(json.dumps(d).encode('utf-8') + b'\n')
+      f.flush()
+      line = f.readline()
+  if not line:
+    raise OSError('No reply from {}'.format(path))
+  r = json.loads(line.decode('utf-8'))
+  if 'error' in r:
+    raise RuntimeError(r['error'])
+  return r['result']
+
+
+def table(statuses):
+  l = [ '{:>6} {:<8} {:>8}  {:<24} {}'.format('job', 'state', 'chapters',
+    'book', 'url / error') ]
+  for s in statuses:
+    l.append('{:>6} {:<8} {:>8}  {:<24} {}'.format(s['id'], s['state'],
+      s['chapters'], s['name'], s.get('error') or s['url']))
+  return '\n'.join(l)
@@ -4,14 +4,75 @@ import lxml
 import lxml.etree
 import lxml.html
 #import logging
+import io
 import os
 import zipfile
+import hashlib
+import concurrent.futures
+import time
+import uuid
+import xml.sax.saxutils
+
+import cleanup
+import zipraw
+import stats
+
+# Modes:
+#   staged - each file is written below archive_path and the zip
+#            file is assembled from the staged files at the end
+#   stream - each file is written directly into the open zip file
+#            (<epub_base_name>.epub.part until write() renames it)
+#   memory - like stream, but the zip file is kept in memory until
+#            write()
+#
+# Progressive books (staged mode only): once progressive chapters
+# are pushed, refresh() writes a readable epub of the chapters so far
+# and replaces it, at most every progressive_interval seconds, while
+# further chapters arrive. Chapters and images of the last snapshot
+# are copied into the next one (and into the final epub) without
+# compressing them again.
+#
+# Splitting: a chapter that exceeds split_size bytes or split_elements
+# elements is written as several files (spine items), at the
+# boundaries of the top-level blocks of its containers - large files
+# render slowly on e-readers. The files of a chapter share one NCX
+# navPoint, the further files are nested below it. Fragment links
+# (href="#id") point to the file their target ends up in.
+#
+# Compaction: chapters are stripped of insignificant whitespace and
+# empty wrapper elements, their inline styles are replaced by classes
+# of the stylesheet, and the other XML files aren't indented. The
+# sizes of the chapters before and after are accounted in the
+# 'compact' phase of the stats.
+
+
+# the targets of fragment links below e
+def fragment_ids(e):
+  for x in e.iter(lxml.etree.Element):
+    if x.get('id'):
+      yield x.get('id')
+    if x.tag == 'a' and x.get('name'):
+      yield x.get('name')
+
+# the target of a fragment link - or None
+def fragment_ref(e):
+  href = e.get('href')
+  if href and href.startswith('#') and len(href) > 1:
+    return href[1:]
+  return None
+
+def escape_attribute(s):
+  return xml.sax.saxutils.escape(s, { '"': '&quot;' }).encode('utf-8')
+
 
 class Book(object):
 
-  def __init__(self, out_path):
+  def __init__(self, out_path, mode = 'staged', archive_name = 'archive'):
+    if mode not in [ 'staged', 'stream', 'memory' ]:
+      raise ValueError('Unknown book mode: {}'.format(mode))
     self.out_path = out_path
-    self.archive_path = self.out_path + '/archive'
+    self.mode = mode
+    self.archive_path = self.out_path + '/' + archive_name
     self.rel_meta_inf_path = 'META-INF'
     self.meta_inf_path = self.archive_path + '/' + self.rel_meta_inf_path
     self.rel_ops_path = 'OPS'
@@ -20,10 +81,52 @@ class Book(object):
     self.chapter_path = self.ops_path + '/' + self.rel_chapter_path
     self.rel_image_path = 'image'
     self.image_path = self.ops_path + '/' + self.rel_image_path
-    for p in [ self.meta_inf_path, self.chapter_path, self.image_path]:
-      os.makedirs(p, exist_ok=True)
+    if self.mode == 'staged':
+      for p in [ self.meta_inf_path, self.chapter_path, self.image_path]:
+        os.makedirs(p, exist_ok=True)
+    self.zip_file = None
+    self.zip_fp = None
+    # 0 stores, 1-9 are deflate levels
+    self.compress_level = 6
+    self.compress_jobs = os.cpu_count() or 1
+    # chapters are written without indentation by default
+    self.pretty_print = False
+    # budgets of a chapter file, 0 disables splitting by that budget
+    self.split_size = 0
+    self.split_elements = 0
+    self.compact = False
+    # class -> declarations of the hoisted inline styles
+    self.styles = {}
+    # the inverse of styles, and the declarations of all inline styles
+    # so far - a style is hoisted once it repeats, in any chapter
+    self.style_classes = {}
+    self.seen_styles = set()
+    self.stats = stats.Stats()
+    # epub of a previous build whose members may be reused
+    self.previous = None
+    self.reused = set()
+    # set if titles, order and metadata are unchanged since the
+    # previous build, then OPF and NCX are copied as well
+    self.reuse_toc = False
+    # 0 disables progressive snapshots
+    self.progressive = 0
+    self.progressive_interval = 10.0
+    # chapters in the last snapshot, when it was written and its
+    # members that can be copied
+    self.snapshot_chapters = 0
+    self.snapshot_time = None
+    self.snapshot_members = set()
     self.chapters = []
+    # sha1 of the serialized chapters (of all their files)
+    self.digests = []
+    # number of files of each chapter
+    self.parts = []
+    # hoisted styles (class -> declarations) of each chapter
+    self.chapter_styles = []
+    # (extension, sha1) of each image
     self.images = []
+    # sha1 -> index in images
+    self.image_index = {}
     self.authors = []
     self.css = []
     self.title = None
@@ -48,22 +151,312 @@ class Book(object):
     self.ncx_media_type = 'application/x-dtbncx+xml'
     self.png_media_type = 'image/png'
     self.jpeg_media_type = 'image/jpeg'
+    self.gif_media_type = 'image/gif'
     self.opf_media_type = 'application/oebps-package+xml'
     self.cover_image = None
     self.epub_base_name = 'book'
+    self.chapter_template_version = 1
     self.container_filename = 'container.xml'
     self.mimetype_filename = 'mimetype'
     self.css_filename = 'book.css'
     self.ncx_filename = 'book.ncx'
     self.opf_filename = 'book.opf'
+    if self.mode == 'staged':
+      self.manifest_filename = self.archive_path + '/manifest.json'
+    else:
+      self.manifest_filename = self.archive_path + '.manifest.json'
 
   # properties
   #   self.title
   #   self.uuid
   #   self.lang
 
+  # returns the serialized files of the chapter
   def push_chapter(self, title, divs):
+    root, body = self.chapter_tree()
+    for div in divs:
+      body.append(div)
+    styles = None
+    if self.compact:
+      start = (time.perf_counter(), time.thread_time())
+      size = len(self.serialize_chapter(root))
+      used = {}
+      self.compact_rules(used, cleanup.repeated_styles(body,
+        self.seen_styles)).apply(body)
+      styles = dict((c, d) for d, c in used.items())
+      start = (time.perf_counter() - start[0], time.thread_time() - start[1])
+    with self.stats.phase('serialize') as p:
+      data = [ self.serialize_chapter(root) ]
+      if self.compact:
+        self.stats.add('compact', start[0], start[1], size, len(data[0]))
+      if self.over_budget(len(data[0]), body):
+        data = self.split_chapter(body)
+      p.bytes_out = sum(len(x) for x in data)
+    self.push_chapter_data(title, data, styles)
+    return data
+
+  # used collects the declarations a chapter hoists (and their
+  # classes), only the repeated ones are hoisted
+  def compact_rules(self, used, repeated):
+    return cleanup.Engine([
+      cleanup.StripWhitespace(),
+      cleanup.HoistStyle(self.style_classes, repeated, used),
+      cleanup.DropEmpty([ 'b', 'big', 'blockquote', 'center', 'div', 'em',
+        'font', 'i', 'p', 'small', 'span', 'strong', 'u' ]),
+      ])
+
+  # Compacts the blocks of a streamed chapter, acc accumulates the
+  # time and the size of the blocks before. Since the later blocks
+  # aren't known yet, a style is hoisted from its second occurrence on.
+  def compact_blocks(self, blocks, container, used, acc):
+    repeated = set()
+    rules = self.compact_rules(used, repeated)
+    for block in blocks:
+      start = (time.perf_counter(), time.thread_time())
+      if isinstance(block, str):
+        acc['bytes_in'] += len(xml.sax.saxutils.escape(block).encode('utf-8'))
+        block = cleanup.whitespace_exp.sub(' ', block)
+        l = [ block ] if block.strip(' ') else []
+      else:
+        acc['bytes_in'] += len(lxml.etree.tostring(block,
+          pretty_print=self.pretty_print, encoding='utf-8', with_tail=True))
+        w = lxml.etree.Element(container.tag)
+        w.append(block)
+        repeated.update(cleanup.repeated_styles(w, self.seen_styles))
+        rules.apply(w)
+        l = ([ w.text ] if w.text else []) + list(w)
+      acc['wall'] += time.perf_counter() - start[0]
+      acc['cpu'] += time.thread_time() - start[1]
+      yield from l
+
+  def serialize_chapter(self, root):
+    return lxml.etree.tostring(root, pretty_print=self.pretty_print,
+        encoding='utf-8')
+
+  # size in bytes, e the element (with descendants) that is counted
+  def over_budget(self, size, e=None, elements=0):
+    if self.split_size and size > self.split_size:
+      return True
+    if self.split_elements and e is not None:
+      elements += sum(1 for x in e.iter())
+    return bool(self.split_elements and elements > self.split_elements)
+
+  # size and number of elements of a block
+  def block_cost(self, block):
+    size = elements = 0
+    if self.split_size:
+      size = len(lxml.etree.tostring(block, pretty_print=self.pretty_print,
+        encoding='utf-8', with_tail=True))
+    if self.split_elements:
+      elements = sum(1 for x in block.iter())
+    return size, elements
+
+  # Moves the blocks of the containers (the children of body) into
+  # as many chapter files as the budgets require, a block that
+  # exceeds them on its own gets a file of its own. Each file has a
+  # copy of the containers it has blocks of. Returns the serialized
+  # files.
+  def split_chapter(self, body):
+    roots = []
+    root, b = self.chapter_tree()
+    n = size = elements = 0
+    for div in list(body):
+      c = None
+      text = div.text
+      for block in list(div):
+        # detached, a block isn't serialized with the namespace
+        # declaration of the chapter
+        div.remove(block)
+        block_size, block_elements = self.block_cost(block)
+        if n and self.over_budget(size + block_size,
+            elements=elements + block_elements):
+          roots.append(root)
+          root, b = self.chapter_tree()
+          n = size = elements = 0
+          c = None
+        if c is None:
+          c = self.copy_container(b, div, text)
+          text = None
+        c.append(block)
+        n += 1
+        size += block_size
+        elements += block_elements
+      if c is None:
+        c = self.copy_container(b, div, text)
+      c.tail = div.tail
+    roots.append(root)
+    ids = {}
+    for k, root in enumerate(roots):
+      for x in fragment_ids(root):
+        ids.setdefault(x, k)
+    i = len(self.chapters)
+    for k, root in enumerate(roots):
+      for e in root.iter(lxml.etree.Element):
+        x = fragment_ref(e)
+        if x is not None and ids.get(x, k) != k:
+          e.set('href', self.chapter_file(i, ids[x]) + '#' + x)
+    return [ self.serialize_chapter(root) for root in roots ]
+
+  def copy_container(self, body, div, text):
+    c = div.makeelement(div.tag, div.attrib)
+    c.text = text
+    body.append(c)
+    return c
+
+  # adds an already serialized chapter (or the list of its files)
+  # and the styles it uses, e.g. from a cache
+  def push_chapter_data(self, title, data, styles=None):
+    if isinstance(data, bytes):
+      data = [ data ]
+    i = len(self.chapters)
     self.chapters.append((title, None))
+    self.parts.append(len(data))
+    self.push_styles(styles)
+    digest = hashlib.sha1()
+    for k, x in enumerate(data):
+      digest.update(x)
+      self.put(self.chapter_name(i, k), x)
+    self.digests.append(digest.hexdigest())
+
+  # Everything besides the content and the book title that goes
+  # into a chapter file - bump the version when chapter_tree() or
+  # the serialization changes.
+  def chapter_fingerprint(self):
+    return [ self.chapter_template_version, self.lang, self.css_filename,
+        self.xhtml_ns, self.pretty_print, self.split_size,
+        self.split_elements, self.compact ]
+
+  # Like push_chapter(), but the chapter is written while blocks
+  # (elements, which are serialized with their tail, or text) are
+  # produced into the container element - e.g. by a streaming
+  # parser. title may be a function that is called after the last
+  # block. In staged mode, the chapter is never completely in memory.
+  # When a block would exceed the budgets, the next file is started.
+  def push_chapter_stream(self, title, blocks, container):
+    i = len(self.chapters)
+    self.chapters.append((None, None))
+    self.parts.append(0)
+    used = {}
+    acc = { 'bytes_in': 0, 'wall': 0.0, 'cpu': 0.0 }
+    if self.compact:
+      blocks = self.compact_blocks(blocks, container, used, acc)
+    root, body = self.chapter_tree()
+    marker = uuid.uuid4().hex
+    c = lxml.etree.SubElement(body, container.tag, dict(container.attrib))
+    c.text = marker
+    head, tail = self.serialize_chapter(root).split(marker.encode('utf-8'))
+    digest = hashlib.sha1()
+    # the open file, its number of blocks, size and elements
+    part = [ None, 0, 0, 0 ]
+    # fragment targets -> file, (file, target) of the links
+    ids = {}
+    refs = []
+    # the finished files, outside of staged mode
+    finished = []
+    def write(data):
+      part[0].write(data)
+      digest.update(data)
+    def start():
+      name = self.chapter_name(i, self.parts[i])
+      self.parts[i] += 1
+      if self.mode == 'staged':
+        part[:] = [ open(self.archive_path + '/' + name + '.part', 'wb'),
+            0, 0, 0 ]
+      else:
+        part[:] = [ io.BytesIO(), 0, 0, 0 ]
+      write(head)
+    def finish():
+      write(tail)
+      name = self.chapter_name(i, self.parts[i] - 1)
+      if self.mode == 'staged':
+        part[0].close()
+        os.replace(self.archive_path + '/' + name + '.part',
+            self.archive_path + '/' + name)
+      else:
+        finished.append(part[0].getvalue())
+    # accounted as one serialize phase, which is cheaper per block
+    wall = cpu = 0.0
+    size = 0
+    start()
+    try:
+      for block in blocks:
+        t = (time.perf_counter(), time.thread_time())
+        elements = 0
+        block_ids = block_refs = ()
+        if isinstance(block, str):
+          data = xml.sax.saxutils.escape(block).encode('utf-8')
+        else:
+          data = lxml.etree.tostring(block, pretty_print=self.pretty_print,
+              encoding='utf-8', with_tail=True)
+          if self.split_elements:
+            elements = sum(1 for x in block.iter())
+          if self.split_size or self.split_elements:
+            block_ids = fragment_ids(block)
+            block_refs = [ x for x in map(fragment_ref,
+              block.iter(lxml.etree.Element)) if x is not None ]
+        if part[1] and self.over_budget(part[2] + len(data),
+            elements=part[3] + elements):
+          finish()
+          start()
+        k = self.parts[i] - 1
+        for x in block_ids:
+          ids.setdefault(x, k)
+        refs.extend((k, x) for x in block_refs)
+        wall += time.perf_counter() - t[0]
+        cpu += time.thread_time() - t[1]
+        size += len(data)
+        part[1] += 1
+        part[2] += len(data)
+        part[3] += elements
+        write(data)
+      finish()
+    except BaseException:
+      part[0].close()
+      raise
+    if self.link_parts(i, ids, refs, finished):
+      digest = hashlib.sha1()
+      for k in range(self.parts[i]):
+        if self.mode == 'staged':
+          with open(self.chapter_filename(i, k), 'rb') as f:
+            digest.update(f.read())
+        else:
+          digest.update(finished[k])
+    for k, data in enumerate(finished):
+      self.put(self.chapter_name(i, k), data)
+    self.stats.add('serialize', wall, cpu, 0, size)
+    if self.compact:
+      self.stats.add('compact', acc['wall'], acc['cpu'], acc['bytes_in'], size)
+    self.push_styles(dict((c, d) for d, c in used.items()))
+    self.digests.append(digest.hexdigest())
+    self.chapters[i] = (title() if callable(title) else title, None)
+
+  # Points the fragment links (refs) of a streamed chapter, whose
+  # targets (ids) ended up in another file, to that file. The files
+  # are either staged or in finished. Returns whether files changed.
+  def link_parts(self, i, ids, refs, finished):
+    cross = {}
+    for k, x in refs:
+      if ids.get(x, k) != k:
+        cross.setdefault(k, set()).add(x)
+    for k, l in cross.items():
+      if self.mode == 'staged':
+        with open(self.chapter_filename(i, k), 'rb') as f:
+          data = f.read()
+      else:
+        data = finished[k]
+      for x in l:
+        data = data.replace(b'href="#' + escape_attribute(x) + b'"',
+            b'href="' + escape_attribute(self.chapter_file(i, ids[x]) + '#'
+              + x) + b'"')
+      if self.mode == 'staged':
+        with open(self.chapter_filename(i, k), 'wb') as f:
+          f.write(data)
+      else:
+        finished[k] = data
+    return bool(cross)
+
+  # the skeleton of a chapter file, returns its root and body
+  def chapter_tree(self):
     root = lxml.etree.Element('html', nsmap=self.xhtml_nsmap)
     root.set(self.xml_prefix+'lang', self.lang)
     head = lxml.etree.SubElement(root, 'head')
@@ -75,12 +468,148 @@ class Book(object):
         href=self.css_filename)
     link.set('type', 'text/css')
     body = lxml.etree.SubElement(root, 'body')
-    for div in divs:
-      body.append(div)
-    with open('{0}/{1:04d}.html'.format(self.chapter_path,
-      len(self.chapters)-1), 'w') as f:
-      f.write(lxml.etree.tostring(root, pretty_print=True,
-        encoding='unicode'))
+    return root, body
+
+  def epub_filename(self):
+    return '{}/{}.epub'.format(self.out_path, self.epub_base_name)
+
+  # file name of the k-th file of a chapter, relative to the
+  # chapter directory
+  def chapter_file(self, i, k=0):
+    if k:
+      return '{0:04d}_{1}.html'.format(i, k)
+    return '{0:04d}.html'.format(i)
+
+  def chapter_id(self, i, k=0):
+    return 'chapter_' + self.chapter_file(i, k)[:-5]
+
+  # archive member name of a chapter (file)
+  def chapter_name(self, i, k=0):
+    return '{0}/{1}/{2}'.format(self.rel_ops_path, self.rel_chapter_path,
+        self.chapter_file(i, k))
+
+  # archive member names of all files of a chapter
+  def chapter_names(self, i, parts=None):
+    if parts is None:
+      parts = self.parts[i]
+    return [ self.chapter_name(i, k) for k in range(parts) ]
+
+  def chapter_filename(self, i, k=0):
+    return '{0}/{1}'.format(self.chapter_path, self.chapter_file(i, k))
+
+  def has_chapter(self, i, parts=1):
+    return self.mode == 'staged' and all(
+        os.path.isfile(self.chapter_filename(i, k)) for k in range(parts))
+
+  def has_image(self, i, ext):
+    return self.mode == 'staged' and os.path.isfile('{0}/{1:04d}.{2}'.format(
+      self.image_path, i, ext))
+
+  def zip(self):
+    if not self.zip_file:
+      if self.mode == 'stream':
+        self.zip_fp = open(self.epub_filename() + '.part', 'wb')
+      else:
+        self.zip_fp = io.BytesIO()
+      self.zip_file = zipfile.ZipFile(self.zip_fp, 'w')
+      # must be the first entry and stored
+      self.zip_file.writestr(self.mimetype_filename, self.mimetype())
+    return self.zip_file
+
+  # writes a file of the archive, name is relative to its root
+  def put(self, name, data):
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    with self.stats.phase('put', len(data)):
+      if self.mode == 'staged':
+        with open(self.archive_path + '/' + name, 'wb') as f:
+          f.write(data)
+      else:
+        zipraw.write(self.zip(), name, data, self.member_level(name))
+
+  # images are already compressed
+  def member_level(self, name):
+    if name.startswith(self.rel_ops_path + '/' + self.rel_image_path + '/'):
+      return 0
+    return self.compress_level
+
+  # archive member name of an image
+  def image_name(self, i):
+    return '{0}/{1}/{2:04d}.{3}'.format(self.rel_ops_path,
+        self.rel_image_path, i, self.images[i][0])
+
+  # href of an image relative to the chapters
+  def image_href(self, i):
+    return '../{0}/{1:04d}.{2}'.format(self.rel_image_path, i,
+        self.images[i][0])
+
+  # Adds an image unless one with the same content was already
+  # added, returns its index.
+  def push_image(self, ext, data):
+    digest = hashlib.sha1(data).hexdigest()
+    i = self.image_index.get(digest)
+    if i is None:
+      i = len(self.images)
+      self.images.append((ext, digest))
+      self.image_index[digest] = i
+      self.put(self.image_name(i), data)
+    return i
+
+  # registers images that are already staged, e.g. when resuming
+  def restore_images(self, images):
+    for ext, digest in images:
+      i = len(self.images)
+      self.images.append((ext, digest))
+      self.image_index[digest] = i
+
+  # registers a chapter that is already staged, e.g. when resuming
+  def restore_chapter(self, title, digest=None, parts=1, styles=None):
+    self.chapters.append((title, None))
+    self.digests.append(digest)
+    self.parts.append(parts)
+    self.push_styles(styles)
+
+  def push_styles(self, styles):
+    self.chapter_styles.append(styles or {})
+    for c, d in (styles or {}).items():
+      self.styles[c] = d
+      self.style_classes[d] = c
+      self.seen_styles.add(d)
+
+  def open_previous(self):
+    if not os.path.isfile(self.epub_filename()):
+      return False
+    self.previous = zipfile.ZipFile(self.epub_filename(), 'r')
+    return True
+
+  def close_previous(self):
+    if self.previous:
+      self.previous.close()
+      self.previous = None
+
+  def can_reuse(self, name):
+    if not self.previous:
+      return False
+    try:
+      self.previous.getinfo(name)
+      return True
+    except KeyError:
+      return False
+
+  # Copies a member of the previous epub into the new one without
+  # decompressing it - when staged, at the end in write_epub().
+  def reuse(self, name):
+    if self.mode == 'staged':
+      self.reused.add(name)
+    else:
+      with self.stats.phase('reuse'):
+        zipraw.copy(self.previous, self.zip(), name)
+
+  # registers a chapter whose members are copied from the previous epub
+  def reuse_chapter(self, title, digest, parts=1, styles=None):
+    self.restore_chapter(title, digest, parts, styles)
+    for name in self.chapter_names(len(self.chapters)-1):
+      self.reuse(name)
 
   # or role = 'edt'
   def push_author(self, first, last, role = 'aut'):
@@ -90,20 +619,49 @@ class Book(object):
     self.css.append(line)
 
   def write(self):
-    self.write_mimetype()
-    self.write_css()
-    self.write_container()
-    self.write_opf()
-    self.write_ncx()
-    self.write_epub()
+    for f in [ self.write_mimetype, self.write_css, self.write_container,
+        self.write_opf, self.write_ncx ]:
+      with self.stats.phase(f.__name__):
+        f()
+    with self.stats.phase('write_epub') as p:
+      self.write_epub()
+      p.bytes_out = os.path.getsize(self.epub_filename())
+    self.stats.finish()
+
+  def refresh(self):
+    n = len(self.chapters)
+    if (not self.progressive or self.mode != 'staged'
+        or n < self.progressive or n == self.snapshot_chapters):
+      return
+    if (self.snapshot_time is not None and time.monotonic() - self.snapshot_time
+        < self.progressive_interval):
+      return
+    with self.stats.phase('snapshot'):
+      for f in [ self.write_mimetype, self.write_css, self.write_container,
+          self.write_opf, self.write_ncx ]:
+        f()
+      self.write_zip(snapshot=True)
+    self.snapshot_chapters = n
+    self.snapshot_time = time.monotonic()
+
+  # bytes the compaction saved in the chapters
+  def compact_saved(self):
+    p = self.stats.phases.get('compact')
+    return p['bytes_in'] - p['bytes_out'] if p else 0
+
+  def mimetype(self):
+    return 'application/epub+zip\n'
 
   def write_mimetype(self):
-    with open(self.archive_path + '/' + self.mimetype_filename, 'w') as f:
-      f.write('application/epub+zip\n')
+    if self.mode == 'staged':
+      self.put(self.mimetype_filename, self.mimetype())
+    else:
+      self.zip()
 
   def write_css(self):
-    with open(self.ops_path + '/' + self.css_filename, 'w') as f:
-      f.writelines(self.css)
+    self.put(self.rel_ops_path + '/' + self.css_filename, ''.join(self.css)
+        + ''.join('.{} {{ {} }}\n'.format(c, self.styles[c])
+          for c in sorted(self.styles)))
 
   def write_opf_metadata(self, root):
     metadata = lxml.etree.SubElement(root, 'metadata',
@@ -132,13 +690,13 @@ class Book(object):
     item = lxml.etree.SubElement(manifest, 'item', href=self.ncx_filename)
     item.set('id', 'ncx')
     item.set('media-type', self.ncx_media_type)
-    i = 0
-    for chapter in self.chapters:
-      item = lxml.etree.SubElement(manifest, 'item',
-          href='{0}/{1:04d}.html'.format(self.rel_chapter_path, i))
-      item.set('id', 'chapter_{0:04d}'.format(i))
-      item.set('media-type', self.chapter_media_type)
-      i += 1
+    for i in range(len(self.chapters)):
+      for k in range(self.parts[i]):
+        item = lxml.etree.SubElement(manifest, 'item',
+            href='{0}/{1}'.format(self.rel_chapter_path,
+              self.chapter_file(i, k)))
+        item.set('id', self.chapter_id(i, k))
+        item.set('media-type', self.chapter_media_type)
     i = 0
     for image in self.images:
       item = lxml.etree.SubElement(manifest, 'item',
@@ -149,15 +707,15 @@ class Book(object):
         item.set('media-type', self.png_media_type)
       elif image[0] == 'jpg':
         item.set('media-type', self.jpeg_media_type)
+      elif image[0] == 'gif':
+        item.set('media-type', self.gif_media_type)
       i += 1
 
   def write_opf_spine(self, root):
     spine = lxml.etree.SubElement(root, 'spine', toc='ncx')
-    i = 0
-    for chapter in self.chapters:
-      lxml.etree.SubElement(spine, 'itemref',
-          idref='chapter_{0:04d}'.format(i))
-      i += 1
+    for i in range(len(self.chapters)):
+      for k in range(self.parts[i]):
+        lxml.etree.SubElement(spine, 'itemref', idref=self.chapter_id(i, k))
 
   def write_opf_guide(self, root):
     guide = lxml.etree.SubElement(root, 'guide')
@@ -174,6 +732,9 @@ class Book(object):
           len(self.chapters)-1))
 
   def write_opf(self):
+    if self.reuse_toc and self.can_reuse(self.rel_ops_path + '/' + self.opf_filename):
+      self.reuse(self.rel_ops_path + '/' + self.opf_filename)
+      return
     root = lxml.etree.Element('package', nsmap=self.opf_nsmap,
         version='2.0')
     root.set('unique-identifier', 'BookId')
@@ -181,18 +742,18 @@ class Book(object):
     self.write_opf_manifest(root)
     self.write_opf_spine(root)
     self.write_opf_guide(root)
-    with open(self.ops_path + '/' + self.opf_filename, 'w') as f:
-      f.write(lxml.etree.tostring(root, pretty_print=True,
-        encoding='unicode'))
+    self.put(self.rel_ops_path + '/' + self.opf_filename,
+        lxml.etree.tostring(root, pretty_print=not self.compact,
+          encoding='utf-8'))
 
   def write_ncx_head(self, root):
     head = lxml.etree.SubElement(root, 'head')
     # same as in .opf
     lxml.etree.SubElement(head, 'meta', name='dtb:uid',
         content=self.uuid)
-    # 1 or higher
+    # 1 or higher - the files of a split chapter are nested
     lxml.etree.SubElement(head, 'meta', name='dtb:depth',
-        content='1')
+        content='2' if any(n > 1 for n in self.parts) else '1')
     # must be 0
     lxml.etree.SubElement(head, 'meta', name='dtb:totalPageCount',
         content='0')
@@ -209,21 +770,34 @@ class Book(object):
       doc_author = lxml.etree.SubElement(root, 'docAuthor')
       lxml.etree.SubElement(doc_author, 'text').text = '{}, {}'.format(author[1], author[0])
 
+  def write_ncx_nav_point(self, parent, i, k, label, order):
+    nav_point = lxml.etree.SubElement(parent, 'navPoint')
+    nav_point.set('class', 'chapter')
+    nav_point.set('id', self.chapter_id(i, k))
+    nav_point.set('playOrder', str(order))
+    nav_label = lxml.etree.SubElement(nav_point, 'navLabel')
+    lxml.etree.SubElement(nav_label, 'text').text = label
+    lxml.etree.SubElement(nav_point, 'content',
+        src='{0}/{1}'.format(self.rel_chapter_path, self.chapter_file(i, k)))
+    return nav_point
+
   def write_ncx_nav_map(self, root):
     nav_map = lxml.etree.SubElement(root, 'navMap')
-    i = 0
-    for chapter in self.chapters:
-      nav_point = lxml.etree.SubElement(nav_map, 'navPoint')
-      nav_point.set('class', 'chapter')
-      nav_point.set('id', 'chapter_{0:04d}'.format(i))
-      nav_point.set('playOrder', str(i+1))
-      nav_label = lxml.etree.SubElement(nav_point, 'navLabel')
-      lxml.etree.SubElement(nav_label, 'text').text = '{}. {}'.format(i, chapter[0])
-      lxml.etree.SubElement(nav_point, 'content',
-          src='{0}/{1:04d}.html'.format(self.rel_chapter_path, i))
-      i += 1
+    order = 1
+    for i, chapter in enumerate(self.chapters):
+      label = '{}. {}'.format(i, chapter[0])
+      nav_point = self.write_ncx_nav_point(nav_map, i, 0, label, order)
+      order += 1
+      n = self.parts[i]
+      for k in range(1, n):
+        self.write_ncx_nav_point(nav_point, i, k,
+            '{} ({}/{})'.format(label, k+1, n), order)
+        order += 1
 
   def write_ncx(self):
+    if self.reuse_toc and self.can_reuse(self.rel_ops_path + '/' + self.ncx_filename):
+      self.reuse(self.rel_ops_path + '/' + self.ncx_filename)
+      return
     root = lxml.etree.Element('ncx', nsmap=self.ncx_nsmap,
         version='2005-1')
     root.set(self.xml_prefix + 'lang', self.lang)
@@ -231,9 +805,9 @@ class Book(object):
     self.write_ncx_title(root)
     self.write_ncx_authors(root)
     self.write_ncx_nav_map(root)
-    with open(self.ops_path + '/' + self.ncx_filename, 'w') as f:
-      f.write(lxml.etree.tostring(root, pretty_print=True,
-        encoding='unicode'))
+    self.put(self.rel_ops_path + '/' + self.ncx_filename,
+        lxml.etree.tostring(root, pretty_print=not self.compact,
+          encoding='utf-8'))
 
   def write_container(self):
     root = lxml.etree.Element('container', nsmap=self.container_nsmap,
@@ -243,28 +817,81 @@ class Book(object):
     rootfile.set('full-path',
         self.rel_ops_path + '/' + self.opf_filename)
     rootfile.set('media-type', self.opf_media_type)
-    with open(self.meta_inf_path + '/' + self.container_filename, 'w') as f:
-      f.write(lxml.etree.tostring(root, pretty_print=True,
-        encoding='unicode'))
+    self.put(self.rel_meta_inf_path + '/' + self.container_filename,
+        lxml.etree.tostring(root, pretty_print=not self.compact,
+          encoding='utf-8'))
+
+  # staged archive members besides mimetype, in zip order
+  def members(self):
+    l = [ self.rel_meta_inf_path + '/' + self.container_filename ]
+    for fn in [ self.css_filename, self.ncx_filename, self.opf_filename ]:
+      l.append(self.rel_ops_path + '/' + fn)
+    for i in range(0, len(self.chapters)):
+      l.extend(self.chapter_names(i))
+    for i in range(0, len(self.images)):
+      l.append(self.image_name(i))
+    return l
+
+  # None for members that are copied from the previous epub or the
+  # last snapshot
+  def load_compressed(self, name):
+    if name in self.reused or name in self.snapshot_members:
+      return None
+    with open(self.archive_path + '/' + name, 'rb') as f:
+      data = f.read()
+    compress_type, cdata = zipraw.compress(data, self.member_level(name))
+    return zipraw.info(name, data, compress_type, cdata), cdata
 
   def write_epub(self):
-    with zipfile.ZipFile('{}/{}.epub'.format(self.out_path,
-      self.epub_base_name), 'w') as z:
-      z.write(self.meta_inf_path + '/' + self.container_filename,
-          self.rel_meta_inf_path + '/' + self.container_filename)
-      z.write(self.archive_path + '/' + self.mimetype_filename,
-          self.mimetype_filename)
-      for fn in [ self.css_filename, self.ncx_filename, self.opf_filename ]:
-        z.write(self.ops_path + '/' + fn, self.rel_ops_path + '/' + fn)
-      for i in range(0, len(self.chapters)):
-        z.write('{0}/{1:04d}.html'.format(self.chapter_path, i),
-            '{0}/{1}/{2:04d}.html'.format(self.rel_ops_path, self.rel_chapter_path, i),
-            )
-      i = 0
-      for image in self.images:
-        z.write(
-            '{0}/{1:04d}.{2}'.format(self.image_path, i, image[0]),
-            '{0}/{1}/{1:04d}.{2}'.format(self.rel_ops_path, self.rel_image_path, i, image[0]))
-        i += 1
+    if self.mode != 'staged':
+      self.finish_zip()
+      return
+    self.write_zip()
+    self.close_previous()
+
+  # The members are read and compressed by a pool of threads, the
+  # compressed data is then added to the archive in order. The
+  # archive replaces the epub file (e.g. the last snapshot) at once.
+  # Only a snapshot's members are copied by the next write, a final
+  # epub is compressed anew when written again.
+  def write_zip(self, snapshot=False):
+    last = None
+    if self.snapshot_members:
+      last = zipfile.ZipFile(self.epub_filename(), 'r')
+    try:
+      with zipfile.ZipFile(self.epub_filename() + '.part', 'w') as z:
+        z.write(self.archive_path + '/' + self.mimetype_filename,
+            self.mimetype_filename)
+        names = self.members()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.compress_jobs) as executor:
+          for name, r in zip(names, executor.map(self.load_compressed, names)):
+            if r:
+              zipraw.write_raw(z, r[0], r[1])
+            elif name in self.reused:
+              zipraw.copy(self.previous, z, name)
+            else:
+              zipraw.copy(last, z, name)
+    finally:
+      if last:
+        last.close()
+    os.replace(self.epub_filename() + '.part', self.epub_filename())
+    self.snapshot_members = set()
+    if snapshot:
+      # chapters and images don't change anymore
+      self.snapshot_members = set(n for n in names if n.startswith((
+        self.chapter_name(0).rsplit('/', 1)[0] + '/',
+        self.rel_ops_path + '/' + self.rel_image_path + '/')))
 
+  def finish_zip(self):
+    self.zip().close()
+    self.zip_file = None
+    self.close_previous()
+    if self.mode == 'stream':
+      self.zip_fp.close()
+      os.replace(self.epub_filename() + '.part', self.epub_filename())
+    else:
+      with open(self.epub_filename(), 'wb') as f:
+        f.write(self.zip_fp.getvalue())
+    self.zip_fp = None
 
@@ -0,0 +1,75 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Declarative extraction of fields (metadata, titles, links) from
+# page trees.
+#
+# A source declares its fields as rules, which are compiled once into
+# a Spec, i.e. their XPath expressions are compiled at class
+# definition time and not per call. Spec.extract() evaluates each
+# rule once and returns a dict of the fields that were found. A Table
+# rule reads all fields of a key/value table (like the metadata of a
+# page) in one pass over its rows.
+
+import lxml.etree
+
+
+def compile_path(path):
+  return lxml.etree.XPath(path, smart_strings=False)
+
+
+class Rule(object):
+
+  def extract(self, root, d):
+    pass
+
+
+# The first result of path as string - or all of them, with many.
+class Field(Rule):
+
+  def __init__(self, name, path, many=False):
+    self.name = name
+    self.path = compile_path(path)
+    self.many = many
+
+  def extract(self, root, d):
+    l = self.path(root)
+    if l:
+      d[self.name] = [ str(x) for x in l ] if self.many else str(l[0])
+
+
+# Rows of a table, each row's key (e.g. 'string(td[1])') selects the
+# field its value is assigned to. fields maps keys to field names, the
+# first row with a key and a value wins.
+class Table(Rule):
+
+  def __init__(self, rows, key, value, fields):
+    self.rows = compile_path(rows)
+    self.key = compile_path(key)
+    self.value = compile_path(value)
+    self.fields = dict(fields)
+
+  def extract(self, root, d):
+    todo = dict((k, v) for k, v in self.fields.items() if v not in d)
+    for row in self.rows(root):
+      key = str(self.key(row)).strip()
+      name = todo.get(key)
+      if name:
+        l = self.value(row)
+        if l:
+          d[name] = str(l[0])
+          del todo[key]
+          if not todo:
+            return
+
+
+class Spec(object):
+
+  def __init__(self, rules):
+    self.rules = rules
+
+  def extract(self, root):
+    d = {}
+    for r in self.rules:
+      r.extract(root, d)
+    return d
@@ -2,120 +2,750 @@
 
 import lxml
 import lxml.html
-import requests
 import urllib.parse
 import logging
 import re
 import hashlib
-import random
+import threading
 import time
+import codecs
+import itertools
+import asyncio
+import concurrent.futures
+import multiprocessing
 
+from transport import Transport, RetryBudget
+import cache
+import checkpoint
+import cleanup
+import extract
+import images
+import pipeline
+import stats
+
+
+charset_exp = re.compile('charset=["\']?([-\\w.:]+)', re.IGNORECASE)
+# first and last name
+author_exp = re.compile('(.+) (.+)')
+
+# The charset of the Content-Type header - or utf-8 if the body
+# happens to be valid utf-8, since the pages' meta tags aren't
+# reliable. None leaves the detection to lxml.
+def page_encoding(page):
+  return header_encoding(page) or sniff_encoding(page.content)
+
+def header_encoding(page):
+  m = charset_exp.search(page.headers.get('Content-Type', ''))
+  if m:
+    return m.group(1)
+  return None
+
+sniff_chunk_size = 64 * 1024
+
+# s is the page or - with final=False - its beginning. Validated
+# chunk-wise, the decoded text isn't kept.
+def sniff_encoding(s, final=True):
+  if s.isascii():
+    return 'utf-8'
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  v = memoryview(s)
+  try:
+    for k in range(0, len(v), sniff_chunk_size):
+      decoder.decode(v[k:k+sniff_chunk_size],
+          final and k + sniff_chunk_size >= len(v))
+    return 'utf-8'
+  except UnicodeDecodeError:
+    return None
+
+# s is either a str or undecoded bytes
+def parse_html(s, encoding=None):
+  if encoding and not isinstance(s, str):
+    return lxml.html.fromstring(s,
+        parser=lxml.html.HTMLParser(encoding=encoding))
+  return lxml.html.fromstring(s)
+
+
+# Fast path: only the divs a source needs are cut out of the page
+# bytes and parsed, by counting div tags. This is only valid if the
+# region doesn't contain markup that hides or implies tags, thus
+# such regions and results that don't match the count are rejected -
+# then the whole page has to be parsed.
+
+div_tag_exp = re.compile(b'<(/?)div\\b[^>]*>', re.IGNORECASE)
+unsafe_exp = re.compile(b'<(?:script|style|textarea|title|!--|!\\[CDATA)',
+    re.IGNORECASE)
+meta_charset_exp = re.compile(b'<meta[^>]+charset=["\']?([-\\w.:]+)',
+    re.IGNORECASE)
+
+def region_start(id):
+  return re.compile(b'<div\\s[^>]*\\bid\\s*=\\s*["\']?' + re.escape(id)
+      + b'["\'\\s/>]', re.IGNORECASE)
+
+region_starts = dict((id, region_start(id.encode('ascii')))
+    for id in [ 'gutenb', 'metadata' ])
+
+# (start, end, number of divs) of the div with the id, including its
+# tail (up to the next tag) - or None
+def find_region(s, id):
+  exp = region_starts.get(id) or region_start(id.encode('ascii'))
+  m = exp.search(s)
+  if not m or exp.search(s, m.end()):
+    return None
+  depth, divs = 0, 0
+  for t in div_tag_exp.finditer(s, m.start()):
+    if t.group(1):
+      depth -= 1
+    else:
+      depth += 1
+      divs += 1
+    if depth == 0:
+      end = t.end()
+      break
+  else:
+    return None
+  if unsafe_exp.search(s, m.start(), end):
+    return None
+  tail = s.find(b'<', end)
+  return m.start(), tail if tail >= 0 else len(s), divs
+
+# A document with just the divs of ids, such that queries like
+# //div[@id="gutenb"] work as on the whole page - or None. Without
+# encoding, the page's meta charset is used, like lxml does.
+def parse_regions(s, ids, encoding=None):
+  if isinstance(s, str):
+    return None
+  if not encoding:
+    m = meta_charset_exp.search(s, 0, 8192)
+    if not m:
+      return None
+    encoding = m.group(1).decode('ascii')
+  regions = []
+  for id in ids:
+    r = find_region(s, id)
+    if not r:
+      return None
+    regions.append(r + (id,))
+  regions.sort()
+  if any(a[1] > b[0] for a, b in zip(regions, regions[1:])):
+    return None
+  try:
+    tree = lxml.html.document_fromstring(b'<html><body>'
+        + b''.join(s[r[0]:r[1]] for r in regions) + b'</body></html>',
+        parser=lxml.html.HTMLParser(encoding=encoding))
+  except (LookupError, lxml.etree.ParserError):
+    return None
+  body = tree.find('body')
+  if (body is None or [ e.get('id') for e in body ] != [ r[3] for r in regions ]
+      or sum(1 for e in body.iter('div')) != sum(r[2] for r in regions)):
+    return None
+  return tree
+
+# the tree of the regions if possible, else of the whole page - and
+# whether the regions were used
+def parse_page(s, ids, encoding=None):
+  tree = parse_regions(s, ids, encoding)
+  if tree is None:
+    logging.debug('Unexpected markup around {} - parsing the whole page'
+        .format(', '.join(ids)))
+    return parse_html(s, encoding), False
+  return tree, True
+
+# Parses and cleans a chapter page, in a worker process of the parse
+# pool. Returns the chapter title (or None), the cleaned chapter div
+# as XML, its tail text and the (phase, wall, CPU, bytes) stats of
+# parse and cleanup.
+def clean_chapter(s, encoding):
+  wall, cpu = time.perf_counter(), time.process_time()
+  tree, fast = parse_page(s, GB_DE.chapter_regions, encoding)
+  times = [ ('parse', time.perf_counter() - wall,
+    time.process_time() - cpu, len(s)) ]
+  if not fast:
+    times.append(('parse_fallback', 0.0, 0.0, 0))
+  wall, cpu = time.perf_counter(), time.process_time()
+  div = GB_DE.chapter_path(tree)[0]
+  title = find_chapter_title(div)
+  GB_DE.cleanup_rules.apply(div)
+  data = lxml.etree.tostring(div, encoding='utf-8', with_tail=False)
+  times.append(('cleanup', time.perf_counter() - wall,
+    time.process_time() - cpu, 0))
+  return title, data, div.tail, times
+
+def find_chapter_title(div):
+  return GB_DE.title_spec.extract(div).get('chapter_title')
 
 
 class GB_DE(object):
 
-  def __init__(self, url, book, args):
+  # applied in one pass to the chapter div by push_chapter
+  cleanup_rules = cleanup.Engine([
+    cleanup.StripAttributes(['class']),
+    # wtf ... with lxml an element may have
+    # tailing text (.tail) - thus, when removing
+    # an element, the tail is removed as well ...
+    # thus, getparent().remove(e) can't be used here
+    cleanup.Unwrap(['a'], unless='href'),
+    cleanup.RemoveEmpty(['p']),
+    ])
+  class_rules = cleanup.Engine([ cleanup.StripAttributes(['class']) ])
+  anchor_rules = cleanup.Engine([ cleanup.Unwrap(['a'], unless='href') ])
+  empty_paragraph_rules = cleanup.Engine([ cleanup.RemoveEmpty(['p']) ])
+  # fields of the first chapter's page (the metadata table) and of
+  # its chapter div (headings, if the table lacks author or title)
+  meta_spec = extract.Spec([
+    extract.Table('.//div[@id="metadata"]//tr', 'string(td[1])',
+      'td[2]/text()', { 'author': 'author', 'title': 'title', 'isbn': 'isbn' }),
+    ])
+  heading_spec = extract.Spec([
+    extract.Field('author', './/h3[1]/text()'),
+    extract.Field('title', './/h2[1]/text()', many=True),
+    ])
+  title_spec = extract.Spec([
+    extract.Field('chapter_title', './/p[@class="centerbig"]/text()'),
+    ])
+  toc_spec = extract.Spec([
+    extract.Field('chapter_urls', '//ul[@class="gbnav"]//li/a/@href',
+      many=True),
+    ])
+  chapter_path = extract.compile_path('//div[@id="gutenb"]')
+  # the divs of a chapter page that are parsed, if possible (the
+  # first chapter's contains the book's metadata)
+  chapter_regions = [ 'gutenb' ]
+  first_chapter_regions = [ 'metadata', 'gutenb' ]
+  # bytes fed to the parser at once, with --stream
+  stream_chunk_size = 64 * 1024
+  # bump when the extraction code changes its output, invalidates
+  # the chapter cache
+  transform_version = 1
+
+  def __init__(self, url, book, args, transport=None):
     self.url = url
     self.base_url = '{0.scheme}://{0.netloc}'.format(
         urllib.parse.urlsplit(url))
     self.book = book
     self.args = args
-    self.headers = { 'User-Agent': args.agent }
     self.dump_count = 0
+    self.dump_lock = threading.Lock()
+    if transport:
+      self.transport = transport
+    else:
+      self.transport = Transport(args)
+    self.manifest = checkpoint.Manifest(book.manifest_filename, url)
+    # shared by all requests of the book
+    self.retries = RetryBudget(args.retries, args.backoff)
+    # the first chapters of a progressive book, they are fetched
+    # before other requests for the host
+    self.urgent_urls = set()
+    # manifest entries and metadata of the previous build, when
+    # rebuilding incrementally
+    self.previous = {}
+    self.previous_meta = None
+    self.previous_overrides = None
+    self.reused = 0
+    # created by download(), unless images are disabled
+    self.image_fetcher = None
+    # number of images referenced by the last pushed chapter
+    self.chapter_images = 0
+    # the serialized files of the last pushed chapter
+    self.chapter_data = None
+    self.chapter_cache = None
+    if args.chapter_cache:
+      self.chapter_cache = cache.chapter_cache(args.chapter_cache,
+          int(args.chapter_cache_size * 1024 * 1024))
+    self.cached = 0
 
 
   def get_url(self, url):
     logging.info('Getting {} ...'.format(url))
-    time.sleep(random.expovariate(1.0/self.args.wait))
-    page = requests.get(url, headers=self.headers)
-    if self.args.dump:
-      with open('{0}/dump_{1:04d}.html'.format(self.args.out,
-        self.dump_count), 'w') as f:
-        f.write(page.text)
-        self.dump_count += 1
+    # rate limit and retry delays are accounted as 'wait' only
+    with self.book.stats.phase('fetch') as p:
+      tally = stats.WaitTally(self.book.stats)
+      try:
+        page = self.transport.get(url, tally, self.retries,
+            url in self.urgent_urls)
+      finally:
+        p.excluded = tally.wait
+      page.raise_for_status()
+      p.bytes_in = len(page.content)
+    self.dump(page)
     return page
 
-  def chapter_urls_from_string(self, s):
-    tree = lxml.html.fromstring(s)
-    chapter_urls = tree.xpath(
-        '//ul[@class="gbnav"]//li/a/@href')
+  # CPU time isn't accounted, since the coroutine shares its thread
+  async def get_url_async(self, tp, url):
+    logging.info('Getting {} ...'.format(url))
+    start = time.perf_counter()
+    tally = stats.WaitTally(self.book.stats)
+    page = await tp.aget(url, tally, self.retries)
+    page.raise_for_status()
+    self.book.stats.add('fetch', time.perf_counter() - start - tally.wait,
+        bytes_in=len(page.content))
+    self.dump(page)
+    return page
+
+  def dump(self, page):
+    if self.args.dump:
+      with self.dump_lock:
+        with open('{0}/dump_{1:04d}.html'.format(self.args.out,
+          self.dump_count), 'wb') as f:
+          f.write(page.content)
+          self.dump_count += 1
+
+  def chapter_urls_from_string(self, s, encoding=None):
+    tree = parse_html(s, encoding)
+    chapter_urls = self.toc_spec.extract(tree).get('chapter_urls', [])
     if not chapter_urls:
       logging.error('Could not find any chapters')
     return chapter_urls
 
   def get_chapter_urls(self):
     page = self.get_url(self.url)
-    return self.chapter_urls_from_string(page.text)
+    return self.chapter_urls_from_string(page.content, page_encoding(page))
 
   def download(self):
     chapter_urls = self.get_chapter_urls()
-    self.download_chapters(chapter_urls)
+    done = self.prepare(chapter_urls)
+    try:
+      self.download_chapters(chapter_urls, done)
+    finally:
+      if self.image_fetcher:
+        self.image_fetcher.close()
+    self.finish(chapter_urls)
 
-  def download_chapters(self, chapter_urls):
-    i = 1
-    for chapter_url in chapter_urls:
-      self.download_chapter(self.base_url + chapter_url, i)
-      i += 1
+  # Like download(), but with an aio.Transport: the pages of a window
+  # of chapters ahead of the assembly are requested at once and the
+  # rate limiter schedules them. The window is as large as the one of
+  # the threaded pipeline, thus the fetched pages held back for the
+  # assembly are bounded. Parsing and cleanup run in the transport's
+  # executor, in TOC order.
+  async def download_async(self, tp):
+    page = await self.get_url_async(tp, self.url)
+    chapter_urls = await tp.run(self.chapter_urls_from_string, page.content,
+        page_encoding(page))
+    done = await tp.run(self.prepare, chapter_urls)
+    urls = [ self.base_url + chapter_url for chapter_url in chapter_urls ]
+    todo = iter([ (i, url) for i, url in enumerate(urls, 1) if i not in done ])
+    window = max(1, self.args.jobs) + 2 * max(1, self.args.queue_depth)
+    pages = {}
+    def fill():
+      while len(pages) < window:
+        item = next(todo, None)
+        if not item:
+          return
+        pages[item[0]] = asyncio.ensure_future(self.get_url_async(tp, item[1]))
+    try:
+      fill()
+      for i, url in enumerate(urls, 1):
+        if i in done:
+          self.restore_chapter(done[i])
+        else:
+          page = await pages.pop(i)
+          fill()
+          encoding = await tp.run(page_encoding, page)
+          await tp.run(self.add_chapter, i, url, page, encoding)
+        await tp.run(self.book.refresh)
+    finally:
+      for f in pages.values():
+        f.cancel()
+      if self.image_fetcher:
+        await tp.run(self.image_fetcher.close)
+    self.finish(chapter_urls)
 
-  def meta_data(self, root, key):
-    l = root.xpath('.//div[@id="metadata"]//tr[./td = "{}"]/td[2]/text()'.format(key))
-    if l:
-      return str(l[0])
-    else:
+  # Sets up the image fetcher and loads the manifest of a previous
+  # run. Returns the chapters that are already done (see
+  # download_chapters()).
+  def prepare(self, chapter_urls):
+    urls = [ self.base_url + chapter_url for chapter_url in chapter_urls ]
+    done = {}
+    self.urgent_urls = set(urls[:self.book.progressive])
+    if not self.args.no_images:
+      self.image_fetcher = images.Fetcher(self.transport, self.args.jobs,
+          self.book.stats, self.retries)
+    if (self.args.resume or self.args.incremental) and self.manifest.load():
+      self.manifest.truncate(len(urls))
+      if self.args.resume:
+        done = self.manifest.completed(urls, self.book)
+        logging.info('Resuming: {} of {} chapters already downloaded'.format(
+          len(done), len(urls)))
+        if 1 in done:
+          self.manifest.restore_meta(self.book)
+      elif self.book.open_previous():
+        self.previous = dict(self.manifest.chapters)
+        self.previous_meta = self.manifest.meta
+        self.previous_overrides = self.manifest.overrides
+    return done
+
+  def finish(self, chapter_urls):
+    if self.chapter_cache:
+      logging.info('Chapter cache: {} of {} chapters'.format(self.cached,
+        len(chapter_urls)))
+    if self.previous:
+      self.book.reuse_toc = self.toc_unchanged(chapter_urls)
+      logging.info('Incremental rebuild: {} of {} chapters unchanged{}'.format(
+        self.reused, len(chapter_urls),
+        ', reusing OPF/NCX' if self.book.reuse_toc else ''))
+
+  def meta_unchanged(self):
+    return self.previous_meta == checkpoint.book_meta(self.book)
+
+  def toc_unchanged(self, urls):
+    if len(self.previous) != len(urls) or not self.meta_unchanged():
+      return False
+    for i, chapter in enumerate(self.book.chapters, 1):
+      if self.previous[i]['title'] != chapter[0]:
+        return False
+    return True
+
+  # The chapter's source is the same as in the previous build and
+  # its member can be copied from the previous epub. Since chapter
+  # files contain the book title, the metadata must be unchanged, too.
+  # The first chapter yields the metadata, thus only the options that
+  # override it must be unchanged.
+  def can_reuse(self, i, url, digest):
+    prev = self.previous.get(i)
+    return (prev and prev['url'] == url and prev['sha1'] == digest
+        and prev.get('out_sha1') and not prev.get('images')
+        and (self.previous_overrides == self.overrides() if i == 1
+          else self.meta_unchanged())
+        and all(self.book.can_reuse(name) for name in
+          self.book.chapter_names(i-1, prev.get('parts', 1))))
+
+  # Pages are fetched by a pool of workers, but parsed and pushed
+  # to the book in TOC order - executor.map() yields results in
+  # submission order. Chapters in done (1-based index -> manifest
+  # entry) are already staged and are only re-registered.
+  def download_chapters(self, chapter_urls, done=None):
+    done = done or {}
+    urls = [ self.base_url + chapter_url for chapter_url in chapter_urls ]
+    if self.args.stream:
+      for i, url in enumerate(urls, 1):
+        if i in done:
+          self.restore_chapter(done[i])
+        else:
+          self.stream_chapter(i, url)
+        self.book.refresh()
+      return
+    self.first_done = threading.Event()
+    if 1 in done:
+      self.first_done.set()
+    # the page and its encoding, which is determined once
+    def fetch(i, url):
+      if i in done:
+        return None
+      page = self.get_url(url)
+      return page, page_encoding(page)
+    def assemble(i, url, fetched, cleaned):
+      if i in done:
+        self.restore_chapter(done[i])
+      else:
+        self.add_chapter(i, url, fetched[0], fetched[1], cleaned)
+      if i == 1:
+        self.first_done.set()
+      self.book.refresh()
+    pool = None
+    if self.args.parse_workers:
+      # not forked: the compiled XPath expressions of the class have
+      # locks, which may be held by another thread at fork time
+      pool = concurrent.futures.ProcessPoolExecutor(
+          max_workers=self.args.parse_workers,
+          mp_context=multiprocessing.get_context('forkserver'))
+    try:
+      pipeline.Pipeline(fetch,
+          lambda i, url, fetched: self.clean_async(pool, i, url, fetched),
+          assemble, self.book.stats, self.args.jobs,
+          self.args.queue_depth).run(list(enumerate(urls, 1)))
+    finally:
+      if pool:
+        pool.shutdown(cancel_futures=True)
+
+  # Starts the parse and cleanup of a page in the pool, unless it's
+  # the first chapter (its whole page is needed for the metadata).
+  # Once the first chapter is assembled, chapters that are going to
+  # be reused or taken from the chapter cache are skipped, too - both
+  # depend on the metadata. fetched is the page and its encoding.
+  # Returns a future or None.
+  def clean_async(self, pool, i, url, fetched):
+    if not pool or not fetched or i == 1:
+      return None
+    page, encoding = fetched
+    if not self.first_done.is_set():
+      return pool.submit(clean_chapter, page.content, encoding)
+    digest = hashlib.sha1(page.content).hexdigest()
+    if self.can_reuse(i, url, digest):
+      return None
+    if self.chapter_cache and self.chapter_cache.has(
+        self.chapter_key(i, digest, encoding)):
       return None
+    return pool.submit(clean_chapter, page.content, encoding)
+
+  # copies the chapter from the previous build or pushes the page,
+  # encoding is the one of page_encoding()
+  def add_chapter(self, i, url, page, encoding, cleaned=None):
+    digest = hashlib.sha1(page.content).hexdigest()
+    key = None
+    if self.chapter_cache:
+      key = self.chapter_key(i, digest, encoding)
+    if self.can_reuse(i, url, digest):
+      if i == 1:
+        self.manifest.restore_meta(self.book)
+      title = self.previous[i]['title']
+      self.book.reuse_chapter(title, self.previous[i]['out_sha1'],
+          self.previous[i].get('parts', 1), self.previous[i].get('styles'))
+      self.reused += 1
+    elif key and self.push_cached_chapter(i, key):
+      title = self.book.chapters[-1][0]
+    else:
+      self.chapter_images = 0
+      if cleaned:
+        title = self.push_cleaned_chapter(cleaned.result(), url)
+      else:
+        title = self.push_chapter(page.content, i, encoding, url)
+      if i == 1:
+        self.manifest.set_meta(self.book, self.overrides())
+      # chapters that reference images aren't cached, the images
+      # would have to be cached along with them
+      if key and not self.chapter_images:
+        meta = { 'title': title }
+        if i == 1:
+          meta['book'] = checkpoint.book_meta(self.book)
+        if len(self.chapter_data) > 1:
+          meta['parts'] = [ len(x) for x in self.chapter_data ]
+        if self.book.chapter_styles[-1]:
+          meta['styles'] = self.book.chapter_styles[-1]
+        self.chapter_cache.put(key, meta, b''.join(self.chapter_data))
+    self.manifest_done(i, url, title, digest)
+
+  def manifest_done(self, i, url, title, digest):
+    self.manifest.done(i, url, title, digest, self.book.digests[i-1],
+        self.chapter_images, self.book.images, self.book.parts[i-1],
+        self.book.chapter_styles[i-1])
+
+  # registers a staged chapter, entry is its manifest entry
+  def restore_chapter(self, entry):
+    self.book.restore_chapter(entry['title'], parts=entry.get('parts', 1),
+        styles=entry.get('styles'))
+
+  # the options that override the metadata of the first chapter
+  def overrides(self):
+    return [ self.args.title, self.args.author, self.args.uuid ]
+
+  # Everything a cleaned chapter depends on, besides the page. The
+  # first chapter yields the book's metadata, the others contain
+  # its title.
+  def chapter_key(self, i, digest, encoding):
+    parts = [ type(self).__name__, self.transform_version,
+        self.cleanup_rules.fingerprint(), self.book.chapter_fingerprint(),
+        encoding, bool(self.image_fetcher) ]
+    if i == 1:
+      parts.append(self.overrides())
+    else:
+      parts.append(self.book.title)
+    return self.chapter_cache.key(digest, parts)
+
+  def push_cached_chapter(self, i, key):
+    r = self.chapter_cache.get(key)
+    if not r:
+      return False
+    meta, data = r
+    if i == 1:
+      checkpoint.set_book_meta(self.book, meta['book'])
+      self.manifest.set_meta(self.book, self.overrides())
+    self.chapter_images = 0
+    # the files of a split chapter
+    parts = []
+    for n in meta.get('parts', [ len(data) ]):
+      parts.append(data[:n])
+      data = data[n:]
+    self.book.push_chapter_data(meta['title'], parts, meta.get('styles'))
+    self.cached += 1
+    return True
+
+  # Fetches and pushes a chapter while it is downloaded (--stream),
+  # chapter after chapter. Incremental rebuilds can't reuse such
+  # chapters, since the page's digest is only known at the end.
+  def stream_chapter(self, i, url):
+    logging.info('Getting {} ...'.format(url))
+    with self.book.stats.phase('fetch') as p:
+      tally = stats.WaitTally(self.book.stats)
+      try:
+        page = self.transport.stream(url, tally, self.retries,
+            url in self.urgent_urls)
+      finally:
+        p.excluded = tally.wait
+      page.raise_for_status()
+    digest = hashlib.sha1()
+    def feed(chunks):
+      for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+    try:
+      chunks = page.iter_content(self.stream_chunk_size)
+      first = next(chunks, b'')
+      encoding = header_encoding(page) or sniff_encoding(first, False)
+      fed = feed(itertools.chain([ first ], chunks))
+      title = self.push_chapter_stream(fed, i, encoding, url)
+      # the rest of the page, for the digest (and to keep the
+      # connection usable)
+      for chunk in fed:
+        pass
+    finally:
+      page.close()
+    if i == 1:
+      self.manifest.set_meta(self.book, self.overrides())
+    self.manifest_done(i, url, title, digest.hexdigest())
+
+  # parser events of the page as its chunks arrive, each chunk's
+  # events are followed by (None, None)
+  def parse_events(self, chunks, encoding=None):
+    parser = lxml.etree.HTMLPullParser(events=('start', 'end'),
+        encoding=encoding)
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    for chunk in chunks:
+      with self.book.stats.phase('parse', len(chunk)):
+        parser.feed(chunk)
+        events = list(parser.read_events())
+      yield from events
+      yield None, None
+    parser.close()
+    yield from parser.read_events()
+
+  # whether set_meta_data() has all it needs
+  def meta_ready(self, root, div):
+    meta, headings = self.extract_meta_data(root, div)
+    return ((self.args.author or meta.get('author') or headings.get('author'))
+        and (self.args.title or meta.get('title') or headings.get('title')))
+
+  # Like push_chapter(), but for the chunks of a page that is parsed
+  # incrementally. After each chunk, the top-level blocks of the
+  # chapter div that are complete (including their tail, i.e. the
+  # next block has started) are cleaned up, written and removed from
+  # the tree. The first chapter is held back until the book's
+  # metadata is known, which may come from its first blocks.
+  def push_chapter_stream(self, chunks, i, encoding=None, url=None):
+    events = self.parse_events(chunks, encoding)
+    div = None
+    ended = False
+    for event, e in events:
+      if div is None:
+        if event == 'start' and e.tag == 'div' and e.get('id') == 'gutenb':
+          div = e
+          if i != 1:
+            break
+      elif e is div and event == 'end':
+        ended = True
+        break
+      elif event == 'start' and e.getparent() is div:
+        # the first blocks, e.g. the author
+        if self.meta_ready(div.getroottree().getroot(), div):
+          break
+    if div is None:
+      raise RuntimeError('Could not find the chapter in {}'.format(url))
+    if i == 1:
+      self.set_meta_data(div.getroottree().getroot(), div)
+    state = { 'title': None, 'images': 0 }
+    def title():
+      if state['title'] is None:
+        logging.info('Chapter title not found - using book title: {}'.format(
+          self.book.title))
+        return self.book.title
+      return state['title']
+    self.book.push_chapter_stream(title,
+        self.stream_blocks(events, div, ended, url or self.url, state), div)
+    self.chapter_images = state['images']
+    return self.book.chapters[-1][0]
+
+  def stream_blocks(self, events, div, ended, url, state):
+    if not ended:
+      for event, e in events:
+        if event is None:
+          if len(div):
+            yield from self.flush_blocks(div, div[-1], url, state)
+        elif e is div and event == 'end':
+          break
+    yield from self.flush_blocks(div, None, url, state)
+
+  # moves the blocks of div before e (all for None) into a detached
+  # copy of div, cleans them up and yields its text and blocks
+  def flush_blocks(self, div, e, url, state):
+    w = lxml.html.Element(div.tag)
+    w.text = div.text
+    div.text = None
+    for c in list(div):
+      if c is e:
+        break
+      w.append(c)
+    if not len(w) and not w.text:
+      return
+    with self.book.stats.phase('cleanup'):
+      if state['title'] is None:
+        state['title'] = find_chapter_title(w)
+        if state['title'] is not None:
+          logging.info('Found chapter title: {}'.format(state['title']))
+      self.cleanup_rules.apply(w)
+    if self.image_fetcher:
+      self.push_images(w, url)
+      state['images'] += self.chapter_images
+    if w.text:
+      yield w.text
+    yield from list(w)
+
+  def meta_data(self, root, key):
+    return self.meta_spec.extract(root).get(key)
+
+  # the fields of the metadata table and the chapter's headings
+  def extract_meta_data(self, root, div):
+    return self.meta_spec.extract(root), self.heading_spec.extract(div)
 
   def set_meta_data(self, root, div):
-    self.set_author(root, div)
-    self.set_title(root, div)
-    self.set_uuid(root, div)
+    meta, headings = self.extract_meta_data(root, div)
+    self.set_author(meta, headings)
+    self.set_title(meta, headings)
+    self.set_uuid(meta)
 
-  def set_author(self, root, div):
+  def set_author(self, meta, headings):
     if self.args.author:
       for author in self.args.author:
         self.push_author(author)
     else:
-      author = self.meta_data(root, 'author')
+      author = meta.get('author')
       if author:
         logging.info('Found author in metadata: {}'.format(author))
         self.push_author(author)
       else:
-        l = div.xpath('.//h3[1]/text()')
-        if not l:
+        author = headings.get('author')
+        if not author:
           raise RuntimeError('Could not find author in first chapter - consider specifying it with an option')
-        logging.info('Found author: {}'.format(l[0]))
-        self.push_author(l[0])
+        logging.info('Found author: {}'.format(author))
+        self.push_author(author)
 
   def push_author(self, author):
-      e = re.compile('(.+) (.+)')
-      m = e.match(author)
+      m = author_exp.match(author)
       if not m:
         raise RuntimeError('Could not seperate author name by blank: {}'.format(author))
       self.book.push_author(m.group(1), m.group(2))
 
-  def set_title(self, root, div):
+  def set_title(self, meta, headings):
     if self.args.title:
       self.book.title = self.args.title
     else:
-      title = self.meta_data(root, 'title')
+      title = meta.get('title')
       if title:
         logging.info('Found title in metadata: {}'.format(title))
         self.book.title = title
       else:
-        l = div.xpath('.//h2[1]/text()')
+        l = headings.get('title')
         if not l:
           raise RuntimeError('Could not find title in first chapter - consider specifying it with an option')
         m = []
         for s in l:
-          m.append(str(s).strip().replace('.', ''))
+          m.append(s.strip().replace('.', ''))
         title = ' - '.join(m)
         logging.info('Found title: {}'.format(title))
         self.book.title = title
 
-  def set_uuid(self, root, div):
+  def set_uuid(self, meta):
     if self.args.uuid:
       self.book.uuid = self.args.uuid
     else:
-      isbn = self.meta_data(root, 'isbn')
+      isbn = meta.get('isbn')
       if isbn:
         logging.info('Found isbn in metadata: {}'.format(isbn))
         self.book.uuid = isbn
@@ -129,10 +759,10 @@ class GB_DE(object):
         self.book.uuid = m.hexdigest()
 
   def chapter_title(self, root):
-    title = ''
-    l = root.xpath('.//p[@class="centerbig"]/text()')
-    if l:
-      title = str(l[0])
+    return self.log_chapter_title(find_chapter_title(root))
+
+  def log_chapter_title(self, title):
+    if title:
       logging.info('Found chapter title: {}'.format(title))
     else:
       logging.info('Chapter title not found - using book title: {}'.format(self.book.title))
@@ -140,35 +770,60 @@ class GB_DE(object):
     return title
 
   def remove_class_attributes(self, div):
-    for e in div.xpath('.//*[@class]'):
-      e.attrib.pop('class')
+    self.class_rules.apply(div)
 
   def remove_anchors(self, div):
-    # wtf ... with lxml an element may have 
-    # tailing text (.tail) - thus, when removing
-    # an element, the tail is removed as well ...
-    # thus, getparent().remove(e) can't be used here
-    for e in div.xpath('.//a[not(@href)]'):
-      e.drop_tag()
+    self.anchor_rules.apply(div)
 
   def remove_empty_paragraphs(self, div):
-    #for e in div.xpath('.//p[not(node())]'):
-    for e in div.xpath('.//p[not(*)][not(normalize-space())]'):
-      e.getparent().remove(e)
+    self.empty_paragraph_rules.apply(div)
 
-  def push_chapter(self, s, i):
-    tree = lxml.html.fromstring(s)
-    div = tree.xpath('//div[@id="gutenb"]')[0]
-    if i == 1:
-      self.set_meta_data(tree, div)
-    title = self.chapter_title(div)
-    self.remove_class_attributes(div)
-    self.remove_anchors(div)
-    self.remove_empty_paragraphs
-    self.book.push_chapter(title, [div])
+  # Fetches the images of a chapter and points them to their copies
+  # in the book. Images that can't be fetched are removed.
+  def push_images(self, div, url):
+    imgs = [ e for e in div.iter('img') if e.get('src') ]
+    urls = [ urllib.parse.urljoin(url, e.get('src')) for e in imgs ]
+    fetched = self.image_fetcher.fetch_all(urls)
+    for e, u in zip(imgs, urls):
+      r = fetched[u]
+      if r:
+        e.set('src', self.book.image_href(self.book.push_image(*r)))
+      else:
+        e.drop_tree()
+    self.chapter_images = len(imgs)
+
+  def push_chapter(self, s, i, encoding=None, url=None):
+    with self.book.stats.phase('parse', len(s)):
+      tree, fast = parse_page(s, self.first_chapter_regions if i == 1
+          else self.chapter_regions, encoding)
+    if not fast:
+      self.book.stats.add('parse_fallback', 0.0)
+    with self.book.stats.phase('cleanup'):
+      div = self.chapter_path(tree)[0]
+      if i == 1:
+        self.set_meta_data(tree, div)
+      title = self.chapter_title(div)
+      self.cleanup_rules.apply(div)
+    if self.image_fetcher:
+      self.push_images(div, url or self.url)
+    self.chapter_data = self.book.push_chapter(title, [div])
+    return title
+
+  # the result of clean_chapter()
+  def push_cleaned_chapter(self, cleaned, url):
+    title, data, tail, times = cleaned
+    for name, wall, cpu, n in times:
+      self.book.stats.add(name, wall, cpu, n)
+    div = lxml.etree.fromstring(data, parser=lxml.html.XHTMLParser())
+    div.tail = tail
+    title = self.log_chapter_title(title)
+    if self.image_fetcher:
+      self.push_images(div, url or self.url)
+    self.chapter_data = self.book.push_chapter(title, [div])
+    return title
 
   def download_chapter(self, url, i):
     page = self.get_url(url)
-    self.push_chapter(page.text, i)
+    self.push_chapter(page.content, i, page_encoding(page), url)
 
 
@@ -0,0 +1,96 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Concurrent download of the images referenced by chapters.
+#
+# Images are fetched through the shared Transport (and thus its rate
+# limiter and page cache). Downloaded images are kept in a
+# process-wide memo, such that books of a batch that are built by the
+# same process don't fetch an image twice. The deduplication by
+# content is done by epub.Book.push_image().
+
+import collections
+import concurrent.futures
+import logging
+import threading
+
+
+# file extension by magic bytes
+def image_type(data):
+  if data.startswith(b'\x89PNG\r\n\x1a\n'):
+    return 'png'
+  if data.startswith(b'\xff\xd8\xff'):
+    return 'jpg'
+  if data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+    return 'gif'
+  return None
+
+
+class Memo(object):
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.d = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, url):
+    with self.lock:
+      r = self.d.get(url)
+      if r:
+        self.d.move_to_end(url)
+      return r
+
+  def put(self, url, r):
+    with self.lock:
+      if url in self.d:
+        return
+      self.d[url] = r
+      self.size += len(r[1])
+      while self.size > self.max_bytes and self.d:
+        self.size -= len(self.d.popitem(last=False)[1][1])
+
+
+memo = Memo(64 * 1024 * 1024)
+
+
+class Fetcher(object):
+
+  def __init__(self, transport, jobs, stats=None, retries=None):
+    self.transport = transport
+    self.stats = stats
+    self.retries = retries
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, jobs))
+
+  # returns (extension, data) or None
+  def fetch(self, url):
+    r = memo.get(url)
+    if r:
+      return r
+    logging.info('Getting image {} ...'.format(url))
+    try:
+      page = self.transport.get(url, self.stats, self.retries)
+    except Exception as e:
+      logging.warning('Could not get image {}: {}'.format(url, e))
+      return None
+    if page.status_code != 200:
+      logging.warning('Could not get image {}: HTTP {}'.format(url,
+        page.status_code))
+      return None
+    ext = image_type(page.content)
+    if not ext:
+      logging.warning('Unsupported image type: {}'.format(url))
+      return None
+    r = (ext, page.content)
+    memo.put(url, r)
+    return r
+
+  # fetches all urls concurrently, returns a dict url -> fetch() result
+  def fetch_all(self, urls):
+    urls = list(collections.OrderedDict.fromkeys(urls))
+    return dict(zip(urls, self.executor.map(self.fetch, urls)))
+
+  def close(self):
+    self.executor.shutdown()
+
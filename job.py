@@ -0,0 +1,174 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Building single books and batches of books.
+#
+# A batch spreads its books over a process pool. Each worker process
+# has its own Transport, but all share the per-host request budget
+# through a ratelimit.SharedHostLimiter. With the asyncio engine, all
+# books are built by one event loop instead (run_async()).
+
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing.util
+import time
+
+import aio
+import epub
+import transport
+
+
+def new_book(name, args):
+  book = epub.Book(args.out, args.build, name + '.archive')
+  book.epub_base_name = name
+  book.compress_level = args.compress_level
+  book.progressive = args.progressive
+  book.progressive_interval = args.progressive_interval
+  book.split_size = int(args.split_size * 1024)
+  book.split_elements = args.split_elements
+  book.compact = args.compact
+  return book
+
+
+def log_compaction(book):
+  if book.compact:
+    logging.info('Compaction saved {} bytes of {}'.format(
+      book.compact_saved(), book.epub_base_name))
+
+
+# progress is called with the book before it is downloaded
+def build_book(cls, url, name, args, tp, progress=None):
+  book = new_book(name, args)
+  if progress:
+    progress(book)
+  o = cls(url, book, args, tp)
+  o.download()
+  logging.info('Book written to: {}/{}.epub'.format(args.out,
+    book.epub_base_name))
+  book.write()
+  log_compaction(book)
+  return book
+
+
+# tp: an aio.Transport
+async def build_book_async(cls, url, name, args, tp):
+  book = await tp.run(new_book, name, args)
+  o = cls(url, book, args, tp)
+  await o.download_async(tp)
+  logging.info('Book written to: {}/{}.epub'.format(args.out,
+    book.epub_base_name))
+  await tp.run(book.write)
+  log_compaction(book)
+  return book
+
+
+worker_transport = None
+
+# The transport is closed when the worker process exits, which logs
+# its connection, cache and rate statistics.
+def init_worker(args, limiter):
+  global worker_transport
+  worker_transport = transport.Transport(args, limiter)
+  multiprocessing.util.Finalize(None, worker_transport.close, exitpriority=10)
+
+
+# runs in a worker process (or a daemon thread, with the daemon's
+# transport), errors are reported in the result
+def run_job(cls, url, name, args, tp=None, progress=None):
+  r = { 'url': url, 'name': name, 'ok': False, 'error': None,
+      'chapters': 0, 'seconds': 0.0, 'saved': 0, 'stats': None }
+  start = time.perf_counter()
+  try:
+    book = build_book(cls, url, name, args, tp or worker_transport,
+        progress)
+    r['ok'] = True
+    r['chapters'] = len(book.chapters)
+    r['saved'] = book.compact_saved()
+    if args.stats:
+      r['stats'] = (book.stats.report(), book.stats.summary())
+  except Exception as e:
+    logging.error('Building {} failed: {}'.format(url, e))
+    r['error'] = '{}: {}'.format(type(e).__name__, e)
+  r['seconds'] = time.perf_counter() - start
+  return r
+
+
+# jobs: list of (source class, url, name)
+def run_batch(jobs, args, limiter):
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers,
+      initializer=init_worker, initargs=(args, limiter)) as executor:
+    futures = [ executor.submit(run_job, cls, url, name, args)
+        for cls, url, name in jobs ]
+    return [ f.result() for f in futures ]
+
+
+async def run_job_async(cls, url, name, args, tp):
+  r = { 'url': url, 'name': name, 'ok': False, 'error': None,
+      'chapters': 0, 'seconds': 0.0, 'saved': 0, 'stats': None }
+  start = time.perf_counter()
+  try:
+    book = await build_book_async(cls, url, name, args, tp)
+    r['ok'] = True
+    r['chapters'] = len(book.chapters)
+    r['saved'] = book.compact_saved()
+    if args.stats:
+      r['stats'] = (book.stats.report(), book.stats.summary())
+  except Exception as e:
+    logging.error('Building {} failed: {}'.format(url, e))
+    r['error'] = '{}: {}'.format(type(e).__name__, e)
+  r['seconds'] = time.perf_counter() - start
+  return r
+
+
+async def run_batch_async(jobs, args):
+  tp = aio.Transport(args)
+  tp.start()
+  try:
+    return await asyncio.gather(*[ run_job_async(cls, url, name, args, tp)
+        for cls, url, name in jobs ])
+  finally:
+    tp.close()
+
+
+# Builds all books in one process with one event loop, the books'
+# requests are in flight concurrently.
+def run_async(jobs, args):
+  return asyncio.run(run_batch_async(jobs, args))
+
+
+def read_urls(f):
+  l = []
+  for line in f:
+    line = line.strip()
+    if line and not line.startswith('#'):
+      l.append(line)
+  return l
+
+
+# appends a counter to repeated names
+def unique_names(names):
+  seen = {}
+  r = []
+  for name in names:
+    n = seen.get(name, 0) + 1
+    seen[name] = n
+    if n > 1:
+      name = '{}_{}'.format(name, n)
+    r.append(name)
+  return r
+
+
+def summary(results):
+  l = [ '{:<24} {:<6} {:>8} {:>10} {:>10}  {}'.format('book', 'status',
+    'chapters', 'seconds', 'saved', 'url / error') ]
+  for r in results:
+    # bytes saved by --compact
+    l.append('{:<24} {:<6} {:>8} {:>10.1f} {:>10}  {}'.format(r['name'],
+      'ok' if r['ok'] else 'FAILED', r['chapters'], r['seconds'],
+      r.get('saved', 0), r['url'] if r['ok'] else r['error']))
+  ok = sum(1 for r in results if r['ok'])
+  l.append('{} of {} books built, {} failed'.format(ok, len(results),
+    len(results) - ok))
+  return '\n'.join(l)
+
@@ -0,0 +1,136 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Staged execution of a book's chapters: fetch -> transform -> assemble.
+#
+# A few fetcher threads get the pages and put them into the bounded
+# 'fetched' queue, in order of completion. A dispatcher thread starts
+# the transform of each page (e.g. by submitting it to a process
+# pool) and puts the pending result into the bounded 'transformed'
+# queue. The calling thread assembles the items in order of their
+# index, thus chapter numbers don't depend on completion order.
+#
+# A full queue blocks its producer (backpressure). Additionally, a
+# window limits the number of items between the start of their fetch
+# and their assembly, such that the items held back for reordering
+# are bounded, too. Queue depths are sampled into the book's stats.
+
+import concurrent.futures
+import queue
+import threading
+
+
+class Queue(object):
+
+  def __init__(self, name, maxsize, stats):
+    self.name = name
+    self.q = queue.Queue(maxsize)
+    self.stats = stats
+
+  def put(self, item):
+    self.q.put(item)
+    self.stats.sample(self.name, self.q.qsize())
+
+  def get(self, timeout=None):
+    return self.q.get(timeout=timeout)
+
+  def drain(self):
+    l = []
+    while True:
+      try:
+        l.append(self.q.get_nowait())
+      except queue.Empty:
+        return l
+
+
+# fetch(i, x) returns a page, transform(i, x, page) something that
+# is passed to assemble(i, x, page, pending) - e.g. a future. Errors
+# of fetch or transform are raised by run() when their item is due.
+# transform must not wait for the assembly of an item, since earlier
+# items may still be queued behind it.
+class Pipeline(object):
+
+  def __init__(self, fetch, transform, assemble, stats, fetchers=4, depth=8):
+    self.fetch = fetch
+    self.transform = transform
+    self.assemble = assemble
+    self.stats = stats
+    self.fetchers = max(1, fetchers)
+    self.depth = max(1, depth)
+    self.fetched = Queue('fetched', self.depth, stats)
+    self.transformed = Queue('transformed', self.depth, stats)
+    self.window = threading.Semaphore(self.fetchers + 2 * self.depth)
+    self.stopped = threading.Event()
+    self.lock = threading.Lock()
+    self.items = None
+
+  def fetch_loop(self):
+    while True:
+      self.window.acquire()
+      if self.stopped.is_set():
+        return
+      with self.lock:
+        item = next(self.items, None)
+      if not item:
+        return
+      i, x = item
+      try:
+        self.fetched.put((i, x, self.fetch(i, x), None))
+      except Exception as e:
+        self.fetched.put((i, x, None, e))
+
+  def dispatch_loop(self, n):
+    while n and not self.stopped.is_set():
+      try:
+        i, x, page, error = self.fetched.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      n -= 1
+      pending = None
+      if not error:
+        try:
+          pending = self.transform(i, x, page)
+        except Exception as e:
+          error = e
+      self.transformed.put((i, x, page, pending, error))
+
+  # items is a list of (index, argument), in order of assembly
+  def run(self, items):
+    self.items = iter(items)
+    threads = [ threading.Thread(target=self.fetch_loop)
+        for k in range(self.fetchers) ]
+    threads.append(threading.Thread(target=self.dispatch_loop,
+      args=(len(items),)))
+    for t in threads:
+      t.start()
+    held = {}
+    try:
+      for i, x in items:
+        while i not in held:
+          r = self.transformed.get()
+          held[r[0]] = r
+        self.stats.sample('reorder', len(held) - 1)
+        i, x, page, pending, error = held.pop(i)
+        if error:
+          raise error
+        self.assemble(i, x, page, pending)
+        self.window.release()
+    except BaseException:
+      self.stop(threads, list(held.values()))
+      raise
+    for t in threads:
+      t.join()
+
+  def stop(self, threads, held):
+    self.stopped.set()
+    for t in threads:
+      self.window.release()
+    while True:
+      for r in held + self.fetched.drain() + self.transformed.drain():
+        if isinstance(r[3], concurrent.futures.Future):
+          r[3].cancel()
+      held = []
+      threads = [ t for t in threads if t.is_alive() ]
+      if not threads:
+        return
+      threads[0].join(0.1)
@@ -0,0 +1,259 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import urllib.parse
+
+
+# Takes one token from a bucket that had tokens at time stamp and
+# returns the new number of tokens and how long to wait for the
+# taken one - negative token counts are reservations.
+def reserve(tokens, stamp, now, rate, burst):
+  tokens = min(burst, tokens + (now - stamp) * rate) - 1.0
+  delay = 0.0
+  if tokens < 0:
+    delay = -tokens / rate
+  return tokens, delay
+
+
+class TokenBucket(object):
+
+  def __init__(self, rate, burst = 1.0):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.stamp = time.monotonic()
+    self.cond = threading.Condition()
+    # (0 for urgent callers else 1, arrival) of the waiting callers
+    self.waiting = []
+    self.arrivals = itertools.count()
+
+  # Takes one token, waiting until one is available. Callers get
+  # their tokens in order of arrival, but urgent ones before all
+  # others. Returns the time waited.
+  def acquire(self, urgent = False):
+    start = time.monotonic()
+    waited = False
+    with self.cond:
+      entry = (0 if urgent else 1, next(self.arrivals))
+      heapq.heappush(self.waiting, entry)
+      while True:
+        now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        if self.waiting[0] == entry and tokens >= 1.0:
+          break
+        timeout = None
+        if self.waiting[0] == entry:
+          timeout = (1.0 - tokens) / self.rate
+        self.cond.wait(timeout)
+        waited = True
+      heapq.heappop(self.waiting)
+      self.tokens = tokens - 1.0
+      self.stamp = now
+      self.cond.notify_all()
+    return time.monotonic() - start if waited else 0.0
+
+
+class HostLimiter(object):
+
+  def __init__(self, rate, burst = 1.0):
+    self.rate = rate
+    self.burst = burst
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def bucket(self, host):
+    with self.lock:
+      b = self.buckets.get(host)
+      if not b:
+        b = TokenBucket(self.rate, self.burst)
+        self.buckets[host] = b
+      return b
+
+  def acquire(self, url, urgent = False):
+    host = urllib.parse.urlsplit(url).netloc
+    return self.bucket(host).acquire(urgent)
+
+  # feedback of a finished request, status is None on errors
+  def done(self, url, latency, status):
+    pass
+
+  # the retry sleeps anyway
+  def pause(self, url, seconds):
+    pass
+
+  def log(self):
+    pass
+
+
+# Like HostLimiter, but the buckets live in a multiprocessing manager
+# such that the budget of a host is shared by all processes that got
+# a copy of the limiter (e.g. via a pool initializer).
+class SharedHostLimiter(object):
+
+  def __init__(self, manager, rate, burst = 1.0):
+    self.rate = rate
+    self.burst = burst
+    self.buckets = manager.dict()
+    self.lock = manager.Lock()
+
+  # urgent requests aren't preferred across processes
+  def acquire(self, url, urgent = False):
+    host = urllib.parse.urlsplit(url).netloc
+    with self.lock:
+      now = time.monotonic()
+      tokens, stamp = self.buckets.get(host, (self.burst, now))
+      tokens, delay = reserve(tokens, stamp, now, self.rate, self.burst)
+      self.buckets[host] = (tokens, now)
+    if delay > 0:
+      time.sleep(delay)
+    return delay
+
+  def done(self, url, latency, status):
+    pass
+
+  # the retry sleeps anyway
+  def pause(self, url, seconds):
+    pass
+
+  def log(self):
+    pass
+
+
+# HostLimiter for coroutines of one event loop, which makes a lock
+# unnecessary.
+class AsyncHostLimiter(object):
+
+  def __init__(self, rate, burst = 1.0):
+    self.rate = rate
+    self.burst = burst
+    self.buckets = {}
+
+  # coroutines get their tokens in order of their calls, the
+  # urgent ones aren't preferred
+  async def acquire(self, url, urgent = False):
+    host = urllib.parse.urlsplit(url).netloc
+    now = time.monotonic()
+    tokens, stamp = self.buckets.get(host, (self.burst, now))
+    tokens, delay = reserve(tokens, stamp, now, self.rate, self.burst)
+    self.buckets[host] = (tokens, now)
+    if delay > 0:
+      await asyncio.sleep(delay)
+    return delay
+
+  def done(self, url, latency, status):
+    pass
+
+  def pause(self, url, seconds):
+    pass
+
+  def log(self):
+    pass
+
+
+
+# responses that ask to slow down
+throttle_statuses = (429, 503)
+
+class HostState(object):
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.tokens = burst
+    self.stamp = time.monotonic()
+    # allowed number of concurrent requests, grows by fractions
+    self.limit = 1.0
+    self.active = 0
+    self.urgent = 0
+    self.blocked_until = 0.0
+    self.min_latency = None
+    self.throttled = 0
+
+
+# Per-host AIMD control of request rate and concurrency. Healthy
+# responses raise the rate additively (and the concurrency by about
+# one per limit responses). Throttling (429/503), server errors and
+# failed requests halve both, latencies far above the best seen one
+# cut the rate a bit. A Retry-After blocks the host via pause().
+class AdaptiveHostLimiter(object):
+
+  def __init__(self, rate, max_rate, max_concurrency, burst = 1.0):
+    self.initial_rate = rate
+    self.max_rate = max(rate, max_rate)
+    self.min_rate = rate / 16
+    self.step = rate / 8
+    self.max_concurrency = max(1, max_concurrency)
+    self.latency_factor = 4.0
+    self.burst = burst
+    self.hosts = {}
+    self.cond = threading.Condition()
+
+  def state(self, host):
+    h = self.hosts.get(host)
+    if not h:
+      h = HostState(self.initial_rate, self.burst)
+      self.hosts[host] = h
+    return h
+
+  # Waits for a free slot, the end of a pause and a token. Waiting
+  # urgent requests get the free slots first.
+  def acquire(self, url, urgent = False):
+    host = urllib.parse.urlsplit(url).netloc
+    start = time.monotonic()
+    with self.cond:
+      h = self.state(host)
+      if urgent:
+        h.urgent += 1
+      while True:
+        now = time.monotonic()
+        if (h.active < int(h.limit) and now >= h.blocked_until
+            and (urgent or not h.urgent)):
+          break
+        self.cond.wait(max(0.01, h.blocked_until - now)
+            if now < h.blocked_until else None)
+      if urgent:
+        h.urgent -= 1
+        self.cond.notify_all()
+      h.active += 1
+      h.tokens, delay = reserve(h.tokens, h.stamp, now, h.rate, self.burst)
+      h.stamp = now
+    if delay > 0:
+      time.sleep(delay)
+    return time.monotonic() - start
+
+  def done(self, url, latency, status):
+    host = urllib.parse.urlsplit(url).netloc
+    with self.cond:
+      h = self.state(host)
+      h.active -= 1
+      if status is None or status in throttle_statuses or status >= 500:
+        h.throttled += 1
+        h.rate = max(self.min_rate, h.rate / 2)
+        h.limit = max(1.0, h.limit / 2)
+      elif h.min_latency and latency > self.latency_factor * h.min_latency:
+        h.rate = max(self.min_rate, h.rate * 0.9)
+      else:
+        h.rate = min(self.max_rate, h.rate + self.step)
+        h.limit = min(self.max_concurrency, h.limit + 1 / h.limit)
+      if status is not None and status < 500:
+        h.min_latency = min(h.min_latency or latency, latency)
+      self.cond.notify_all()
+
+  def pause(self, url, seconds):
+    host = urllib.parse.urlsplit(url).netloc
+    with self.cond:
+      h = self.state(host)
+      h.blocked_until = max(h.blocked_until, time.monotonic() + seconds)
+
+  def log(self):
+    with self.cond:
+      for host in sorted(self.hosts):
+        h = self.hosts[host]
+        logging.info('{}: converged to {:.2f} requests/s, {} concurrent, '
+            'throttled {} times'.format(host, h.rate, int(h.limit),
+              h.throttled))
@@ -0,0 +1,115 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Per-phase timing and resource accounting of a book build.
+#
+# Phases may run concurrently (e.g. several fetches), thus their wall
+# times are cumulative and may add up to more than the elapsed time.
+# CPU time is measured per thread.
+
+import resource
+import threading
+import time
+import tracemalloc
+
+
+class Phase(object):
+
+  def __init__(self, stats, name, bytes_in=0):
+    self.stats = stats
+    self.name = name
+    self.bytes_in = bytes_in
+    self.bytes_out = 0
+    # seconds that are accounted in another phase
+    self.excluded = 0.0
+
+  def __enter__(self):
+    self.wall = time.perf_counter()
+    self.cpu = time.thread_time()
+    return self
+
+  def __exit__(self, *args):
+    self.stats.add(self.name, time.perf_counter() - self.wall - self.excluded,
+        time.thread_time() - self.cpu, self.bytes_in, self.bytes_out)
+
+
+# Passed instead of a Stats object to an operation (e.g. a fetch),
+# tallies the seconds the operation accounts in the 'wait' phase.
+class WaitTally(object):
+
+  def __init__(self, stats):
+    self.stats = stats
+    self.wait = 0.0
+
+  def add(self, name, wall, *args):
+    if name == 'wait':
+      self.wait += wall
+    self.stats.add(name, wall, *args)
+
+
+class Stats(object):
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.phases = {}
+    # queue name -> depth samples (count, sum, max)
+    self.queues = {}
+    self.start = time.perf_counter()
+    self.elapsed = None
+
+  def phase(self, name, bytes_in=0):
+    return Phase(self, name, bytes_in)
+
+  def add(self, name, wall, cpu=0.0, bytes_in=0, bytes_out=0):
+    with self.lock:
+      p = self.phases.get(name)
+      if not p:
+        p = { 'count': 0, 'wall': 0.0, 'cpu': 0.0,
+            'bytes_in': 0, 'bytes_out': 0 }
+        self.phases[name] = p
+      p['count'] += 1
+      p['wall'] += wall
+      p['cpu'] += cpu
+      p['bytes_in'] += bytes_in
+      p['bytes_out'] += bytes_out
+
+  def sample(self, name, depth):
+    with self.lock:
+      q = self.queues.get(name)
+      if not q:
+        q = { 'count': 0, 'sum': 0, 'max': 0 }
+        self.queues[name] = q
+      q['count'] += 1
+      q['sum'] += depth
+      q['max'] = max(q['max'], depth)
+
+  def finish(self):
+    self.elapsed = time.perf_counter() - self.start
+
+  def report(self, top=10):
+    r = { 'elapsed': self.elapsed, 'phases': self.phases,
+        'queues': self.queues,
+        # KiB on Linux
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }
+    if tracemalloc.is_tracing():
+      snapshot = tracemalloc.take_snapshot()
+      r['top_allocators'] = [ { 'where': str(s.traceback), 'size': s.size,
+        'count': s.count } for s in snapshot.statistics('lineno')[:top] ]
+    return r
+
+  def summary(self):
+    l = [ '{:<16} {:>6} {:>10} {:>10} {:>12} {:>12}'.format('phase',
+      'count', 'wall [s]', 'cpu [s]', 'bytes in', 'bytes out') ]
+    for name in sorted(self.phases, key=lambda k: -self.phases[k]['wall']):
+      p = self.phases[name]
+      l.append('{:<16} {:>6} {:>10.3f} {:>10.3f} {:>12} {:>12}'.format(name,
+        p['count'], p['wall'], p['cpu'], p['bytes_in'], p['bytes_out']))
+    for name in sorted(self.queues):
+      q = self.queues[name]
+      l.append('queue {:<10} depth: mean {:.1f}, max {} ({} samples)'.format(
+        name, q['sum'] / q['count'], q['max'], q['count']))
+    if self.elapsed is not None:
+      l.append('elapsed: {:.3f} s, peak RSS: {} KiB'.format(self.elapsed,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return '\n'.join(l)
+
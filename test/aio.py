@@ -0,0 +1,157 @@
+import aio
+import gb_de
+import job
+import test.server
+import test.gb_de
+
+import unittest
+import asyncio
+import requests
+import logging
+import shutil
+import tempfile
+import time
+import zlib
+import zipfile
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Args(test.gb_de.Args):
+
+  def __init__(self, out):
+    super().__init__()
+    self.rate = 1000.0
+    self.jobs = 8
+    self.out = out
+    self.build = 'staged'
+    self.compress_level = 1
+    self.stats = True
+    self.dump = False
+
+
+toc = ('<html><body><ul class="gbnav">'
+    '<li><a href="/dmoe_1.html">1</a></li>'
+    '<li><a href="/dmoe_2.html">2</a></li>'
+    '<li><a href="/dmoe_2.html?again">3</a></li>'
+    '</ul></body></html>')
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    self.args = Args(self.base_path)
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def run_transport(self, f):
+    async def g():
+      tp = aio.Transport(self.args)
+      tp.start()
+      try:
+        return await f(tp), tp
+      finally:
+        tp.close()
+    return asyncio.run(g())
+
+  def test_keep_alive(self):
+    async def f(tp):
+      return [ await tp.aget(s.url('dmoe_1.html')) for i in range(5) ]
+    with test.server.Server() as s:
+      pages, tp = self.run_transport(f)
+    with open('test/in/dmoe_1.html', 'rb') as g:
+      self.assertEqual(pages[0].content, g.read())
+    self.assertEqual(pages[0].headers['Content-Type'], 'text/html; charset=utf-8')
+    self.assertEqual(gb_de.page_encoding(pages[0]), 'utf-8')
+    self.assertEqual(tp.stats.requests['127.0.0.1'], 5)
+    self.assertEqual(tp.stats.connections['127.0.0.1'], 1)
+
+  def test_concurrent(self):
+    async def f(tp):
+      return await asyncio.gather(*[ tp.aget(s.url('dmoe_2.html?{}'.format(i)))
+        for i in range(16) ])
+    with test.server.Server(latency=0.3) as s:
+      start = time.perf_counter()
+      pages, tp = self.run_transport(f)
+      elapsed = time.perf_counter() - start
+    self.assertEqual([ p.status_code for p in pages ], [ 200 ] * 16)
+    # 2 rounds of 8 connections
+    self.assertLess(elapsed, 1.5)
+    self.assertEqual(tp.stats.connections['127.0.0.1'], 8)
+
+  def test_status(self):
+    async def f(tp):
+      return await tp.aget(s.url('missing.html'))
+    with test.server.Server() as s:
+      page, tp = self.run_transport(f)
+    self.assertEqual(page.status_code, 404)
+    self.assertEqual(page.content, b'not found')
+
+  def test_redirect(self):
+    async def f(tp):
+      return await tp.aget(s.url('old.html'))
+    with test.server.Server(redirects={ 'old.html': '/moved.html',
+        'moved.html': 'dmoe_1.html', 'loop.html': '/loop.html' }) as s:
+      page, tp = self.run_transport(f)
+      with self.assertRaises(requests.TooManyRedirects):
+        self.run_transport(lambda tp: tp.aget(s.url('loop.html')))
+    self.assertEqual(page.status_code, 200)
+    self.assertEqual(page.url, s.url('dmoe_1.html'))
+    with open('test/in/dmoe_1.html', 'rb') as g:
+      self.assertEqual(page.content, g.read())
+
+  def test_timeout(self):
+    self.args.read_timeout = 0.1
+    async def f(tp):
+      return await tp.aget(s.url('dmoe_1.html'))
+    with test.server.Server(latency=0.5) as s:
+      with self.assertRaises(asyncio.TimeoutError):
+        self.run_transport(f)
+
+  def test_cancel(self):
+    async def f(tp):
+      t = asyncio.ensure_future(tp.aget(s.url('dmoe_1.html')))
+      await asyncio.sleep(0.1)
+      t.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await t
+      # the interrupted connection isn't reused
+      self.assertEqual(tp.pools[('http', s.url('')[7:-1])].idle, [])
+      return await tp.aget(s.url('dmoe_1.html'))
+    with test.server.Server(latency=0.3) as s:
+      page, tp = self.run_transport(f)
+    self.assertEqual(page.status_code, 200)
+    self.assertEqual(tp.stats.connections['127.0.0.1'], 2)
+
+  def test_body(self):
+    async def f():
+      tp = aio.Transport(self.args)
+      r = asyncio.StreamReader()
+      r.feed_data(b'4\r\nabcd\r\n3;x=y\r\nefg\r\n0\r\n\r\n')
+      r.feed_eof()
+      return await tp.read_body(r, 200, { 'Transfer-Encoding': 'chunked' })
+    self.assertEqual(asyncio.run(f()), b'abcdefg')
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    self.assertEqual(aio.decode_body(c.compress(b'hello') + c.flush(),
+      'gzip'), b'hello')
+    self.assertEqual(aio.decode_body(zlib.compress(b'hello'), 'deflate'),
+      b'hello')
+
+  def test_run_async(self):
+    with open(self.base_path + '/toc.html', 'w') as f:
+      f.write(toc)
+    for n in [ 'dmoe_1.html', 'dmoe_2.html' ]:
+      shutil.copy('test/in/' + n, self.base_path)
+    with test.server.Server(self.base_path, latency=0.05) as s:
+      results = job.run_async([ (gb_de.GB_DE, s.url('toc.html'), 'a'),
+        (gb_de.GB_DE, s.url('missing.html'), 'b') ], self.args)
+    self.assertTrue(results[0]['ok'])
+    self.assertEqual(results[0]['chapters'], 3)
+    self.assertFalse(results[1]['ok'])
+    with zipfile.ZipFile(self.base_path + '/a.epub') as z:
+      self.assertIsNone(z.testzip())
+      self.assertTrue(z.read('OPS/chapter/0002.html').find(
+        'Schwiegerpapa'.encode('utf-8')) > 0)
+
+if __name__ == '__main__':
+  unittest.main()
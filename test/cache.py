@@ -0,0 +1,109 @@
+
+import cache
+import transport
+import test.server
+import test.transport
+
+import unittest
+import logging
+import shutil
+import tempfile
+import time
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Store(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def test_put_get(self):
+    s = cache.Store(self.base_path, 1000)
+    self.assertIsNone(s.get('a'))
+    s.put('a', { 'x': 1 }, b'hello')
+    self.assertEqual(s.get('a'), ({ 'x': 1 }, b'hello'))
+    s = cache.Store(self.base_path, 1000)
+    self.assertEqual(s.size, 5)
+    self.assertEqual(s.get('a'), ({ 'x': 1 }, b'hello'))
+
+  def test_lru(self):
+    s = cache.Store(self.base_path, 25)
+    s.put('a', {}, b'0123456789')
+    time.sleep(0.01)
+    s.put('b', {}, b'0123456789')
+    time.sleep(0.01)
+    s.get('a')
+    s.put('c', {}, b'0123456789')
+    self.assertIsNotNone(s.get('a'))
+    self.assertIsNone(s.get('b'))
+    self.assertIsNotNone(s.get('c'))
+    self.assertEqual(s.size, 20)
+
+  def test_stats(self):
+    s = cache.Store(self.base_path, 1000)
+    self.assertEqual(s.stats()['entries'], 0)
+    s.put('a', {}, b'hello')
+    s.put('b', {}, b'world!')
+    d = s.stats()
+    self.assertEqual(d['entries'], 2)
+    self.assertEqual(d['bytes'], 11)
+    self.assertTrue(d['oldest'] <= d['newest'])
+    self.assertTrue(cache.format_stats('x', d).find('entries: 2') > 0)
+
+  def test_chapter_cache(self):
+    c = cache.ChapterCache(self.base_path, 1000)
+    k = c.key('abc', [ 'GB_DE', 1 ])
+    self.assertNotEqual(k, c.key('abc', [ 'GB_DE', 2 ]))
+    self.assertIsNone(c.get(k))
+    c.put(k, { 'title': 't' }, b'<html/>')
+    self.assertEqual(c.get(k), ({ 'title': 't' }, b'<html/>'))
+    self.assertEqual(c.counts, { 'hit': 1, 'miss': 1 })
+    self.assertIs(cache.chapter_cache(self.base_path, 1000),
+        cache.chapter_cache(self.base_path, 1000))
+
+
+class Http(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    self.args = test.transport.Args()
+    self.args.cache = self.base_path
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def test_hit(self):
+    with test.server.Server() as s:
+      t = transport.Transport(self.args)
+      a = t.get(s.url('dmoe_2.html'))
+      b = t.get(s.url('dmoe_2.html'))
+      self.assertEqual(len(s.hits()), 1)
+      self.assertEqual(a.text, b.text)
+      self.assertTrue(b.from_cache)
+      self.assertEqual(t.cache.counts, { 'hit': 1, 'revalidated': 0, 'miss': 1 })
+
+  def test_revalidate(self):
+    self.args.cache_ttl = 0
+    with test.server.Server() as s:
+      t = transport.Transport(self.args)
+      a = t.get(s.url('dmoe_2.html'))
+      b = t.get(s.url('dmoe_2.html'))
+      self.assertEqual(len(s.hits()), 2)
+      self.assertEqual(a.content, b.content)
+      self.assertEqual(t.cache.counts['revalidated'], 1)
+
+  def test_offline(self):
+    with test.server.Server() as s:
+      t = transport.Transport(self.args)
+      t.get(s.url('dmoe_1.html'))
+      self.args.offline = True
+      self.args.cache_ttl = 0
+      t = transport.Transport(self.args)
+      self.assertTrue(t.get(s.url('dmoe_1.html')).from_cache)
+      with self.assertRaises(RuntimeError):
+        t.get(s.url('dmoe_2.html'))
+      self.assertEqual(len(s.hits()), 1)
+
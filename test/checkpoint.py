@@ -0,0 +1,55 @@
+import checkpoint
+
+import unittest
+import shutil
+import tempfile
+
+class Journal(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    self.filename = self.base_path + '/manifest.json'
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def test_replay(self):
+    m = checkpoint.Manifest(self.filename, 'u')
+    m.meta = { 'title': 't' }
+    m.done(1, 'u1', 'a', 'd1', 'o1', 1, [ ('png', 'x') ])
+    m.done(2, 'u2', 'b', 'd2', 'o2', 1, [ ('png', 'x'), ('jpg', 'y') ],
+        styles={ 'c': 'color: red' })
+    m.done(1, 'u1', 'c', 'd3', 'o3', 0, [ ('jpg', 'y') ], parts=2)
+    with open(self.filename) as f:
+      self.assertEqual(len(f.readlines()), 4)
+    n = checkpoint.Manifest(self.filename, 'u')
+    self.assertTrue(n.load())
+    self.assertEqual(n.meta, m.meta)
+    self.assertEqual(n.chapters, m.chapters)
+    self.assertEqual(n.images, [ ('jpg', 'y') ])
+    self.assertEqual(n.chapters[1]['parts'], 2)
+    with open(self.filename) as f:
+      self.assertEqual(len(f.readlines()), 1)
+
+  def test_interrupted(self):
+    m = checkpoint.Manifest(self.filename, 'u')
+    m.done(1, 'u1', 'a', 'd1')
+    m.done(2, 'u2', 'b', 'd2')
+    with open(self.filename, 'a') as f:
+      f.write('{"chapter": 3, "ent')
+    n = checkpoint.Manifest(self.filename, 'u')
+    self.assertTrue(n.load())
+    self.assertEqual(sorted(n.chapters), [ 1, 2 ])
+    self.assertFalse(checkpoint.Manifest(self.filename, 'v').load())
+
+  def test_overrides(self):
+    class Book(object):
+      title = 'T'
+      uuid = 'x'
+      authors = [ ('R', 'M', 'aut') ]
+    m = checkpoint.Manifest(self.filename, 'u')
+    m.set_meta(Book(), [ 'T', None, None ])
+    n = checkpoint.Manifest(self.filename, 'u')
+    self.assertTrue(n.load())
+    self.assertEqual(n.overrides, [ 'T', None, None ])
+    self.assertEqual(n.meta['authors'], [ [ 'R', 'M', 'aut' ] ])
@@ -0,0 +1,70 @@
+
+import cleanup
+import gb_de
+
+import unittest
+import lxml.etree
+import lxml.html
+
+class Basic(unittest.TestCase):
+
+  def test_xpath_equivalence(self):
+    with open('test/in/dmoe_2.html', 'rb') as f:
+      s = f.read()
+    a = lxml.html.fromstring(s).xpath('//div[@id="gutenb"]')[0]
+    b = lxml.html.fromstring(s).xpath('//div[@id="gutenb"]')[0]
+    for e in a.xpath('.//*[@class]'):
+      e.attrib.pop('class')
+    for e in a.xpath('.//a[not(@href)]'):
+      e.drop_tag()
+    for e in a.xpath('.//p[not(*)][not(normalize-space())]'):
+      e.getparent().remove(e)
+    gb_de.GB_DE.cleanup_rules.apply(b)
+    self.assertEqual(lxml.html.tostring(a), lxml.html.tostring(b))
+
+  def test_children_first(self):
+    div = lxml.html.fromstring('<div><p class="x"><a name="1"> </a></p><p>\xa0</p><p><a href="y">z</a></p></div>')
+    gb_de.GB_DE.cleanup_rules.apply(div)
+    self.assertEqual(lxml.html.tostring(div, encoding='unicode'),
+        '<div><p>\xa0</p><p><a href="y">z</a></p></div>')
+
+  def test_comment(self):
+    div = lxml.html.fromstring('<div><p><!-- x --> </p><b><!-- y --></b></div>')
+    cleanup.Engine([ cleanup.RemoveEmpty(['p']),
+      cleanup.Unwrap(['b']) ]).apply(div)
+    self.assertEqual(lxml.html.tostring(div), b'<div><!-- y --></div>')
+
+  def test_strip_whitespace(self):
+    body = lxml.etree.fromstring('<body><div>\n  <p>\n a  <i>b</i> <b>c</b>\n</p>\n  '
+        '<pre>  x\n  y </pre>  <p> </p><p>\xa0</p>\n</div></body>')
+    cleanup.Engine([ cleanup.StripWhitespace() ]).apply(body)
+    self.assertEqual(lxml.etree.tostring(body[0], encoding='unicode'),
+        '<div><p> a <i>b</i> <b>c</b> </p><pre>  x\n  y </pre><p/><p>\xa0</p></div>')
+
+  def test_hoist_style(self):
+    div = lxml.etree.fromstring('<div><p style="color : red;">a</p>'
+        '<p class="x" style=" color: red ">b</p><p style=";">c</p></div>')
+    classes = {}
+    cleanup.Engine([ cleanup.HoistStyle(classes) ]).apply(div)
+    c = classes['color: red']
+    self.assertEqual(list(classes), [ 'color: red' ])
+    self.assertEqual(lxml.etree.tostring(div, encoding='unicode'),
+        '<div><p class="{0}">a</p><p class="x {0}">b</p><p>c</p></div>'.format(c))
+
+  def test_hoist_repeated(self):
+    div = lxml.etree.fromstring('<div><p style="color:red">a</p>'
+        '<p style="margin: 0">b</p><p style="color: red;">c</p></div>')
+    repeated = cleanup.repeated_styles(div)
+    self.assertEqual(repeated, { 'color: red' })
+    classes = {}
+    cleanup.Engine([ cleanup.HoistStyle(classes, repeated) ]).apply(div)
+    self.assertEqual(lxml.etree.tostring(div, encoding='unicode'),
+        '<div><p class="{0}">a</p><p style="margin: 0">b</p>'
+        '<p class="{0}">c</p></div>'.format(classes['color: red']))
+
+  def test_drop_empty(self):
+    div = lxml.etree.fromstring('<div>a<span> </span>b<p><span/></p>c'
+        '<p id="x"/><b><i/>d</b><p>\xa0</p></div>')
+    cleanup.Engine([ cleanup.DropEmpty([ 'p', 'span', 'b', 'i' ]) ]).apply(div)
+    self.assertEqual(lxml.etree.tostring(div, encoding='unicode'),
+        '<div>a bc<p id="x"/><b>d</b><p>\xa0</p></div>')
@@ -0,0 +1,101 @@
+import daemon
+import test.server
+import test.job
+
+import argparse
+import unittest
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import json
+import os.path
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    self.socket = self.base_path + '/socket'
+    self.spool = self.base_path + '/spool'
+    os.mkdir(self.spool)
+    args = test.job.Args(self.base_path)
+    self.daemon = daemon.Daemon(args,
+        lambda url: test.job.Source if url.startswith('http') else None,
+        lambda url: 'book')
+    self.thread = threading.Thread(target=self.daemon.serve,
+        args=(self.socket, self.spool, 0.05))
+    self.thread.start()
+    while not os.path.exists(self.socket):
+      time.sleep(0.01)
+
+  def tearDown(self):
+    daemon.request(self.socket, { 'op': 'shutdown' })
+    self.thread.join()
+    self.assertFalse(os.path.exists(self.socket))
+    shutil.rmtree(self.base_path)
+
+  def test_submit(self):
+    with test.server.Server(latency=0.2) as s:
+      ids = [ daemon.request(self.socket, { 'op': 'submit', 'url': s.url(n) })
+          for n in [ 'dmoe_1.html', 'missing.html', 'dmoe_2.html' ] ]
+      rs = [ daemon.request(self.socket, { 'op': 'wait', 'id': i })
+          for i in ids ]
+    self.assertEqual([ r['state'] for r in rs ], [ 'done', 'failed', 'done' ])
+    self.assertEqual(rs[1]['error'], 'RuntimeError: HTTP 404')
+    self.assertEqual(rs[2]['chapters'], 1)
+    # concurrent jobs get distinct names
+    self.assertEqual(len(set(r['name'] for r in rs)), 3)
+    for r in [ rs[0], rs[2] ]:
+      self.assertTrue(os.path.isfile('{}/{}.epub'.format(self.base_path,
+        r['name'])))
+    l = daemon.request(self.socket, { 'op': 'status' })
+    self.assertEqual(sorted(r['id'] for r in l), ids)
+    self.assertIn('failed', daemon.table(l))
+    # the connections are kept across jobs, one per worker
+    self.assertLessEqual(self.daemon.transport.stats.connections['127.0.0.1'], 2)
+
+  def test_errors(self):
+    with self.assertRaises(RuntimeError):
+      daemon.request(self.socket, { 'op': 'frobnicate' })
+    with self.assertRaises(RuntimeError):
+      daemon.request(self.socket, { 'op': 'submit', 'url': 'ftp://x' })
+    with self.assertRaises(RuntimeError):
+      daemon.request(self.socket, { 'op': 'status', 'id': 42 })
+    with self.assertRaises(RuntimeError):
+      self.daemon.serve(self.socket)
+
+  def test_spool(self):
+    with test.server.Server() as s:
+      with open(self.spool + '/a.job', 'w') as f:
+        json.dump({ 'url': s.url('dmoe_1.html'), 'name': 'spooled' }, f)
+      with open(self.spool + '/b.job', 'w') as f:
+        f.write('{ broken')
+      for i in range(200):
+        if len([ fn for fn in os.listdir(self.spool)
+            if fn.endswith('.status') ]) == 2:
+          break
+        time.sleep(0.05)
+    with open(self.spool + '/a.status') as f:
+      self.assertEqual(json.load(f)['state'], 'done')
+    with open(self.spool + '/b.status') as f:
+      self.assertEqual(json.load(f)['state'], 'failed')
+    self.assertEqual(sorted(os.listdir(self.spool)), [ 'a.status', 'b.status' ])
+    self.assertTrue(os.path.isfile(self.base_path + '/spooled.epub'))
+
+class Options(unittest.TestCase):
+
+  def test_submit_options(self):
+    defaults = dict((k, None) for k in daemon.job_options)
+    defaults.update(compress_level=6, compact=False, split_size=256)
+    args = argparse.Namespace(**defaults)
+    args.compress_level = 1
+    args.compact = True
+    args.out = '/tmp'
+    self.assertEqual(daemon.submit_options(args, defaults.get),
+        { 'compress_level': 1, 'compact': True, 'out': '/tmp' })
+
+if __name__ == '__main__':
+  unittest.main()
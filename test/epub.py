@@ -8,6 +8,7 @@ import os.path
 import lxml.etree
 import io
 import zipfile
+import hashlib
 
 logging.basicConfig(level = logging.DEBUG)
 
@@ -91,18 +92,18 @@ class OPF(unittest.TestCase):
     self.assertTrue(os.path.isfile(self.base_path + '/archive/OPS/chapter/0001.html'))
 
   def test_chapter_content(self):
-    ref = '''<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
-  <head>
-    <meta http-equiv="Content-Type" content="application/xhtml+xml; charset=utf-8"/>
-    <title>Der Mann ohne Eigenschaften</title>
-    <link href="book.css" rel="stylesheet" type="text/css"/>
-  </head>
-  <body>
-    <div>
-      <h1>23</h1>
-      <p>abcd</p>
-    </div>
-  </body>
+    ref = '''<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">\
+<head>\
+<meta http-equiv="Content-Type" content="application/xhtml+xml; charset=utf-8"/>\
+<title>Der Mann ohne Eigenschaften</title>\
+<link href="book.css" rel="stylesheet" type="text/css"/>\
+</head>\
+<body>\
+<div>\
+<h1>23</h1>\
+<p>abcd</p>\
+</div>\
+</body>\
 </html>'''
     x = lxml.etree.fromstring(ref)
     xb = io.BytesIO()
@@ -266,3 +267,384 @@ class Zip(unittest.TestCase):
            'mimetype']
     self.assertEqual(ref, l)
 
+
+
+class Stream(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    logging.debug('Tempdir is: %s', self.base_path)
+
+  def tearDown(self):
+    logging.debug('Removing %s', self.base_path)
+    shutil.rmtree(self.base_path)
+
+  def build(self, mode, name):
+    book = epub.Book(self.base_path, mode)
+    book.epub_base_name = name
+    book.title = 'Der Mann ohne Eigenschaften'
+    book.uuid = '4223xxx'
+    book.push_author('Robert', 'Musil')
+    divs = [ lxml.etree.fromstring('<div><h1>123</h1><p>lorum lipsum</p></div>') ]
+    book.push_chapter('Auch ein Mann ohne Eigenschaften hat einen Vater mit Eigenschaften', divs)
+    divs = [ lxml.etree.fromstring('<div><h1>23</h1><p>abcd</p></div>') ]
+    book.push_chapter('Woraus bemerkenswerter Weise nichts hervorgeht', divs)
+    return book
+
+  def check(self, name):
+    with zipfile.ZipFile(self.base_path + '/' + name + '.epub', 'r') as z:
+      l = z.infolist()
+      self.assertEqual(l[0].filename, 'mimetype')
+      self.assertEqual(l[0].compress_type, zipfile.ZIP_STORED)
+      self.assertEqual(sorted(i.filename for i in l),
+          ['META-INF/container.xml',
+           'OPS/book.css',
+           'OPS/book.ncx',
+           'OPS/book.opf',
+           'OPS/chapter/0000.html',
+           'OPS/chapter/0001.html',
+           'mimetype'])
+      s = z.read('OPS/chapter/0001.html').decode('utf-8')
+      self.assertTrue(s.find('abcd') > 0)
+
+  def test_stream(self):
+    book = self.build('stream', 'a')
+    self.assertTrue(os.path.isfile(self.base_path + '/a.epub.part'))
+    book.write()
+    self.assertFalse(os.path.exists(self.base_path + '/a.epub.part'))
+    self.assertFalse(os.path.exists(self.base_path + '/archive'))
+    self.check('a')
+
+  def test_memory(self):
+    book = self.build('memory', 'b')
+    self.assertEqual(os.listdir(self.base_path), [])
+    book.write()
+    self.check('b')
+
+  def test_interleaved(self):
+    a = self.build('stream', 'a')
+    b = self.build('memory', 'b')
+    b.write()
+    a.write()
+    self.check('a')
+    self.check('b')
+
+  def test_staged_order(self):
+    book = self.build('staged', 'c')
+    book.write()
+    self.check('c')
+
+  def test_compress(self):
+    for mode in [ 'staged', 'stream' ]:
+      for level in [ 0, 9 ]:
+        name = '{}_{}'.format(mode, level)
+        book = self.build(mode, name)
+        book.compress_level = level
+        book.write()
+        self.check(name)
+        with zipfile.ZipFile(self.base_path + '/' + name + '.epub') as z:
+          self.assertIsNone(z.testzip())
+          i = z.getinfo('OPS/book.opf')
+          if level:
+            self.assertEqual(i.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(i.compress_size, i.file_size)
+          else:
+            self.assertEqual(i.compress_type, zipfile.ZIP_STORED)
+
+
+  # a second write doesn't copy the members of the first one
+  def test_rewrite(self):
+    book = self.build('staged', 'd')
+    sizes = []
+    for level in [ 9, 0 ]:
+      book.compress_level = level
+      book.write()
+      self.check('d')
+      sizes.append(os.path.getsize(self.base_path + '/d.epub'))
+    self.assertLess(sizes[0], sizes[1])
+    ref = self.build('staged', 'e')
+    ref.compress_level = 0
+    ref.write()
+    self.assertEqual(sizes[1], os.path.getsize(self.base_path + '/e.epub'))
+
+class Progressive(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def spine(self, fn):
+    with zipfile.ZipFile(fn) as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual(z.namelist()[0], 'mimetype')
+      opf = lxml.etree.fromstring(z.read('OPS/book.opf'))
+      ncx = lxml.etree.fromstring(z.read('OPS/book.ncx'))
+      nav = ncx.findall('.//{http://www.daisy.org/z3986/2005/ncx/}navPoint')
+      refs = opf.findall('.//{http://www.idpf.org/2007/opf}itemref')
+      self.assertEqual(len(nav), len(refs))
+      return len(refs)
+
+  def test_refresh(self):
+    book = epub.Book(self.base_path)
+    book.title = 'Der Mann ohne Eigenschaften'
+    book.uuid = '4223xxx'
+    book.progressive = 2
+    book.progressive_interval = 0.0
+    fn = self.base_path + '/book.epub'
+    compressed = []
+    load_compressed = book.load_compressed
+    def f(name):
+      r = load_compressed(name)
+      if r:
+        compressed.append(name)
+      return r
+    book.load_compressed = f
+    for i in range(4):
+      divs = [ lxml.etree.fromstring('<div><p>{}</p></div>'.format(i)) ]
+      book.push_chapter('Chapter {}'.format(i), divs)
+      book.refresh()
+      if i == 0:
+        self.assertFalse(os.path.exists(fn))
+      else:
+        self.assertEqual(self.spine(fn), i + 1)
+        self.assertEqual(book.snapshot_chapters, i + 1)
+    book.refresh()
+    self.assertEqual(book.snapshot_chapters, 4)
+    book.write()
+    self.assertEqual(self.spine(fn), 4)
+    self.assertFalse(os.path.exists(fn + '.part'))
+    # chapters are compressed once, later copied from the snapshot
+    for i in range(4):
+      self.assertEqual(compressed.count('OPS/chapter/{:04d}.html'.format(i)), 1)
+    self.assertEqual(compressed.count('OPS/book.opf'), 4)
+    self.assertIn('snapshot', book.stats.phases)
+
+  def test_interval(self):
+    book = epub.Book(self.base_path)
+    book.title = 'x'
+    book.uuid = 'y'
+    book.progressive = 1
+    book.progressive_interval = 3600.0
+    for i in range(3):
+      book.push_chapter('c', [ lxml.etree.fromstring('<div/>') ])
+      book.refresh()
+    self.assertEqual(book.snapshot_chapters, 1)
+    book.write()
+    self.assertEqual(self.spine(self.base_path + '/book.epub'), 3)
+
+
+class Split(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    book = epub.Book(self.base_path)
+    self.book = book
+    book.title = 'Der Mann ohne Eigenschaften'
+    book.uuid = '4223xxx'
+    book.split_size = 200
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def div(self, n):
+    div = lxml.etree.fromstring('<div id="c">text<h1>Kapitel</h1>{}</div>'
+        .format(''.join('<p>Absatz {} {}</p>'.format(i, 'x' * 40)
+          for i in range(n))))
+    div.tail = 'tail'
+    return div
+
+  def text(self, names):
+    l = []
+    for name in names:
+      with open(self.base_path + '/archive/' + name, 'rb') as f:
+        root = lxml.etree.fromstring(f.read())
+      body = root.find('{http://www.w3.org/1999/xhtml}body')
+      l.append(''.join(body.itertext()))
+    return ''.join(l)
+
+  def test_push_chapter(self):
+    ref = epub.Book(self.base_path, archive_name='ref')
+    ref.push_chapter('a', [ self.div(10) ])
+    data = self.book.push_chapter('a', [ self.div(10) ])
+    self.book.push_chapter('b', [ self.div(1) ])
+    self.assertEqual(self.book.parts, [ 4, 1 ])
+    self.assertEqual(len(data), 4)
+    self.assertTrue(all(len(x) < 600 for x in data))
+    self.assertEqual(self.book.chapter_names(0)[1], 'OPS/chapter/0000_1.html')
+    with open(self.base_path + '/ref/OPS/chapter/0000.html', 'rb') as f:
+      root = lxml.etree.fromstring(f.read())
+    self.assertEqual(self.text(self.book.chapter_names(0)),
+        ''.join(root.find('{http://www.w3.org/1999/xhtml}body').itertext()))
+    self.assertEqual(self.book.digests[0],
+        hashlib.sha1(b''.join(data)).hexdigest())
+
+  def test_elements(self):
+    self.book.split_size = 0
+    self.book.split_elements = 5
+    self.book.push_chapter('a', [ self.div(10) ])
+    self.assertEqual(self.book.parts, [ 3 ])
+    self.book.split_elements = 0
+    self.book.push_chapter('b', [ self.div(10) ])
+    self.assertEqual(self.book.parts, [ 3, 1 ])
+
+  def test_stream(self):
+    data = self.book.push_chapter('a', [ self.div(10) ])
+    div = self.div(10)
+    blocks = [ div.text ] + list(div)
+    container = div.makeelement(div.tag, div.attrib)
+    self.book.push_chapter_stream('b', iter(blocks), container)
+    self.assertEqual(self.book.parts, [ 4, 4 ])
+    self.assertEqual(self.text(self.book.chapter_names(1)),
+        self.text(self.book.chapter_names(0))[:-len('tail')])
+
+  def linked_div(self):
+    div = self.div(10)
+    p = div.findall('p')
+    p[0].set('id', 'r0')
+    lxml.etree.SubElement(p[0], 'a', href='#n9').text = 'note'
+    lxml.etree.SubElement(p[1], 'a', href='#r0').text = 'up'
+    lxml.etree.SubElement(p[9], 'a', name='n9')
+    lxml.etree.SubElement(p[9], 'a', href='#r0').text = 'back'
+    return div
+
+  def links(self, names):
+    l = []
+    for name in names:
+      with open(self.base_path + '/archive/' + name, 'rb') as f:
+        root = lxml.etree.fromstring(f.read())
+      l.append([ e.get('href') for e in
+        root.iter('{http://www.w3.org/1999/xhtml}a') if e.get('href') ])
+    return l
+
+  # fragment links whose target is in another file of the chapter
+  def test_links(self):
+    data = self.book.push_chapter('a', [ self.linked_div() ])
+    div = self.linked_div()
+    container = div.makeelement(div.tag, div.attrib)
+    self.book.push_chapter_stream('b', iter([ div.text ] + list(div)),
+        container)
+    self.assertEqual(self.links(self.book.chapter_names(0)),
+        [ [ '0000_3.html#n9', '#r0' ], [], [], [ '0000.html#r0' ] ])
+    self.assertEqual(self.links(self.book.chapter_names(1)),
+        [ [ '0001_3.html#n9', '#r0' ], [], [], [ '0001.html#r0' ] ])
+    self.assertEqual(self.book.digests[0],
+        hashlib.sha1(b''.join(data)).hexdigest())
+    names = self.book.chapter_names(1)
+    digest = hashlib.sha1()
+    for name in names:
+      with open(self.base_path + '/archive/' + name, 'rb') as f:
+        digest.update(f.read())
+    self.assertEqual(self.book.digests[1], digest.hexdigest())
+    # not staged, the files are linked before they are added
+    book = epub.Book(self.base_path, 'memory')
+    book.epub_base_name = 'm'
+    book.title = 'x'
+    book.uuid = 'y'
+    book.split_size = 200
+    div = self.linked_div()
+    book.push_chapter_stream('b', iter([ div.text ] + list(div)), container)
+    book.write()
+    with zipfile.ZipFile(self.base_path + '/m.epub') as z:
+      self.assertIn(b'href="0000_3.html#n9"', z.read('OPS/chapter/0000.html'))
+
+  def test_toc(self):
+    self.book.push_chapter('a', [ self.div(10) ])
+    self.book.push_chapter('b', [ self.div(1) ])
+    self.book.write()
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertIsNone(z.testzip())
+      names = z.namelist()
+      opf = lxml.etree.fromstring(z.read('OPS/book.opf'))
+      ncx = lxml.etree.fromstring(z.read('OPS/book.ncx'))
+    self.assertIn('OPS/chapter/0000_3.html', names)
+    refs = [ e.get('idref') for e in
+        opf.iter('{http://www.idpf.org/2007/opf}itemref') ]
+    self.assertEqual(refs, [ 'chapter_0000', 'chapter_0000_1', 'chapter_0000_2',
+      'chapter_0000_3', 'chapter_0001' ])
+    ns = '{http://www.daisy.org/z3986/2005/ncx/}'
+    self.assertEqual(ncx.find('.//{}meta[@name="dtb:depth"]'.format(ns))
+        .get('content'), '2')
+    top = ncx.find(ns + 'navMap').findall(ns + 'navPoint')
+    self.assertEqual([ p.get('id') for p in top ],
+        [ 'chapter_0000', 'chapter_0001' ])
+    nested = top[0].findall(ns + 'navPoint')
+    self.assertEqual([ p.find(ns + 'content').get('src') for p in nested ],
+        [ 'chapter/0000_1.html', 'chapter/0000_2.html', 'chapter/0000_3.html' ])
+    self.assertEqual([ p.get('playOrder') for p in ncx.iter(ns + 'navPoint') ],
+        [ '1', '2', '3', '4', '5' ])
+
+
+class Compact(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    book = epub.Book(self.base_path)
+    self.book = book
+    book.title = 'Der Mann ohne Eigenschaften'
+    book.uuid = '4223xxx'
+    book.compact = True
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  def div(self):
+    return lxml.etree.fromstring('<div>\n  <h1 style="Color:red">Kapitel</h1>\n  '
+        '<p style="text-indent: 1em">Ulrich   kam\n  nach <i>Hause</i>.</p>\n  '
+        '<div><span/></div>\n  <p style="text-indent:1em;">Es war</p>\n</div>')
+
+  def test_push_chapter(self):
+    ref = epub.Book(self.base_path, archive_name='ref')
+    ref.title = self.book.title
+    r = ref.push_chapter('a', [ self.div() ])[0]
+    data = self.book.push_chapter('a', [ self.div() ])[0]
+    self.assertEqual(self.book.compact_saved(), len(r) - len(data))
+    self.assertTrue(len(data) < len(r))
+    c = list(self.book.styles)[0]
+    self.assertEqual(self.book.styles, { c: 'text-indent: 1em' })
+    self.assertEqual(self.book.chapter_styles, [ { c: 'text-indent: 1em' } ])
+    body = data[data.index(b'<body>'):]
+    # the style that is used once stays inline
+    self.assertEqual(body.decode('utf-8'), '<body><div>'
+        '<h1 style="color: red">Kapitel</h1>'
+        '<p class="{0}">Ulrich kam nach <i>Hause</i>.</p>'
+        '<p class="{0}">Es war</p></div></body></html>'.format(c))
+    self.book.write()
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(z.read('OPS/book.css').decode('utf-8'),
+          '.{} {{ text-indent: 1em }}\n'.format(c))
+      self.assertNotIn(b'\n ', z.read('OPS/book.opf'))
+
+  def test_stream(self):
+    ref = epub.Book(self.base_path, archive_name='ref')
+    ref.title = self.book.title
+    ref.compact = True
+    data = ref.push_chapter('a', [ self.div() ])[0]
+    div = self.div()
+    container = div.makeelement(div.tag, div.attrib)
+    self.book.push_chapter_stream('a', iter([ div.text ] + list(div)),
+        container)
+    c = list(ref.chapter_styles[0])[0]
+    # the first occurrence precedes the hoisting
+    data = data.replace('class="{}"'.format(c).encode('utf-8'),
+        b'style="text-indent: 1em"', 1)
+    with open(self.base_path + '/archive/OPS/chapter/0000.html', 'rb') as f:
+      self.assertEqual(f.read(), data)
+    self.assertEqual(self.book.chapter_styles, ref.chapter_styles)
+    self.assertEqual(self.book.stats.phases['compact']['count'], 1)
+
+  # a style is hoisted once it repeats in another chapter
+  def test_shared(self):
+    self.book.push_chapter('a', [ self.div() ])
+    data = self.book.push_chapter('b', [ self.div() ])[0]
+    styles = self.book.chapter_styles
+    self.assertEqual(list(styles[0].values()), [ 'text-indent: 1em' ])
+    self.assertEqual(sorted(styles[1].values()),
+        [ 'color: red', 'text-indent: 1em' ])
+    self.assertNotIn(b'style=', data)
+    div = lxml.etree.fromstring('<div><p style="text-indent: 1em">x</p></div>')
+    container = div.makeelement(div.tag, div.attrib)
+    self.book.push_chapter_stream('c', iter(list(div)), container)
+    self.assertEqual(styles[2], styles[0])
+    self.assertEqual(len(self.book.styles), 2)
@@ -0,0 +1,46 @@
+
+import extract
+import gb_de
+
+import unittest
+import lxml.html
+
+class Basic(unittest.TestCase):
+
+  def test_xpath_equivalence(self):
+    with open('test/in/dmoe_1.html', 'rb') as f:
+      root = lxml.html.fromstring(f.read())
+    d = gb_de.GB_DE.meta_spec.extract(root)
+    for key in [ 'author', 'title', 'isbn' ]:
+      l = root.xpath('.//div[@id="metadata"]//tr[./td = "{}"]/td[2]/text()'.format(key))
+      self.assertEqual(d[key], str(l[0]))
+    div = root.xpath('//div[@id="gutenb"]')[0]
+    d = gb_de.GB_DE.heading_spec.extract(div)
+    self.assertEqual(d['author'], str(div.xpath('.//h3[1]/text()')[0]))
+    self.assertEqual(d['title'], [ str(x) for x in div.xpath('.//h2[1]/text()') ])
+    self.assertEqual(gb_de.GB_DE.toc_spec.extract(root)['chapter_urls'],
+        [ str(x) for x in root.xpath('//ul[@class="gbnav"]//li/a/@href') ])
+
+  def test_table(self):
+    root = lxml.html.fromstring('<div><table>'
+        '<tr><td><b>a</b></td><td>1</td></tr>'
+        '<tr><td>b</td><td></td></tr>'
+        '<tr><td> b </td><td>2</td></tr>'
+        '<tr><td>a</td><td>3</td></tr>'
+        '<tr><td>c</td><td>4</td></tr>'
+        '</table></div>')
+    spec = extract.Spec([
+      extract.Table('.//tr', 'string(td[1])', 'td[2]/text()',
+        { 'a': 'x', 'b': 'y', 'd': 'z' }) ])
+    self.assertEqual(spec.extract(root), { 'x': '1', 'y': '2' })
+
+  def test_field(self):
+    root = lxml.html.fromstring('<div><h2>a</h2><h2>b</h2></div>')
+    spec = extract.Spec([
+      extract.Field('first', './/h2/text()'),
+      extract.Field('all', './/h2/text()', many=True),
+      extract.Field('none', './/h3/text()') ])
+    d = spec.extract(root)
+    self.assertEqual(d, { 'first': 'a', 'all': [ 'a', 'b' ] })
+    self.assertIs(type(d['first']), str)
+
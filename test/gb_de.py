@@ -1,6 +1,7 @@
 import gb_de
 import epub
 
+import asyncio
 import unittest
 import logging
 import shutil
@@ -8,6 +9,10 @@ import tempfile
 import lxml.etree
 import lxml.html
 import re
+import random
+import time
+import zipfile
+import hashlib
 
 logging.basicConfig(level = logging.DEBUG)
 
@@ -18,6 +23,36 @@ class Args(object):
     self.author = [] 
     self.title = None
     self.uuid = None
+    self.wait = 1.1
+    self.adaptive = False
+    self.max_rate = None
+    self.retries = 0
+    self.backoff = 1.0
+    self.rate = None
+    self.jobs = 1
+    self.pool_size = None
+    self.connect_timeout = 10.0
+    self.read_timeout = 60.0
+    self.compression = 'gzip, deflate'
+    self.cache = None
+    self.cache_size = 1
+    self.cache_ttl = 3600
+    self.offline = False
+    self.conn_stats = False
+    self.resume = False
+    self.incremental = False
+    self.no_images = False
+    self.dump = False
+    self.stream = False
+    self.chapter_cache = None
+    self.chapter_cache_size = 1
+    self.parse_workers = 0
+    self.queue_depth = 2
+    self.progressive = 0
+    self.progressive_interval = 10.0
+    self.split_size = 256
+    self.split_elements = 0
+    self.compact = False
 
 
 class Basic(unittest.TestCase):
@@ -142,3 +177,362 @@ class Basic(unittest.TestCase):
     t = re.sub('[ \\t\\r\\n\\xa0 ]+', ' ', t)
     self.assertEqual(s, t)
 
+
+  def test_download_chapters_order(self):
+    class Page(object):
+      def __init__(self, text):
+        self.content = text.encode('utf-8')
+        self.headers = {}
+    def get_url(url):
+      time.sleep(random.uniform(0, 0.01))
+      return Page(url)
+    pushed = []
+    self.gb.get_url = get_url
+    def push_chapter(s, i, encoding, url=None):
+      pushed.append((s.decode(encoding), i))
+      self.book.restore_chapter(str(i))
+    self.gb.push_chapter = push_chapter
+    self.args.jobs = 4
+    urls = [ '/{}'.format(i) for i in range(1, 21) ]
+    self.gb.download_chapters(urls)
+    ref = [ ('http://gutenberg.spiegel.de/{}'.format(i), i)
+        for i in range(1, 21) ]
+    self.assertEqual(pushed, ref)
+
+  def test_resume(self):
+    class Page(object):
+      def __init__(self, fn):
+        with open(fn, 'rb') as f:
+          self.content = f.read()
+        self.headers = { 'Content-Type': 'text/html; charset=utf-8' }
+    fetched = []
+    blip = [ True ]
+    def get_url(url):
+      fetched.append(url)
+      if url.endswith('/3') and blip[0]:
+        raise RuntimeError('network blip')
+      return Page('test/in/dmoe_{}.html'.format(1 if url.endswith('/1') else 2))
+    urls = [ '/{}'.format(i) for i in range(1, 5) ]
+    self.gb.get_url = get_url
+    with self.assertRaises(RuntimeError):
+      self.gb.download_chapters(urls)
+    self.assertEqual(sorted(self.gb.manifest.chapters), [1, 2])
+
+    del fetched[:]
+    blip[0] = False
+    book = epub.Book(self.base_path)
+    self.args.resume = True
+    gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml', book, self.args)
+    gb.get_url = get_url
+    gb.get_chapter_urls = lambda: urls
+    gb.download()
+    self.assertEqual(fetched, [ 'http://gutenberg.spiegel.de/3',
+      'http://gutenberg.spiegel.de/4' ])
+    self.assertEqual(len(book.chapters), 4)
+    self.assertEqual(book.title, 'Der Mann ohne Eigenschaften. Erstes Buch')
+    self.assertEqual(book.authors, [('Robert', 'Musil', 'aut')])
+    self.assertEqual(sorted(gb.manifest.chapters), [1, 2, 3, 4])
+
+  def test_fetch_excludes_wait(self):
+    class Page(object):
+      content = b'x'
+      def raise_for_status(self):
+        pass
+    class Transport(object):
+      def get(self, url, stats=None, retries=None, urgent=False):
+        time.sleep(0.05)
+        stats.add('wait', 0.05)
+        return Page()
+    self.gb.transport = Transport()
+    self.gb.get_url('http://example.org/')
+    phases = self.book.stats.phases
+    self.assertEqual(phases['wait']['wall'], 0.05)
+    self.assertLess(phases['fetch']['wall'], 0.04)
+
+  def test_download_async_window(self):
+    class Page(object):
+      def __init__(self, fn):
+        with open(fn, 'rb') as f:
+          self.content = f.read()
+        self.headers = { 'Content-Type': 'text/html; charset=utf-8' }
+      def raise_for_status(self):
+        pass
+    in_flight = [ 0, 0 ]
+    class Transport(object):
+      async def aget(self, url, stats=None, retries=None):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.001)
+        in_flight[0] -= 1
+        return Page('test/in/dmoe_{}.html'.format(
+          1 if url.endswith('/1') else 2))
+      async def run(self, f, *args):
+        return f(*args)
+    urls = [ '/{}'.format(i) for i in range(1, 31) ]
+    self.gb.chapter_urls_from_string = lambda s, encoding=None: urls
+    asyncio.run(self.gb.download_async(Transport()))
+    self.assertEqual(len(self.book.chapters), 30)
+    # jobs + 2 * queue_depth
+    self.assertEqual(in_flight[1], 5)
+
+  def test_push_chapter_bytes(self):
+    with open('test/in/dmoe_2.html', 'rb') as f:
+      s = f.read()
+    self.gb.push_chapter(s, 2, 'utf-8')
+    with open(self.base_path + '/archive/OPS/chapter/0000.html', 'rb') as f:
+      t = f.read().decode('utf-8')
+    self.assertTrue(t.find('zukünftigen Schwiegerpapa') > 0)
+    self.assertEqual(self.book.chapters, [('Wirkung eines Mannes ohne Eigenschaften auf einen Mann mit Eigenschaften', None)])
+
+  def test_push_chapter_stream(self):
+    for fn, i in [ ('test/in/dmoe_1.html', 1), ('test/in/dmoe_2.html', 2) ]:
+      with open(fn, 'rb') as f:
+        s = f.read()
+      chunks = [ s[k:k+997] for k in range(0, len(s), 997) ]
+      ref = epub.Book(self.base_path, archive_name='ref')
+      gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml', ref, self.args)
+      book = epub.Book(self.base_path, archive_name='stream')
+      self.gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml', book, self.args)
+      if i == 2:
+        ref.title = book.title = 'x'
+      gb.push_chapter(s, i, 'utf-8')
+      title = self.gb.push_chapter_stream(iter(chunks), i, 'utf-8')
+      self.assertEqual(title, ref.chapters[0][0])
+      self.assertEqual((book.title, book.authors, book.uuid),
+          (ref.title, ref.authors, ref.uuid))
+      with open(self.base_path + '/ref/OPS/chapter/0000.html', 'rb') as f:
+        t = f.read()
+      with open(self.base_path + '/stream/OPS/chapter/0000.html', 'rb') as f:
+        u = f.read()
+      # except for the tail of the chapter div
+      self.assertEqual(re.sub(b'</div>[^<]*</body>', b'</div></body>', t), u)
+      self.assertEqual(book.digests[0], hashlib.sha1(u).hexdigest())
+      shutil.rmtree(self.base_path + '/ref')
+      shutil.rmtree(self.base_path + '/stream')
+
+  def test_stream(self):
+    class Page(object):
+      def __init__(self, fn):
+        with open(fn, 'rb') as f:
+          self.content = f.read()
+        self.headers = { 'Content-Type': 'text/html; charset=utf-8' }
+      def iter_content(self, n):
+        return iter([ self.content[k:k+n]
+          for k in range(0, len(self.content), n) ])
+      def close(self):
+        pass
+      def raise_for_status(self):
+        pass
+    self.gb.transport.stream = lambda url, stats, retries=None, urgent=False: Page(
+        'test/in/dmoe_{}.html'.format(1 if url.endswith('/1') else 2))
+    self.gb.stream_chunk_size = 4096
+    self.args.stream = True
+    self.gb.download_chapters([ '/1', '/2', '/3' ])
+    self.assertEqual(len(self.book.chapters), 3)
+    self.assertEqual(self.book.chapters[1][0], 'Wirkung eines Mannes ohne Eigenschaften auf einen Mann mit Eigenschaften')
+    self.assertEqual(self.book.title, 'Der Mann ohne Eigenschaften. Erstes Buch')
+    self.assertEqual(sorted(self.gb.manifest.chapters), [1, 2, 3])
+    with open('test/in/dmoe_2.html', 'rb') as f:
+      self.assertEqual(self.gb.manifest.chapters[3]['sha1'],
+          hashlib.sha1(f.read()).hexdigest())
+
+  def test_parse_regions(self):
+    for fn, i in [ ('test/in/dmoe_1.html', 1), ('test/in/dmoe_2.html', 2) ]:
+      with open(fn, 'rb') as f:
+        s = f.read()
+      books = []
+      # a str is always parsed as a whole
+      for name, t in [ ('full', s.decode('iso-8859-1')), ('fast', s) ]:
+        book = epub.Book(self.base_path, archive_name=name)
+        gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml', book, self.args)
+        if i == 2:
+          book.title = 'x'
+        gb.push_chapter(t, i)
+        books.append(book)
+      full, fast = books
+      self.assertEqual('parse_fallback' in full.stats.phases, True)
+      self.assertEqual('parse_fallback' in fast.stats.phases, False)
+      self.assertEqual((fast.title, fast.authors, fast.uuid, fast.chapters),
+          (full.title, full.authors, full.uuid, full.chapters))
+      self.assertEqual(fast.digests, full.digests)
+      shutil.rmtree(self.base_path + '/full')
+      shutil.rmtree(self.base_path + '/fast')
+
+  def test_parse_regions_fallback(self):
+    with open('test/in/dmoe_2.html', 'rb') as f:
+      s = f.read()
+    ids = [ 'gutenb' ]
+    self.assertIsNotNone(gb_de.parse_regions(s, ids))
+    self.assertIsNotNone(gb_de.parse_regions(s, [ 'metadata', 'gutenb' ]))
+    start = s.index(b'<div id="gutenb">')
+    end = s.index(b'</div>', start)
+    for t in [
+        # duplicate id
+        s + b'<div id="gutenb"></div>',
+        # markup that hides tags
+        s[:end] + b'<script>document.write("</div>")</script>' + s[end:],
+        s[:end] + b'<!-- <div> -->' + s[end:],
+        # unclosed
+        s[:start] + b'<div id="gutenb"><div>' + s[start + 17:],
+        # no encoding
+        re.sub(b'<meta [^>]*charset[^>]*>', b'', s),
+        s.decode('iso-8859-1'),
+        ]:
+      self.assertIsNone(gb_de.parse_regions(t, ids))
+    tree, fast = gb_de.parse_page(s + b'<div id="gutenb"></div>', ids)
+    self.assertFalse(fast)
+    self.assertEqual(len(tree.xpath('//div[@id="gutenb"]')), 2)
+
+  def test_page_encoding(self):
+    class Page(object):
+      def __init__(self, content, content_type):
+        self.content = content
+        self.headers = { 'Content-Type': content_type }
+    self.assertEqual(gb_de.page_encoding(Page(b'\xfc', 'text/html; charset=ISO-8859-1')), 'ISO-8859-1')
+    self.assertEqual(gb_de.page_encoding(Page('ü'.encode('utf-8'), 'text/html')), 'utf-8')
+    self.assertIsNone(gb_de.page_encoding(Page(b'\xfc', 'text/html')))
+    # across chunks
+    s = b'a' * (gb_de.sniff_chunk_size - 1) + 'ü'.encode('utf-8')
+    self.assertEqual(gb_de.sniff_encoding(s), 'utf-8')
+    self.assertIsNone(gb_de.sniff_encoding(s[:-1]))
+    self.assertEqual(gb_de.sniff_encoding(s[:-1], False), 'utf-8')
+    self.assertIsNone(gb_de.sniff_encoding(s + b'a' * gb_de.sniff_chunk_size
+      + b'\xfc'))
+
+  def build(self, mode, pages, split_size=0):
+    book = epub.Book(self.base_path, mode)
+    book.split_size = split_size
+    gb = gb_de.GB_DE('http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml', book, self.args)
+    class Page(object):
+      def __init__(self, content):
+        self.content = content
+        self.headers = { 'Content-Type': 'text/html; charset=utf-8' }
+    gb.get_url = lambda url: Page(pages[int(url.split('/')[-1]) - 1])
+    gb.get_chapter_urls = lambda: [ '/{}'.format(i)
+        for i in range(1, len(pages) + 1) ]
+    gb.download()
+    book.write()
+    return gb
+
+  def test_incremental(self):
+    pages = []
+    for i in range(1, 5):
+      with open('test/in/dmoe_{}.html'.format(1 if i == 1 else 2), 'rb') as f:
+        pages.append(f.read())
+    self.args.incremental = True
+    for mode in [ 'staged', 'stream' ]:
+      self.build(mode, pages)
+      changed = list(pages)
+      changed[2] = changed[2].replace('Schwiegerpapa'.encode('utf-8'),
+          'Schwiegermama'.encode('utf-8'))
+      gb = self.build(mode, changed)
+      self.assertEqual(gb.reused, 3)
+      self.assertTrue(gb.book.reuse_toc)
+      self.assertEqual(gb.book.title, 'Der Mann ohne Eigenschaften. Erstes Buch')
+      with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+        self.assertIsNone(z.testzip())
+        self.assertEqual(z.namelist()[0], 'mimetype')
+        self.assertTrue(z.read('OPS/chapter/0002.html').find(
+          'Schwiegermama'.encode('utf-8')) > 0)
+        self.assertTrue(z.read('OPS/chapter/0003.html').find(
+          'Schwiegerpapa'.encode('utf-8')) > 0)
+        self.assertEqual(len(z.namelist()), 9)
+      # a changed title invalidates OPF/NCX
+      changed[3] = changed[3].replace(b'Wirkung eines Mannes', b'Wirkung einer Frau')
+      gb = self.build(mode, changed)
+      self.assertEqual(gb.reused, 3)
+      self.assertFalse(gb.book.reuse_toc)
+      with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+        self.assertTrue(z.read('OPS/book.ncx').find(b'Wirkung einer Frau') > 0)
+      # an overridden title invalidates all chapters
+      self.args.title = 'Overridden Title'
+      gb = self.build(mode, changed)
+      self.assertEqual(gb.reused, 0)
+      self.assertEqual(gb.book.title, 'Overridden Title')
+      with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+        self.assertIn(b'Overridden Title', z.read('OPS/book.opf'))
+        self.assertIn(b'Overridden Title', z.read('OPS/chapter/0003.html'))
+      gb = self.build(mode, changed)
+      self.assertEqual(gb.reused, 4)
+      self.assertEqual(gb.book.title, 'Overridden Title')
+      self.args.title = None
+
+  def test_chapter_cache(self):
+    pages = []
+    for i in range(1, 4):
+      with open('test/in/dmoe_{}.html'.format(1 if i == 1 else 2), 'rb') as f:
+        pages.append(f.read())
+    self.args.chapter_cache = self.base_path + '/cache'
+    gb = self.build('staged', pages)
+    # the third chapter is the same page as the second one
+    self.assertEqual(gb.cached, 1)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      ref = dict((n, z.read(n)) for n in z.namelist())
+    gb = self.build('staged', pages)
+    self.assertEqual(gb.cached, 3)
+    self.assertEqual(gb.book.title, 'Der Mann ohne Eigenschaften. Erstes Buch')
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(dict((n, z.read(n)) for n in z.namelist()), ref)
+    # other rules (or another book title) miss
+    self.args.title = 'Another Title'
+    gb = self.build('staged', pages)
+    self.assertEqual(gb.cached, 1)
+    old = gb_de.GB_DE.cleanup_rules
+    try:
+      gb_de.GB_DE.cleanup_rules = gb_de.cleanup.Engine(old.rules[:1])
+      gb = self.build('staged', pages)
+      self.assertEqual(gb.cached, 1)
+    finally:
+      gb_de.GB_DE.cleanup_rules = old
+
+  def test_split(self):
+    pages = []
+    for i in range(1, 4):
+      with open('test/in/dmoe_{}.html'.format(1 if i == 1 else 2), 'rb') as f:
+        pages.append(f.read())
+    self.args.chapter_cache = self.base_path + '/cache'
+    self.args.incremental = True
+    gb = self.build('staged', pages, 4096)
+    parts = list(gb.book.parts)
+    self.assertEqual(parts, [ 1, 7, 7 ])
+    self.assertEqual([ gb.manifest.chapters[i]['parts'] for i in range(1, 4) ],
+        parts)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      ref = dict((n, z.read(n)) for n in z.namelist())
+    self.assertEqual(len([ n for n in ref if n.startswith('OPS/chapter/') ]),
+        sum(parts))
+    # reused from the previous epub
+    gb = self.build('staged', pages, 4096)
+    self.assertEqual(gb.reused, 3)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(dict((n, z.read(n)) for n in z.namelist()), ref)
+    # from the chapter cache
+    self.args.incremental = False
+    gb = self.build('staged', pages, 4096)
+    self.assertEqual(gb.cached, 3)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(dict((n, z.read(n)) for n in z.namelist()), ref)
+    # resumed
+    self.args.chapter_cache = None
+    self.args.resume = True
+    gb = self.build('staged', pages[:2] + [ b'' ], 4096)
+    self.assertEqual(gb.book.parts, parts)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(dict((n, z.read(n)) for n in z.namelist()), ref)
+
+  def test_parse_workers(self):
+    pages = []
+    for i in range(1, 6):
+      with open('test/in/dmoe_{}.html'.format(1 if i == 1 else 2), 'rb') as f:
+        pages.append(f.read())
+    pages[3] = pages[3].replace(b'Wirkung eines Mannes', b'Wirkung einer Frau')
+    self.build('staged', pages)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      ref = dict((n, z.read(n)) for n in z.namelist())
+    self.args.parse_workers = 2
+    gb = self.build('staged', pages)
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertEqual(dict((n, z.read(n)) for n in z.namelist()), ref)
+    self.assertEqual(gb.book.chapters[3][0], 'Wirkung einer Frau ohne Eigenschaften auf einen Mann mit Eigenschaften')
+    self.assertEqual(gb.book.stats.phases['parse']['count'], 5)
+    self.assertEqual(gb.book.stats.queues['fetched']['count'], 5)
@@ -0,0 +1,102 @@
+import images
+import transport
+import epub
+import gb_de
+import test.server
+import test.transport
+import test.gb_de
+
+import unittest
+import logging
+import tempfile
+import shutil
+import zipfile
+
+logging.basicConfig(level = logging.DEBUG)
+
+png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+gif = b'GIF89a' + b'\x01' * 32
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+    for name, data in [ ('a.png', png), ('b.png', png), ('c.gif', gif),
+        ('d.txt', b'no image') ]:
+      with open(self.base_path + '/' + name, 'wb') as f:
+        f.write(data)
+    self.transport = transport.Transport(test.transport.Args())
+    images.memo = images.Memo(1024)
+
+  def tearDown(self):
+    self.transport.close()
+    shutil.rmtree(self.base_path)
+
+  def test_image_type(self):
+    self.assertEqual(images.image_type(png), 'png')
+    self.assertEqual(images.image_type(b'\xff\xd8\xff\xe0'), 'jpg')
+    self.assertEqual(images.image_type(gif), 'gif')
+    self.assertIsNone(images.image_type(b'<html>'))
+
+  def test_memo(self):
+    m = images.Memo(100)
+    m.put('a', ('png', b'x' * 60))
+    m.put('b', ('png', b'x' * 30))
+    m.get('a')
+    m.put('c', ('png', b'x' * 30))
+    self.assertIsNotNone(m.get('a'))
+    self.assertIsNone(m.get('b'))
+    self.assertEqual(m.size, 90)
+
+  def test_fetch_all(self):
+    f = images.Fetcher(self.transport, 4)
+    with test.server.Server(self.base_path) as s:
+      urls = [ s.url(n) for n in [ 'a.png', 'b.png', 'c.gif', 'd.txt',
+        'missing.png', 'a.png' ] ]
+      r = f.fetch_all(urls)
+      self.assertEqual(len(s.hits()), 5)
+      self.assertEqual(r[urls[0]], ('png', png))
+      self.assertEqual(r[urls[2]], ('gif', gif))
+      self.assertIsNone(r[urls[3]])
+      self.assertIsNone(r[urls[4]])
+      # memoized
+      f.fetch(urls[0])
+      self.assertEqual(len(s.hits()), 5)
+    f.close()
+
+  def test_push_chapter(self):
+    book = epub.Book(self.base_path)
+    book.title = 'Title'
+    book.uuid = 'some uuid'
+    args = test.gb_de.Args()
+    args.rate = 1000.0
+    with test.server.Server(self.base_path) as s:
+      gb = gb_de.GB_DE(s.url('book.xml'), book, args, self.transport)
+      gb.image_fetcher = images.Fetcher(self.transport, 2)
+      page = ('<html><body><div id="gutenb"><h3>Title</h3>'
+          '<p><img src="a.png"/> a</p><p><img src="/b.png"/> b</p>'
+          '<p><img src="c.gif"/> c</p><p><img src="x.png"/>tail</p>'
+          '</div></body></html>')
+      gb.push_chapter(page.encode('utf-8'), 2, 'utf-8', s.url('1.html'))
+      gb.image_fetcher.close()
+    self.assertEqual(gb.chapter_images, 4)
+    # a.png and b.png have the same content
+    self.assertEqual(book.images, [ ('png', book.images[0][1]),
+      ('gif', book.images[1][1]) ])
+    book.write()
+    with zipfile.ZipFile(self.base_path + '/book.epub') as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual(z.read('OPS/image/0000.png'), png)
+      self.assertEqual(z.read('OPS/image/0001.gif'), gif)
+      self.assertEqual(z.getinfo('OPS/image/0000.png').compress_type,
+          zipfile.ZIP_STORED)
+      c = z.read('OPS/chapter/0000.html').decode('utf-8')
+      opf = z.read('OPS/book.opf').decode('utf-8')
+    self.assertEqual(c.count('src="../image/0000.png"'), 2)
+    self.assertEqual(c.count('src="../image/0001.gif"'), 1)
+    self.assertFalse('x.png' in c)
+    self.assertTrue('tail' in c)
+    self.assertTrue('image/gif' in opf)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,105 @@
+
+import job
+import ratelimit
+import test.server
+import test.transport
+
+import unittest
+import io
+import logging
+import multiprocessing
+import shutil
+import tempfile
+import os.path
+import lxml.html
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Args(test.transport.Args):
+
+  def __init__(self, out):
+    super().__init__()
+    self.out = out
+    self.build = 'staged'
+    self.compress_level = 1
+    self.workers = 2
+    self.stats = True
+    self.progressive = 0
+    self.progressive_interval = 10.0
+    self.split_size = 256
+    self.split_elements = 0
+    self.compact = False
+
+
+# minimal source: one chapter, the gutenb div of the page
+class Source(object):
+
+  def __init__(self, url, book, args, transport):
+    self.url = url
+    self.book = book
+    self.transport = transport
+
+  def download(self):
+    page = self.transport.get(self.url)
+    if page.status_code != 200:
+      raise RuntimeError('HTTP {}'.format(page.status_code))
+    div = lxml.html.fromstring(page.content).xpath('//div[@id="gutenb"]')[0]
+    self.book.title = 'x'
+    self.book.uuid = 'y'
+    self.book.push_chapter('a', [ div ])
+
+
+class Basic(unittest.TestCase):
+
+  def test_read_urls(self):
+    f = io.StringIO('http://a/1\n\n# comment\n  http://b/2  \n')
+    self.assertEqual(job.read_urls(f), [ 'http://a/1', 'http://b/2' ])
+
+  def test_unique_names(self):
+    self.assertEqual(job.unique_names([ 'a', 'b', 'a', 'a' ]),
+        [ 'a', 'b', 'a_2', 'a_3' ])
+
+
+class Batch(unittest.TestCase):
+
+  def setUp(self):
+    self.base_path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.base_path)
+
+  # the workers close their transports, which logs the cache counts
+  def test_worker_close(self):
+    args = Args(self.base_path)
+    args.cache = self.base_path + '/cache'
+    h = logging.FileHandler(self.base_path + '/log')
+    logging.getLogger().addHandler(h)
+    try:
+      with test.server.Server() as s, multiprocessing.Manager() as manager:
+        limiter = ratelimit.SharedHostLimiter(manager, 100.0)
+        results = job.run_batch([ (Source, s.url('dmoe_1.html'), 'a') ],
+            args, limiter)
+    finally:
+      logging.getLogger().removeHandler(h)
+      h.close()
+    self.assertTrue(results[0]['ok'])
+    with open(self.base_path + '/log') as f:
+      self.assertIn('cache: 0 hits, 0 revalidated, 1 misses', f.read())
+
+  def test_batch(self):
+    args = Args(self.base_path)
+    with test.server.Server() as s, multiprocessing.Manager() as manager:
+      limiter = ratelimit.SharedHostLimiter(manager, 100.0)
+      jobs = [ (Source, s.url('dmoe_1.html'), 'a'),
+          (Source, s.url('missing.html'), 'b'),
+          (Source, s.url('dmoe_2.html'), 'c') ]
+      results = job.run_batch(jobs, args, limiter)
+    self.assertEqual([ r['ok'] for r in results ], [ True, False, True ])
+    self.assertEqual(results[1]['error'], 'RuntimeError: HTTP 404')
+    self.assertEqual(results[2]['chapters'], 1)
+    self.assertTrue(os.path.isfile(self.base_path + '/a.epub'))
+    self.assertTrue(os.path.isfile(self.base_path + '/c.archive/OPS/chapter/0000.html'))
+    self.assertIn('write_epub', results[0]['stats'][0]['phases'])
+    self.assertTrue(job.summary(results).endswith('2 of 3 books built, 1 failed'))
+    self.assertIn(' saved ', job.summary(results).split('\n')[0])
+
@@ -0,0 +1,62 @@
+import pipeline
+import stats
+
+import unittest
+import logging
+import random
+import threading
+import time
+import concurrent.futures
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.stats = stats.Stats()
+
+  def test_order(self):
+    l = []
+    def fetch(i, x):
+      time.sleep(random.random() * 0.01)
+      return x * 2
+    p = pipeline.Pipeline(fetch, lambda i, x, page: page + 1,
+        lambda i, x, page, pending: l.append((i, page, pending)),
+        self.stats, fetchers=4, depth=2)
+    p.run([ (i, i * 10) for i in range(50) ])
+    self.assertEqual(l, [ (i, i * 20, i * 20 + 1) for i in range(50) ])
+    q = self.stats.queues
+    self.assertEqual(q['fetched']['count'], 50)
+    self.assertTrue(q['fetched']['max'] <= 2)
+    self.assertTrue(q['transformed']['max'] <= 2)
+    # fetchers + 2 * depth in flight
+    self.assertTrue(q['reorder']['max'] < 8)
+
+  def test_futures(self):
+    l = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+      p = pipeline.Pipeline(lambda i, x: x,
+          lambda i, x, page: executor.submit(time.sleep, random.random() * 0.01),
+          lambda i, x, page, pending: l.append(pending.done() or pending.result()),
+          self.stats, fetchers=2, depth=3)
+      p.run([ (i, i) for i in range(20) ])
+    self.assertEqual(len(l), 20)
+
+  def test_error(self):
+    l = []
+    def fetch(i, x):
+      if i == 7:
+        raise RuntimeError('no {}'.format(i))
+      return x
+    p = pipeline.Pipeline(fetch, lambda i, x, page: None,
+        lambda i, x, page, pending: l.append(i), self.stats, fetchers=3,
+        depth=1)
+    n = threading.active_count()
+    with self.assertRaises(RuntimeError):
+      p.run([ (i, i) for i in range(100) ])
+    self.assertEqual(l, list(range(7)))
+    # the stages are stopped
+    self.assertEqual(threading.active_count(), n)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,126 @@
+
+import ratelimit
+
+import unittest
+import threading
+import time
+import multiprocessing
+
+class Bucket(unittest.TestCase):
+
+  def test_burst(self):
+    b = ratelimit.TokenBucket(1.0, burst = 3.0)
+    for i in range(3):
+      self.assertEqual(b.acquire(), 0.0)
+
+  def test_rate(self):
+    b = ratelimit.TokenBucket(50.0)
+    start = time.monotonic()
+    for i in range(6):
+      b.acquire()
+    # first token is free, the other 5 are spaced by 1/50 s
+    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+  def test_threads(self):
+    b = ratelimit.TokenBucket(100.0)
+    start = time.monotonic()
+    ts = [ threading.Thread(target=b.acquire) for i in range(11) ]
+    for t in ts:
+      t.start()
+    for t in ts:
+      t.join()
+    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+  def test_urgent(self):
+    b = ratelimit.TokenBucket(20.0)
+    b.acquire()
+    l = []
+    def f(name, urgent):
+      b.acquire(urgent)
+      l.append(name)
+    ts = [ threading.Thread(target=f, args=(i, False)) for i in range(3) ]
+    for t in ts:
+      t.start()
+    time.sleep(0.01)
+    ts.append(threading.Thread(target=f, args=('urgent', True)))
+    ts[-1].start()
+    for t in ts:
+      t.join()
+    self.assertEqual(l[0], 'urgent')
+    self.assertEqual(sorted(l[1:]), [ 0, 1, 2 ])
+
+
+class Hosts(unittest.TestCase):
+
+  def test_per_host(self):
+    l = ratelimit.HostLimiter(0.001)
+    self.assertEqual(l.acquire('http://a.example.org/1'), 0.0)
+    self.assertEqual(l.acquire('http://b.example.org/1'), 0.0)
+    self.assertIs(l.bucket('a.example.org'), l.bucket('a.example.org'))
+    self.assertEqual(len(l.buckets), 2)
+
+
+class Adaptive(unittest.TestCase):
+
+  def test_aimd(self):
+    l = ratelimit.AdaptiveHostLimiter(10.0, 20.0, 4)
+    url = 'http://a.example.org/1'
+    for i in range(20):
+      l.acquire(url)
+      l.done(url, 0.01, 200)
+    h = l.hosts['a.example.org']
+    self.assertEqual(h.rate, 20.0)
+    self.assertEqual(int(h.limit), 4)
+    l.acquire(url)
+    l.done(url, 0.01, 429)
+    self.assertEqual(h.rate, 10.0)
+    self.assertEqual(int(h.limit), 2)
+    self.assertEqual(h.throttled, 1)
+    # slow responses cut the rate
+    l.acquire(url)
+    l.done(url, 1.0, 200)
+    self.assertAlmostEqual(h.rate, 9.0)
+    self.assertEqual(h.active, 0)
+
+  def test_concurrency(self):
+    l = ratelimit.AdaptiveHostLimiter(1000.0, 1000.0, 4)
+    url = 'http://a.example.org/1'
+    l.acquire(url)
+    t = threading.Thread(target=l.acquire, args=(url,))
+    t.start()
+    # the limit starts at one request
+    t.join(0.1)
+    self.assertTrue(t.is_alive())
+    l.done(url, 0.01, 200)
+    t.join()
+    l.done(url, 0.01, 200)
+
+  def test_pause(self):
+    l = ratelimit.AdaptiveHostLimiter(1000.0, 1000.0, 4)
+    l.pause('http://a.example.org/1', 0.1)
+    self.assertGreaterEqual(l.acquire('http://a.example.org/2'), 0.09)
+    self.assertLess(l.acquire('http://b.example.org/2'), 0.05)
+
+
+def shared_acquire(limiter, n):
+  for i in range(n):
+    limiter.acquire('http://a.example.org/')
+
+
+class Shared(unittest.TestCase):
+
+  def test_processes(self):
+    with multiprocessing.Manager() as manager:
+      l = ratelimit.SharedHostLimiter(manager, 50.0)
+      start = time.monotonic()
+      ps = [ multiprocessing.Process(target=shared_acquire, args=(l, 3))
+          for i in range(2) ]
+      for p in ps:
+        p.start()
+      for p in ps:
+        p.join()
+      # 6 tokens, the first is free
+      self.assertGreaterEqual(time.monotonic() - start, 0.09)
+      self.assertEqual(l.acquire('http://b.example.org/'), 0.0)
+
@@ -0,0 +1,73 @@
+import registry
+import gb_de
+
+import unittest
+import logging
+import json
+import os
+import sys
+import tempfile
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.r = registry.Registry()
+    self.r.add(registry.Source('a', 'gb_de', 'GB_DE', [ 'a.example.org' ]))
+    self.r.add(registry.Source('b', 'test.server', 'Server',
+      [ 'b.example.org' ], [ 'example\\.net/b/', 'mirror\\.example\\.net' ]))
+
+  def test_default(self):
+    self.assertIs(registry.registry.resolve(
+      'http://gutenberg.spiegel.de/musil/mannohne/mannohne.xml'), gb_de.GB_DE)
+    self.assertIs(registry.registry.resolve('http://x/y.xml', 'gb'),
+        gb_de.GB_DE)
+
+  def test_match(self):
+    self.assertEqual(self.r.match('http://a.example.org/x').name, 'a')
+    self.assertEqual(self.r.match('https://WWW.A.example.org:8080/x').name, 'a')
+    self.assertEqual(self.r.match('http://b.example.org/x').name, 'b')
+    # regex fallback
+    self.assertEqual(self.r.match('http://example.net/b/x').name, 'b')
+    self.assertEqual(self.r.match('http://mirror.example.net/').name, 'b')
+    with self.assertRaises(ValueError):
+      self.r.match('http://example.net/c/x')
+    with self.assertRaises(ValueError):
+      self.r.get('c')
+    with self.assertRaises(ValueError):
+      self.r.add(registry.Source('a', 'x', 'X'))
+
+  def test_search(self):
+    for i in range(10):
+      self.r.add(registry.Source('s{}'.format(i), 'gb_de', 'GB_DE',
+        patterns=[ 'x{}'.format(i), 'same' ]))
+    self.assertEqual(self.r.search('http://x7.example.com/').name, 's7')
+    # the first registered pattern that matches at the leftmost position
+    self.assertEqual(self.r.search('http://x9.com/same/x3').name, 's9')
+    self.assertEqual(self.r.search('http://same.com/x3').name, 's0')
+    self.assertIsNone(self.r.search('http://y.com/'))
+    self.assertIsNone(registry.Registry().search('http://y.com/'))
+
+  def test_lazy(self):
+    self.r.add(registry.Source('c', 'test.in_registry_only', 'X',
+      [ 'c.example.org' ]))
+    self.assertEqual(self.r.match('http://c.example.org/').name, 'c')
+    self.assertNotIn('test.in_registry_only', sys.modules)
+    with self.assertRaises(ImportError):
+      self.r.resolve('http://c.example.org/')
+    import test.server
+    self.assertIs(self.r.resolve('http://b.example.org/'), test.server.Server)
+
+  def test_load(self):
+    fd, fn = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+      json.dump([ { 'name': 'd', 'module': 'gb_de', 'cls': 'GB_DE',
+        'patterns': [ 'example\\.com/d' ] } ], f)
+    self.r.load(fn)
+    os.remove(fn)
+    self.assertEqual(self.r.names(), [ 'a', 'b', 'd' ])
+    self.assertIs(self.r.resolve('http://example.com/d/1'), gb_de.GB_DE)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+
+# Local stand-in for the book site: serves the files under test/in
+# with keep-alive and an optional injected latency. failures maps a
+# file name to a list of (status, Retry-After) responses that are
+# sent before the file, redirects a name to the Location of a 301.
+
+import http.server
+import threading
+import time
+import os
+import hashlib
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.hits.append(self.path)
+    time.sleep(self.server.latency)
+    name = self.path.lstrip('/').split('?')[0]
+    fn = os.path.join(self.server.root, name)
+    failures = self.server.failures.get(name)
+    if name in self.server.redirects:
+      body = b'moved'
+      self.send_response(301)
+      self.send_header('Location', self.server.redirects[name])
+    elif failures:
+      status, after = failures.pop(0)
+      body = b'busy'
+      self.send_response(status)
+      if after is not None:
+        self.send_header('Retry-After', str(after))
+    elif name and os.path.isfile(fn):
+      with open(fn, 'rb') as f:
+        body = f.read()
+      etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+      if self.headers.get('If-None-Match') == etag:
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/html; charset=utf-8')
+      self.send_header('ETag', etag)
+    else:
+      body = b'not found'
+      self.send_response(404)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class Server(object):
+
+  def __init__(self, root = 'test/in', latency = 0.0, failures = None,
+      redirects = None):
+    self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.httpd.daemon_threads = True
+    self.httpd.root = root
+    self.httpd.latency = latency
+    self.httpd.hits = []
+    self.httpd.failures = failures or {}
+    self.httpd.redirects = redirects or {}
+    self.thread = threading.Thread(target=self.httpd.serve_forever)
+    self.thread.daemon = True
+
+  def url(self, path):
+    return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, path)
+
+  def hits(self):
+    return self.httpd.hits
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
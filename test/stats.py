@@ -0,0 +1,58 @@
+
+import stats
+import epub
+
+import unittest
+import logging
+import shutil
+import tempfile
+import time
+import tracemalloc
+import lxml.etree
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Basic(unittest.TestCase):
+
+  def test_phase(self):
+    s = stats.Stats()
+    for i in range(2):
+      with s.phase('sleep', 10) as p:
+        time.sleep(0.01)
+        p.bytes_out = 5
+    s.add('wait', 0.5)
+    p = s.phases['sleep']
+    self.assertEqual(p['count'], 2)
+    self.assertGreaterEqual(p['wall'], 0.02)
+    self.assertLess(p['cpu'], p['wall'])
+    self.assertEqual((p['bytes_in'], p['bytes_out']), (20, 10))
+    self.assertEqual(s.phases['wait']['wall'], 0.5)
+    s.finish()
+    r = s.report()
+    self.assertGreater(r['peak_rss_kib'], 0)
+    self.assertNotIn('top_allocators', r)
+    self.assertTrue(s.summary().startswith('phase'))
+
+  def test_trace_malloc(self):
+    tracemalloc.start()
+    try:
+      r = stats.Stats().report(top=3)
+    finally:
+      tracemalloc.stop()
+    self.assertLessEqual(len(r['top_allocators']), 3)
+
+  def test_book(self):
+    base_path = tempfile.mkdtemp()
+    try:
+      book = epub.Book(base_path)
+      book.title = 'x'
+      book.uuid = 'y'
+      book.push_chapter('a', [ lxml.etree.fromstring('<div><p>abcd</p></div>') ])
+      book.write()
+      for k in [ 'serialize', 'put', 'write_opf', 'write_ncx', 'write_epub' ]:
+        self.assertIn(k, book.stats.phases)
+      self.assertGreater(book.stats.phases['write_epub']['bytes_out'], 0)
+      self.assertIsNotNone(book.stats.elapsed)
+    finally:
+      shutil.rmtree(base_path)
+
@@ -0,0 +1,106 @@
+
+import transport
+import test.server
+
+import unittest
+import logging
+import time
+import email.utils
+
+logging.basicConfig(level = logging.DEBUG)
+
+class Args(object):
+
+  def __init__(self):
+    self.agent = 'some agent'
+    self.wait = 1.1
+    self.adaptive = False
+    self.max_rate = None
+    self.retries = 0
+    self.backoff = 1.0
+    self.rate = 1000.0
+    self.jobs = 2
+    self.pool_size = None
+    self.connect_timeout = 5.0
+    self.read_timeout = 5.0
+    self.compression = 'gzip, deflate'
+    self.cache = None
+    self.cache_size = 1
+    self.cache_ttl = 3600
+    self.offline = False
+    self.conn_stats = True
+
+
+class Basic(unittest.TestCase):
+
+  def setUp(self):
+    self.args = Args()
+    self.transport = transport.Transport(self.args)
+
+  def tearDown(self):
+    self.transport.close()
+
+  def test_reuse(self):
+    with test.server.Server() as s:
+      for i in range(5):
+        page = self.transport.get(s.url('dmoe_1.html'))
+        self.assertEqual(page.status_code, 200)
+    self.assertEqual(self.transport.stats.requests['127.0.0.1'], 5)
+    self.assertEqual(self.transport.stats.connections['127.0.0.1'], 1)
+
+  def test_headers(self):
+    h = self.transport.session.headers
+    self.assertEqual(h['User-Agent'], 'some agent')
+    self.assertEqual(h['Accept-Encoding'], 'gzip, deflate')
+    self.assertEqual(self.transport.timeout, (5.0, 5.0))
+
+  def test_rate(self):
+    self.args.rate = None
+    t = transport.Transport(self.args)
+    self.assertAlmostEqual(t.limiter.rate, 1.0 / 1.1)
+
+  def test_retry(self):
+    failures = { 'dmoe_1.html': [ (503, 0.2), (429, None) ] }
+    with test.server.Server(failures=failures) as s:
+      retries = transport.RetryBudget(5, base=0.01)
+      start = time.monotonic()
+      page = self.transport.get(s.url('dmoe_1.html'), retries=retries)
+      self.assertEqual(page.status_code, 200)
+      # Retry-After is honored
+      self.assertGreaterEqual(time.monotonic() - start, 0.2)
+      self.assertEqual(retries.used, 2)
+      self.assertEqual(len(s.hits()), 3)
+
+  def test_retry_budget(self):
+    failures = { 'dmoe_1.html': [ (503, None) ] * 3 }
+    with test.server.Server(failures=failures) as s:
+      retries = transport.RetryBudget(1, base=0.01)
+      page = self.transport.get(s.url('dmoe_1.html'), retries=retries)
+      self.assertEqual(page.status_code, 503)
+      self.assertEqual(retries.used, 1)
+      # without retries, a failure is returned as is
+      page = self.transport.get(s.url('dmoe_1.html'))
+      self.assertEqual(page.status_code, 503)
+      self.assertEqual(len(s.hits()), 3)
+
+  def test_retry_after(self):
+    class Page(object):
+      def __init__(self, v):
+        self.headers = { 'Retry-After': v } if v else {}
+    self.assertEqual(transport.retry_after(Page('7')), 7.0)
+    self.assertIsNone(transport.retry_after(Page(None)))
+    self.assertIsNone(transport.retry_after(Page('soon')))
+    d = email.utils.formatdate(time.time() + 60, usegmt=True)
+    self.assertAlmostEqual(transport.retry_after(Page(d)), 60, delta=2)
+
+  def test_adaptive(self):
+    self.args.adaptive = True
+    self.args.rate = 10.0
+    t = transport.Transport(self.args)
+    with test.server.Server() as s:
+      for i in range(5):
+        t.get(s.url('dmoe_1.html'))
+    h = t.limiter.hosts['127.0.0.1:{}'.format(s.httpd.server_port)]
+    self.assertGreater(h.rate, 10.0)
+    t.close()
+
@@ -0,0 +1,55 @@
+
+import zipraw
+
+import unittest
+import io
+import zipfile
+
+class Basic(unittest.TestCase):
+
+  def test_roundtrip(self):
+    b = io.BytesIO()
+    data = b'lorum lipsum ' * 1000
+    with zipfile.ZipFile(b, 'w') as z:
+      z.writestr('mimetype', 'application/epub+zip')
+      zipraw.write(z, 'a.html', data, 9)
+      zipraw.write(z, 'b.html', data, 0)
+      z.writestr('c.html', b'after')
+    with zipfile.ZipFile(b, 'r') as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual([ i.filename for i in z.infolist() ],
+          ['mimetype', 'a.html', 'b.html', 'c.html'])
+      self.assertEqual(z.read('a.html'), data)
+      self.assertEqual(z.read('b.html'), data)
+      self.assertEqual(z.read('c.html'), b'after')
+      a = z.getinfo('a.html')
+      self.assertEqual(a.compress_type, zipfile.ZIP_DEFLATED)
+      self.assertLess(a.compress_size, len(data) / 10)
+      self.assertEqual(z.getinfo('b.html').compress_type, zipfile.ZIP_STORED)
+
+  def test_duplicate(self):
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, 'w') as z:
+      zipraw.write(z, 'a', b'x', 6)
+      with self.assertWarns(UserWarning):
+        zipraw.write(z, 'a', b'y', 6)
+
+
+  def test_copy(self):
+    a = io.BytesIO()
+    data = b'lorum lipsum ' * 1000
+    with zipfile.ZipFile(a, 'w') as z:
+      z.writestr('mimetype', 'application/epub+zip')
+      z.writestr('x.html', data, compress_type=zipfile.ZIP_DEFLATED)
+      zipraw.write(z, 'y.html', data, 1)
+    b = io.BytesIO()
+    with zipfile.ZipFile(a, 'r') as src, zipfile.ZipFile(b, 'w') as dst:
+      for name in [ 'mimetype', 'y.html', 'x.html' ]:
+        zipraw.copy(src, dst, name)
+      zinfo, cdata = zipraw.read_raw(src, 'x.html')
+      self.assertEqual(len(cdata), zinfo.compress_size)
+    with zipfile.ZipFile(b, 'r') as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual(z.namelist(), [ 'mimetype', 'y.html', 'x.html' ])
+      self.assertEqual(z.read('x.html'), data)
+      self.assertEqual(z.getinfo('x.html').compress_type, zipfile.ZIP_DEFLATED)
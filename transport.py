@@ -0,0 +1,238 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+import email.utils
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+import urllib3.connectionpool
+
+import ratelimit
+import cache
+
+
+class ConnectionStats(object):
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = {}
+    self.connections = {}
+
+  def count(self, d, host):
+    with self.lock:
+      d[host] = d.get(host, 0) + 1
+
+  def request(self, host):
+    self.count(self.requests, host)
+
+  def connection(self, host):
+    self.count(self.connections, host)
+
+  def log(self):
+    for host in sorted(self.requests):
+      logging.info('{}: {} requests over {} connections'.format(host,
+        self.requests[host], self.connections.get(host, 0)))
+
+
+def counting_pool(base, stats):
+  class Pool(base):
+    def _new_conn(self):
+      stats.connection(self.host)
+      return super()._new_conn()
+  return Pool
+
+
+class CountingAdapter(requests.adapters.HTTPAdapter):
+
+  def __init__(self, stats, **kw):
+    self.stats = stats
+    super().__init__(**kw)
+
+  def init_poolmanager(self, *args, **kw):
+    super().init_poolmanager(*args, **kw)
+    self.poolmanager.pool_classes_by_scheme = {
+        'http' : counting_pool(
+          urllib3.connectionpool.HTTPConnectionPool, self.stats),
+        'https' : counting_pool(
+          urllib3.connectionpool.HTTPSConnectionPool, self.stats) }
+
+
+# responses that are retried
+retry_statuses = (429, 500, 502, 503, 504)
+
+# seconds of a Retry-After header (delta or HTTP date), or None
+def retry_after(page):
+  v = page.headers.get('Retry-After') if page is not None else None
+  if not v:
+    return None
+  try:
+    return max(0.0, float(v))
+  except ValueError:
+    pass
+  try:
+    return max(0.0, email.utils.parsedate_to_datetime(v).timestamp()
+        - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+# Retries of a book's requests: a budget of n retries in total, each
+# after a jittered exponential backoff (or the Retry-After, if longer).
+class RetryBudget(object):
+
+  def __init__(self, n, base=1.0, cap=60.0, attempts=5):
+    self.left = n
+    self.base = base
+    self.cap = cap
+    self.attempts = attempts
+    self.used = 0
+    self.lock = threading.Lock()
+
+  def take(self, attempt):
+    with self.lock:
+      if self.left <= 0 or attempt >= self.attempts:
+        return False
+      self.left -= 1
+      self.used += 1
+      return True
+
+  def backoff(self, attempt):
+    return random.uniform(0.5, 1.0) * min(self.cap, self.base * 2 ** attempt)
+
+
+def retryable(page, error):
+  return error is not None or page.status_code in retry_statuses
+
+# How long to wait before retrying a failed request - or None if it
+# shouldn't be retried. A Retry-After also pauses the host.
+def retry_delay(url, page, error, limiter, retries, attempt):
+  if not retryable(page, error):
+    return None
+  after = retry_after(page)
+  if after is not None:
+    limiter.pause(url, after)
+  if not retries or not retries.take(attempt):
+    return None
+  delay = max(after or 0.0, retries.backoff(attempt))
+  logging.warning('Retrying {} in {:.1f} s ({})'.format(url, delay,
+    error or 'HTTP {}'.format(page.status_code)))
+  return delay
+
+
+# One keep-alive session (and its per-host connection pools) that
+# is shared by all sources and books of a run.
+class Transport(object):
+
+  def __init__(self, args, limiter=None):
+    self.args = args
+    if limiter:
+      self.limiter = limiter
+    elif args.adaptive:
+      self.limiter = ratelimit.AdaptiveHostLimiter(request_rate(args),
+          args.max_rate or 4 * request_rate(args), args.jobs)
+    else:
+      self.limiter = ratelimit.HostLimiter(request_rate(args))
+    self.timeout = (args.connect_timeout, args.read_timeout)
+    self.stats = ConnectionStats()
+    pool_size = args.pool_size or max(1, args.jobs)
+    adapter = CountingAdapter(self.stats, pool_connections=pool_size,
+        pool_maxsize=pool_size)
+    self.session = requests.Session()
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.session.headers.update({ 'User-Agent': args.agent,
+      'Accept-Encoding': args.compression })
+    self.cache = None
+    if args.cache:
+      self.cache = cache.HttpCache(args.cache,
+          int(args.cache_size * 1024 * 1024), args.cache_ttl)
+    elif args.offline:
+      raise ValueError('--offline requires --cache')
+
+  # The time spent waiting for the rate limiter (and retries) is
+  # accounted in the 'wait' phase of stats. Without retries, failed
+  # requests aren't repeated. Urgent requests get their rate limiter
+  # tokens first.
+  def fetch(self, url, headers=None, stats=None, stream=False, retries=None,
+      urgent=False):
+    attempt = 0
+    while True:
+      delay = self.limiter.acquire(url, urgent)
+      if stats:
+        stats.add('wait', delay)
+      self.stats.request(urllib.parse.urlsplit(url).hostname)
+      page, error = None, None
+      start = time.monotonic()
+      try:
+        page = self.session.get(url, headers=headers, timeout=self.timeout,
+            stream=stream)
+      except requests.RequestException as e:
+        error = e
+      finally:
+        self.limiter.done(url, time.monotonic() - start,
+            page.status_code if page is not None else None)
+      delay = retry_delay(url, page, error, self.limiter, retries, attempt)
+      if delay is None:
+        if error:
+          raise error
+        return page
+      if page is not None:
+        page.close()
+      time.sleep(delay)
+      if stats:
+        stats.add('wait', delay)
+      attempt += 1
+
+  # Like get(), but the body isn't read yet, use iter_content() and
+  # close(). With a cache, the page is read completely, though.
+  def stream(self, url, stats=None, retries=None, urgent=False):
+    if self.cache:
+      return self.get(url, stats, retries, urgent)
+    return self.fetch(url, stats=stats, stream=True, retries=retries,
+        urgent=urgent)
+
+  # Fresh cache entries (and all entries in offline mode) are
+  # served without touching the network - and thus without waiting
+  # for the rate limiter. Stale ones are revalidated.
+  def get(self, url, stats=None, retries=None, urgent=False):
+    if not self.cache:
+      return self.fetch(url, stats=stats, retries=retries, urgent=urgent)
+    entry = self.cache.lookup(url)
+    if entry and (self.args.offline or self.cache.fresh(entry)):
+      self.cache.count('hit')
+      return self.cache.response(url, entry)
+    if self.args.offline:
+      raise RuntimeError('Not in cache (offline mode): {}'.format(url))
+    headers = None
+    if entry:
+      headers = self.cache.conditional_headers(entry)
+    page = self.fetch(url, headers, stats, retries=retries, urgent=urgent)
+    if entry and page.status_code == 304:
+      self.cache.count('revalidated')
+      self.cache.revalidated(url, entry)
+      return self.cache.response(url, entry)
+    self.cache.count('miss')
+    if page.status_code == 200:
+      self.cache.put(url, page)
+    return page
+
+  def close(self):
+    self.limiter.log()
+    if self.args.conn_stats:
+      self.stats.log()
+    if self.cache:
+      self.cache.log()
+    self.session.close()
+
+
+# requests per second and host, --rate overrides the --wait mean
+def request_rate(args):
+  if args.rate:
+    return args.rate
+  return 1.0 / args.wait
+
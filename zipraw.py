@@ -0,0 +1,84 @@
+
+# 2015-05-03, Georg Sauthoff <mail@georg.so>, GPLv3+
+
+# Adds already compressed members to a zipfile.ZipFile.
+#
+# The zipfile module only accepts uncompressed data and compresses it
+# while holding the archive. Compressing outside of it allows using
+# several threads (zlib releases the GIL). This uses the same
+# ZipFile internals as ZipFile.writestr() does.
+
+import struct
+import time
+import zipfile
+import zlib
+
+
+def deflate(data, level):
+  c = zlib.compressobj(level, zlib.DEFLATED, -15)
+  return c.compress(data) + c.flush()
+
+
+def compress(data, level):
+  if level:
+    return (zipfile.ZIP_DEFLATED, deflate(data, level))
+  return (zipfile.ZIP_STORED, data)
+
+
+def info(name, data, compress_type, cdata, date_time=None):
+  zinfo = zipfile.ZipInfo(name, date_time or time.localtime(time.time())[:6])
+  zinfo.compress_type = compress_type
+  zinfo.file_size = len(data)
+  zinfo.compress_size = len(cdata)
+  zinfo.CRC = zlib.crc32(data)
+  zinfo.external_attr = 0o644 << 16
+  return zinfo
+
+
+def write_raw(z, zinfo, cdata):
+  zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT
+      or zinfo.compress_size > zipfile.ZIP64_LIMIT)
+  with z._lock:
+    if z._seekable:
+      z.fp.seek(z.start_dir)
+    zinfo.header_offset = z.fp.tell()
+    z._writecheck(zinfo)
+    z._didModify = True
+    z.fp.write(zinfo.FileHeader(zip64))
+    z.fp.write(cdata)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+    z.start_dir = z.fp.tell()
+
+
+def write(z, name, data, level):
+  compress_type, cdata = compress(data, level)
+  write_raw(z, info(name, data, compress_type, cdata), cdata)
+
+
+# returns the ZipInfo and the still compressed data of a member
+def read_raw(z, name):
+  zinfo = z.getinfo(name)
+  with z._lock:
+    z.fp.seek(zinfo.header_offset)
+    h = z.fp.read(zipfile.sizeFileHeader)
+    if len(h) != zipfile.sizeFileHeader or h[0:4] != zipfile.stringFileHeader:
+      raise zipfile.BadZipFile('Bad local file header: {}'.format(name))
+    fh = struct.unpack(zipfile.structFileHeader, h)
+    z.fp.seek(zinfo.header_offset + zipfile.sizeFileHeader
+        + fh[zipfile._FH_FILENAME_LENGTH] + fh[zipfile._FH_EXTRA_FIELD_LENGTH])
+    cdata = z.fp.read(zinfo.compress_size)
+  return zinfo, cdata
+
+
+# copies a member from one archive into another without
+# decompressing it
+def copy(src, dst, name):
+  old, cdata = read_raw(src, name)
+  zinfo = zipfile.ZipInfo(old.filename, old.date_time)
+  zinfo.compress_type = old.compress_type
+  zinfo.file_size = old.file_size
+  zinfo.compress_size = old.compress_size
+  zinfo.CRC = old.CRC
+  zinfo.external_attr = old.external_attr
+  write_raw(dst, zinfo, cdata)